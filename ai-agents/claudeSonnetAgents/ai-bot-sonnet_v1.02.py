@@ -11,16 +11,28 @@
 """
 AI Agent using Claude 3.7 Sonnet with file manipulation and command execution tools.
 """
+import io
 import os
 import sys
 import json
 import time
+import codecs
+import signal
+import shutil
+import difflib
+import hashlib
+import tempfile
+import functools
+import contextlib
+import asyncio
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Any, Optional, Callable
 from dotenv import load_dotenv
 import anthropic
 from rich.console import Console
 from rich.panel import Panel
+from rich.syntax import Syntax
 
 # Load environment variables from .env file
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
@@ -33,9 +45,46 @@ if not ANTHROPIC_API_KEY:
     sys.exit(1)
 
 # Initialize Claude client
-client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
 MODEL = "claude-3-7-sonnet-20250219"
 
+# Agentic loop budgets for a single user turn, checked before each follow-up request
+AGENT_MAX_ITERATIONS = 25       # Model requests per user turn
+AGENT_MAX_TOKENS = 1_000_000    # Cumulative input, cache and output tokens per user turn
+AGENT_MAX_SECONDS = 600         # Wall-clock time per user turn
+
+# Context editing: older tool results are replaced with short placeholders
+CONTEXT_CLEARING_ENABLED = True
+CONTEXT_KEEP_TOOL_RESULTS = 4           # Most recent tool results always sent in full
+CONTEXT_CLEAR_TRIGGER_TOKENS = 20_000   # Clear once stale results add up to this much, so the cached prefix changes rarely
+CONTEXT_CLEAR_MIN_TOKENS = 100          # Smaller results are left alone
+CONTEXT_CHARS_PER_TOKEN = 4.0           # Rough estimate used to size tool results
+
+# Prompt caching: breakpoints on the tools, the system prompt and the latest turn
+PROMPT_CACHE_ENABLED = True
+PROMPT_CACHE_CONTROL = {"type": "ephemeral"}
+
+# Console shared by the agent loop and tools that stream output
+console = Console()
+
+# Command execution parameters
+COMMAND_TIMEOUT = 300       # Wall-clock limit in seconds for a single command
+COMMAND_IDLE_TIMEOUT = 60   # Stop a command that produces no output for this many seconds
+COMMAND_STDOUT_STYLE = "dim"
+COMMAND_STDERR_STYLE = "yellow"
+
+# Edit result parameters
+EDIT_DIFF_CONTEXT_LINES = 3      # Unchanged lines shown around each change in edit diffs
+EDIT_DIFF_MAX_CHARS = 16 * 1024  # Longer diffs are cut; view_file shows the rest
+
+# Tool execution parameters
+TOOL_MAX_WORKERS = 8                   # Threads for blocking tools running at the same time
+TOOL_PATH_ARGUMENTS = ("file_path",)   # Calls on the same path run one after another
+EXCLUSIVE_TOOLS = {"execute_command"}  # Tools that run alone, after every earlier call has finished
+
+# Shared pool for running blocking tool implementations off the event loop
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
 # Tool definitions
 TOOLS = [
     {
@@ -58,7 +107,7 @@ TOOLS = [
     },
     {
         "name": "replace_text",
-        "description": "Replace text in a file",
+        "description": "Replace text in a file. Returns a unified diff of the change",
         "input_schema": {
             "type": "object",
             "properties": {
@@ -73,6 +122,10 @@ TOOLS = [
                 "replace_text": {
                     "type": "string",
                     "description": "Text to replace with"
+                },
+                "return_content": {
+                    "type": "boolean",
+                    "description": "Also return the full updated file (default false; a diff is always returned)"
                 }
             },
             "required": ["file_path", "search_text", "replace_text"]
@@ -80,7 +133,7 @@ TOOLS = [
     },
     {
         "name": "insert_line",
-        "description": "Insert a line at a specific position in a file",
+        "description": "Insert a line at a specific position in a file. Returns a unified diff of the change",
         "input_schema": {
             "type": "object",
             "properties": {
@@ -95,11 +148,49 @@ TOOLS = [
                 "content": {
                     "type": "string",
                     "description": "Content to insert"
+                },
+                "return_content": {
+                    "type": "boolean",
+                    "description": "Also return the full updated file (default false; a diff is always returned)"
                 }
             },
             "required": ["file_path", "line_number", "content"]
         }
     },
+    {
+        "name": "apply_edits",
+        "description": "Apply several edits to one file at once. Every edit is checked against the current file "
+                       "first; if any fails nothing is written. Prefer this over repeated replace_text/insert_line calls. "
+                       "Returns one unified diff",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "file_path": {
+                    "type": "string",
+                    "description": "Path to the file"
+                },
+                "edits": {
+                    "type": "array",
+                    "description": "Edits to apply. Each is either {search_text, replace_text} (replaces every "
+                                   "occurrence) or {line_number, content} (inserts before that line of the original file)",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "search_text": {"type": "string"},
+                            "replace_text": {"type": "string"},
+                            "line_number": {"type": "integer"},
+                            "content": {"type": "string"}
+                        }
+                    }
+                },
+                "return_content": {
+                    "type": "boolean",
+                    "description": "Also return the full updated file (default false; a diff is always returned)"
+                }
+            },
+            "required": ["file_path", "edits"]
+        }
+    },
     {
         "name": "execute_command",
         "description": "Execute a bash command",
@@ -131,6 +222,33 @@ TOOLS = [
 ]
 
 # Tool implementations
+def make_diff(file_path: str, old_text: str, new_text: str) -> str:
+    """Return a unified diff between two versions of a file, cut to EDIT_DIFF_MAX_CHARS."""
+    name = os.path.basename(file_path)
+    lines = []
+    for line in difflib.unified_diff(
+        old_text.splitlines(keepends=True), new_text.splitlines(keepends=True),
+        fromfile=f"a/{name}", tofile=f"b/{name}", n=EDIT_DIFF_CONTEXT_LINES
+    ):
+        lines.append(line if line.endswith("\n") else line + "\n\\ No newline at end of file\n")
+    diff = "".join(lines)
+    if len(diff) > EDIT_DIFF_MAX_CHARS:
+        diff = diff[:EDIT_DIFF_MAX_CHARS] + "\n... [diff cut; use view_file to see the rest]\n"
+    return diff
+
+def make_edit_result(message: str, file_path: str, old_text: str, new_text: str, return_content: bool) -> Dict[str, Any]:
+    """Build an edit tool's result: a diff and content hash, plus the full file only on request."""
+    result = {
+        "status": "success",
+        "message": message,
+        "file_path": file_path,
+        "diff": make_diff(file_path, old_text, new_text),
+        "sha256": hashlib.sha256(new_text.encode("utf-8")).hexdigest()
+    }
+    if return_content:
+        result["updated_content"] = new_text
+    return result
+
 def create_file(file_path: str, content: str) -> Dict[str, Any]:
     """Create a new file with the specified content."""
     try:
@@ -139,15 +257,17 @@ def create_file(file_path: str, content: str) -> Dict[str, Any]:
         # Write content to file
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write(content)
+        # The model already has the content it sent, so only confirm what was written
         return {
             "status": "success", 
             "message": f"File created at {file_path}",
-            "content": content
+            "lines": len(content.splitlines()),
+            "sha256": hashlib.sha256(content.encode("utf-8")).hexdigest()
         }
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-def replace_text(file_path: str, search_text: str, replace_text: str) -> Dict[str, Any]:
+def replace_text(file_path: str, search_text: str, replace_text: str, return_content: bool = False) -> Dict[str, Any]:
     """Replace text in a file."""
     try:
         # Try to find the file with fuzzy matching
@@ -172,12 +292,10 @@ def replace_text(file_path: str, search_text: str, replace_text: str) -> Dict[st
             with open(actual_path, 'w', encoding='utf-8') as f:
                 f.write(new_content)
 
-            return {
-                "status": "success", 
-                "message": f"Replaced '{search_text}' with '{replace_text}' in {actual_path}",
-                "updated_content": new_content,
-                "file_path": actual_path
-            }
+            return make_edit_result(
+                f"Replaced '{search_text}' with '{replace_text}' in {actual_path}",
+                actual_path, content, new_content, return_content
+            )
         elif file_result["status"] == "suggestions":
             # Return suggestions for similar files
             return {
@@ -191,7 +309,7 @@ def replace_text(file_path: str, search_text: str, replace_text: str) -> Dict[st
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-def insert_line(file_path: str, line_number: int, content: str) -> Dict[str, Any]:
+def insert_line(file_path: str, line_number: int, content: str, return_content: bool = False) -> Dict[str, Any]:
     """Insert a line at a specific position in a file."""
     try:
         # Try to find the file with fuzzy matching
@@ -203,6 +321,7 @@ def insert_line(file_path: str, line_number: int, content: str) -> Dict[str, Any
             
             with open(actual_path, 'r', encoding='utf-8') as f:
                 lines = f.readlines()
+            old_content = ''.join(lines)
 
             if line_number < 1 or line_number > len(lines) + 1:
                 return {"status": "error", "message": f"Invalid line number: {line_number}. File has {len(lines)} lines."}
@@ -215,12 +334,119 @@ def insert_line(file_path: str, line_number: int, content: str) -> Dict[str, Any
             with open(actual_path, 'w', encoding='utf-8') as f:
                 f.writelines(lines)
 
+            return make_edit_result(
+                f"Inserted line at position {line_number} in {actual_path}",
+                actual_path, old_content, updated_content, return_content
+            )
+        elif file_result["status"] == "suggestions":
+            # Return suggestions for similar files
             return {
-                "status": "success", 
-                "message": f"Inserted line at position {line_number} in {actual_path}",
-                "updated_content": updated_content,
-                "file_path": actual_path
+                "status": "error",
+                "message": f"File '{file_path}' not found. Did you mean one of these? {', '.join(file_result['suggestions'])}"
             }
+        else:
+            # No matching files found
+            return {"status": "error", "message": file_result["message"]}
+            
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+def plan_edits(text: str, edits: List[Dict[str, Any]]):
+    """Resolve every edit against the original text and return (new_text, errors).
+
+    Replacements apply to every occurrence of their search_text, as replace_text does,
+    and insertions go before their line_number in the original numbering. Nothing is
+    applied if any edit fails to match or two edits overlap.
+    """
+    line_starts = [0]
+    for line in io.StringIO(text).readlines():
+        line_starts.append(line_starts[-1] + len(line))
+
+    spans, errors = [], []
+    for number, edit in enumerate(edits, 1):
+        if not isinstance(edit, dict):
+            errors.append(f"Edit {number}: expected an object")
+        elif "search_text" in edit:
+            search_text = edit["search_text"]
+            start = text.find(search_text) if search_text else -1
+            if start < 0:
+                errors.append(f"Edit {number}: text '{search_text}' not found")
+            while start >= 0:
+                spans.append((start, start + len(search_text), edit.get("replace_text", ""), number))
+                start = text.find(search_text, start + len(search_text))
+        elif "line_number" in edit:
+            line_number = edit["line_number"]
+            if not isinstance(line_number, int) or line_number < 1 or line_number > len(line_starts):
+                errors.append(f"Edit {number}: invalid line number {line_number}, file has {len(line_starts) - 1} lines")
+                continue
+            content = edit.get("content", "")
+            content = content if content.endswith("\n") else content + "\n"
+            offset = line_starts[line_number - 1]
+            if offset == len(text) and text and not text.endswith("\n"):
+                content = "\n" + content
+            spans.append((offset, offset, content, number))
+        else:
+            errors.append(f"Edit {number}: needs search_text and replace_text, or line_number and content")
+
+    # Insertions at an offset go before a replacement starting there; ties keep the given order
+    spans.sort(key=lambda span: (span[0], span[1] > span[0], span[3]))
+    previous_end, previous_number = 0, None
+    for start, end, _, number in spans:
+        if start < previous_end:
+            errors.append(f"Edit {number} overlaps edit {previous_number}")
+        if end > previous_end:
+            previous_end, previous_number = end, number
+    if errors:
+        return None, errors
+
+    pieces, position = [], 0
+    for start, end, replacement, _ in spans:
+        pieces.append(text[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(text[position:])
+    return "".join(pieces), []
+
+def write_file_atomic(file_path: str, text: str) -> None:
+    """Write a file through a temporary file in the same directory and os.replace."""
+    real_path = os.path.realpath(file_path)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(real_path), prefix=f".{os.path.basename(real_path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        shutil.copymode(real_path, temp_path)
+        os.replace(temp_path, real_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+def apply_edits(file_path: str, edits: List[Dict[str, Any]], return_content: bool = False) -> Dict[str, Any]:
+    """Apply several edits to a file in one read and one atomic write."""
+    try:
+        if not edits:
+            return {"status": "error", "message": "No edits given"}
+        # Try to find the file with fuzzy matching
+        file_result = find_file(file_path)
+        
+        if file_result["status"] == "found":
+            # Use the found file path
+            actual_path = file_result["file_path"]
+            
+            with open(actual_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+
+            # Check every edit against the same copy before writing anything
+            new_content, errors = plan_edits(content, edits)
+            if errors:
+                return {"status": "error", "message": f"No edits applied to {actual_path}: {'; '.join(errors)}"}
+
+            write_file_atomic(actual_path, new_content)
+
+            return make_edit_result(
+                f"Applied {len(edits)} edits to {actual_path}",
+                actual_path, content, new_content, return_content
+            )
         elif file_result["status"] == "suggestions":
             # Return suggestions for similar files
             return {
@@ -234,29 +460,111 @@ def insert_line(file_path: str, line_number: int, content: str) -> Dict[str, Any
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-def execute_command(command: str) -> Dict[str, Any]:
-    """Execute a bash command."""
+def kill_process_tree(process) -> None:
+    """Kill a command's shell and every process it started."""
+    if process.returncode is not None:
+        return
     try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            encoding='utf-8'
-        )
+        if os.name == "nt":
+            # taskkill /T walks the child process tree on Windows
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+        else:
+            # The shell was started in its own session, so its pid is also the process group id
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, OSError):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
 
-        # Create a descriptive message based on the command and return code
-        if result.returncode == 0:
+async def execute_command(command: str) -> Dict[str, Any]:
+    """Execute a bash command, streaming its output to the console as lines arrive."""
+    try:
+        if os.name == "nt":
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
+            )
+        else:
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        last_output_time = start_time
+        output = {"stdout": [], "stderr": []}
+
+        async def pump(stream, stream_name):
+            nonlocal last_output_time
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            style = COMMAND_STDOUT_STYLE if stream_name == "stdout" else COMMAND_STDERR_STYLE
+            partial_line = ""
+            while True:
+                data = await stream.read(4096)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    last_output_time = loop.time()
+                    output[stream_name].append(text)
+                    # Echo complete lines to the console as they arrive
+                    *lines, partial_line = (partial_line + text).split("\n")
+                    for line in lines:
+                        console.print(line, style=style, markup=False, highlight=False)
+                if not data:
+                    if partial_line:
+                        console.print(partial_line, style=style, markup=False, highlight=False)
+                    break
+
+        io_task = asyncio.ensure_future(asyncio.gather(
+            pump(process.stdout, "stdout"),
+            pump(process.stderr, "stderr"),
+            process.wait()
+        ))
+
+        timeout_message = None
+        try:
+            while not io_task.done():
+                await asyncio.wait({io_task}, timeout=0.5)
+                now = loop.time()
+                if io_task.done():
+                    break
+                if now - start_time > COMMAND_TIMEOUT:
+                    timeout_message = f"Command timed out after {COMMAND_TIMEOUT}s: '{command}'"
+                elif now - last_output_time > COMMAND_IDLE_TIMEOUT:
+                    timeout_message = f"Command produced no output for {COMMAND_IDLE_TIMEOUT}s and was stopped: '{command}'"
+                if timeout_message:
+                    kill_process_tree(process)
+                    # Give the pipes a moment to drain, then stop reading regardless
+                    await asyncio.wait({io_task}, timeout=2)
+                    io_task.cancel()
+                    await asyncio.gather(io_task, return_exceptions=True)
+                    break
+        except asyncio.CancelledError:
+            kill_process_tree(process)
+            io_task.cancel()
+            # Retrieve the outcome so the abandoned readers do not log a warning
+            io_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            raise
+
+        returncode = process.returncode if process.returncode is not None else -1
+        if timeout_message:
+            message = timeout_message
+        elif returncode == 0:
             message = f"Command executed successfully: '{command}'"
         else:
-            message = f"Command failed with return code {result.returncode}: '{command}'"
+            message = f"Command failed with return code {returncode}: '{command}'"
 
         return {
-            "status": "success" if result.returncode == 0 else "error",
+            "status": "success" if returncode == 0 and not timeout_message else "error",
             "message": message,
-            "stdout": result.stdout,
-            "stderr": result.stderr,
-            "returncode": result.returncode
+            "stdout": "".join(output["stdout"]),
+            "stderr": "".join(output["stderr"]),
+            "returncode": returncode
         }
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -293,21 +601,139 @@ def view_file(file_path: str) -> Dict[str, Any]:
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+# Context editing functions
+# Estimated input tokens saved by each cleared tool result, keyed by tool_use_id
+cleared_tool_results: Dict[str, int] = {}
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens in a text."""
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN)
+
+def make_cleared_placeholder(tool_name: str, content: str) -> str:
+    """Return the short tool_result content that stands in for a cleared result."""
+    try:
+        status = json.loads(content).get("status", "success")
+    except (ValueError, AttributeError):
+        status = "success"
+    return json.dumps({
+        "status": status,
+        "message": f"Older {tool_name} result cleared to save context (about {estimate_tokens(content):,} tokens). "
+                   f"Run the tool again if you need it."
+    })
+
+def clear_stale_tool_results(messages: List[Dict[str, Any]]) -> int:
+    """Replace older tool results in the history with placeholders.
+
+    The most recent CONTEXT_KEEP_TOOL_RESULTS results are pinned. Older results are
+    only cleared once together they reach CONTEXT_CLEAR_TRIGGER_TOKENS; clearing
+    changes the prompt prefix, so doing it in batches keeps most requests reading it
+    from the prompt cache. Each tool_result keeps its tool_use_id, so every tool_use
+    still has its result. Returns the estimated input tokens saved on this request.
+    """
+    tool_names = {}
+    tool_results = []
+    for message in messages:
+        if not isinstance(message["content"], list):
+            continue
+        for block in message["content"]:
+            if block.get("type") == "tool_use":
+                tool_names[block["id"]] = block["name"]
+            elif block.get("type") == "tool_result":
+                tool_results.append(block)
+
+    if CONTEXT_CLEARING_ENABLED:
+        stale = tool_results[:max(len(tool_results) - CONTEXT_KEEP_TOOL_RESULTS, 0)]
+        candidates = [
+            block for block in stale
+            if block["tool_use_id"] not in cleared_tool_results
+            and isinstance(block["content"], str)
+            and estimate_tokens(block["content"]) >= CONTEXT_CLEAR_MIN_TOKENS
+        ]
+        if sum(estimate_tokens(block["content"]) for block in candidates) >= CONTEXT_CLEAR_TRIGGER_TOKENS:
+            for block in candidates:
+                placeholder = make_cleared_placeholder(tool_names.get(block["tool_use_id"], "tool"), block["content"])
+                cleared_tool_results[block["tool_use_id"]] = estimate_tokens(block["content"]) - estimate_tokens(placeholder)
+                block["content"] = placeholder
+
+    return sum(cleared_tool_results.get(block["tool_use_id"], 0) for block in tool_results)
+
+# Prompt caching functions
+def add_cache_breakpoints(system_prompt: str, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Return the system, tools and messages request arguments with prompt cache breakpoints.
+
+    The tools and the system prompt never change, so a breakpoint after each lets every
+    request read them from cache. A third breakpoint on the last block of the latest
+    message moves forward each turn; the next request finds the previous prefix in
+    cache and only the new messages are prefilled. The history itself is not modified,
+    so old breakpoints do not pile up past the API's limit of four.
+    """
+    if not PROMPT_CACHE_ENABLED:
+        return {"system": system_prompt, "tools": TOOLS, "messages": messages}
+
+    tools = TOOLS[:-1] + [dict(TOOLS[-1], cache_control=PROMPT_CACHE_CONTROL)]
+    system = [{"type": "text", "text": system_prompt, "cache_control": PROMPT_CACHE_CONTROL}]
+    if not messages:
+        return {"system": system, "tools": tools, "messages": messages}
+
+    last_message = messages[-1]
+    content = last_message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = content[:-1] + [dict(content[-1], cache_control=PROMPT_CACHE_CONTROL)]
+    return {"system": system, "tools": tools, "messages": messages[:-1] + [dict(last_message, content=content)]}
+
 # Token usage functions
-def get_token_usage(response, response_time=None):
-    """Extract token usage information from Claude API response."""
-    output_tokens = response.usage.output_tokens
-    
-    # Calculate tokens per second if response_time is provided
+def get_token_usage(response):
+    """Extract token usage and timing information from a streamed Claude response.
+
+    Speed is measured over the decode phase only, from the first token to the end of
+    the stream, so prefill and network latency show up in the time to first token
+    instead of lowering the tokens per second.
+    """
+    output_tokens = response["usage"]["output_tokens"]
+    ttft = response["ttft"]
+    total_time = response["total_time"]
+    decode_time = total_time - ttft if ttft is not None else None
+
     tokens_per_second = None
-    if response_time is not None and response_time > 0:
-        tokens_per_second = output_tokens / response_time
-    
+    if decode_time is not None and decode_time > 0:
+        tokens_per_second = output_tokens / decode_time
+
+    # input_tokens only counts the uncached part of the prompt
+    input_tokens = response["usage"]["input_tokens"]
+    cache_creation_tokens = response["usage"].get("cache_creation_input_tokens", 0)
+    cache_read_tokens = response["usage"].get("cache_read_input_tokens", 0)
+
     return {
-        "input_tokens": response.usage.input_tokens,
+        "input_tokens": input_tokens,
+        "cache_creation_tokens": cache_creation_tokens,
+        "cache_read_tokens": cache_read_tokens,
         "output_tokens": output_tokens,
         "tokens_per_second": tokens_per_second,
-        "total_tokens": response.usage.input_tokens + output_tokens
+        "ttft": ttft,
+        "decode_time": decode_time,
+        "total_time": total_time,
+        "total_tokens": input_tokens + cache_creation_tokens + cache_read_tokens + output_tokens,
+        "cleared_tokens": response["usage"].get("cleared_tokens", 0),
+        "requests": 1
+    }
+
+def combine_token_usage(usages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Add up the usage of several requests made for one user turn."""
+    output_tokens = sum(usage["output_tokens"] for usage in usages)
+    decode_time = sum(usage["decode_time"] or 0 for usage in usages)
+    return {
+        "input_tokens": sum(usage["input_tokens"] for usage in usages),
+        "cache_creation_tokens": sum(usage["cache_creation_tokens"] for usage in usages),
+        "cache_read_tokens": sum(usage["cache_read_tokens"] for usage in usages),
+        "output_tokens": output_tokens,
+        "tokens_per_second": output_tokens / decode_time if decode_time > 0 else None,
+        "ttft": usages[0]["ttft"],
+        "decode_time": decode_time,
+        "total_time": sum(usage["total_time"] for usage in usages),
+        "total_tokens": sum(usage["total_tokens"] for usage in usages),
+        "cleared_tokens": sum(usage["cleared_tokens"] for usage in usages),
+        "requests": sum(usage["requests"] for usage in usages)
     }
 
 def find_file(file_path: str) -> Dict[str, Any]:
@@ -376,12 +802,39 @@ def display_token_usage(console, usage):
     # Format tokens per second if available
     tps_display = ""
     if usage.get("tokens_per_second") is not None:
-        tps_display = f" | Speed: [bold red]{usage['tokens_per_second']:.2f} t/s[/bold red]"
+        tps_display = f" | Decode: [bold red]{usage['tokens_per_second']:.2f} t/s[/bold red]"
+
+    # Time to first token covers prefill and network; latency is the whole request
+    timing_display = ""
+    if usage.get("ttft") is not None:
+        timing_display += f" | TTFT: [bold green]{usage['ttft']:.2f}s[/bold green]"
+    if usage.get("total_time") is not None:
+        timing_display += f" | Latency: [bold green]{usage['total_time']:.2f}s[/bold green]"
+
+    # Number of model requests when a turn needed several tool rounds
+    requests_display = ""
+    if usage.get("requests", 1) > 1:
+        requests_display = f"Requests: [bold cyan]{usage['requests']}[/bold cyan] | "
+
+    # Share of the prompt that was read from the prompt cache
+    cache_display = ""
+    prompt_tokens = usage["input_tokens"] + usage.get("cache_creation_tokens", 0) + usage.get("cache_read_tokens", 0)
+    if usage.get("cache_creation_tokens") or usage.get("cache_read_tokens"):
+        cache_display = (
+            f" | Cache write: [bold cyan]{usage['cache_creation_tokens']:,}[/bold cyan]"
+            f" read: [bold cyan]{usage['cache_read_tokens']:,}[/bold cyan]"
+            f" ([bold green]{usage['cache_read_tokens'] / prompt_tokens:.0%}[/bold green] hit)"
+        )
+
+    # Input tokens kept out of the prompt by clearing stale tool results
+    if usage.get("cleared_tokens"):
+        cache_display += f" | Cleared: [bold cyan]~{usage['cleared_tokens']:,}[/bold cyan]"
     
     console.print(Panel(
-        f"[green]Token Usage:[/green] Input: [bold cyan]{usage['input_tokens']:,}[/bold cyan] | "
+        f"[green]Token Usage:[/green] {requests_display}Input: [bold cyan]{usage['input_tokens']:,}[/bold cyan]"
+        f"{cache_display} | "
         f"Output: [bold magenta]{usage['output_tokens']:,}[/bold magenta]"
-        f"{tps_display} | "
+        f"{tps_display}{timing_display} | "
         f"Total: [bold yellow]{usage['total_tokens']:,}[/bold yellow]",
         border_style="blue",
         expand=False
@@ -392,29 +845,249 @@ TOOL_MAP = {
     "create_file": create_file,
     "replace_text": replace_text,
     "insert_line": insert_line,
+    "apply_edits": apply_edits,
     "execute_command": execute_command,
     "view_file": view_file
 }
 
-def execute_tool_call(tool_call) -> Dict[str, Any]:
-    """Execute a tool call and return the result."""
+async def stream_message(system_prompt: str, messages: List[Dict[str, Any]], status_message: str = "Thinking...") -> Dict[str, Any]:
+    """Send a streaming Messages API request and print text as it arrives.
+
+    Returns the assistant content blocks as plain dicts (tool_use inputs are parsed
+    from their partial JSON deltas once each block ends), the stop reason, usage, the
+    time to first token and the total latency.
+    """
+    blocks: Dict[int, Dict[str, Any]] = {}
+    partial_json: Dict[int, str] = {}
+    usage = {"input_tokens": 0, "output_tokens": 0}
+    stop_reason = None
+    first_token_time = None
+    printed_text = False
+
+    # Stale tool results are cleared before the request is built
+    usage["cleared_tokens"] = clear_stale_tool_results(messages)
+
+    status = console.status(f"[bold blue]{status_message}[/bold blue]")
+    status.start()
+    start_time = time.time()
+    try:
+        stream = await client.messages.create(
+            model=MODEL,
+            max_tokens=4096,
+            stream=True,
+            # System prompt, tools and messages, with prompt cache breakpoints
+            **add_cache_breakpoints(system_prompt, messages)
+        )
+        async for event in stream:
+            if event.type == "message_start":
+                usage["input_tokens"] = event.message.usage.input_tokens
+                usage["cache_creation_input_tokens"] = getattr(event.message.usage, "cache_creation_input_tokens", None) or 0
+                usage["cache_read_input_tokens"] = getattr(event.message.usage, "cache_read_input_tokens", None) or 0
+            elif event.type == "content_block_start":
+                block = event.content_block
+                if block.type == "text":
+                    blocks[event.index] = {"type": "text", "text": ""}
+                elif block.type == "tool_use":
+                    blocks[event.index] = {"type": "tool_use", "id": block.id, "name": block.name, "input": {}}
+                    partial_json[event.index] = ""
+            elif event.type == "content_block_delta":
+                if first_token_time is None:
+                    first_token_time = time.time()
+                    status.stop()
+                delta = event.delta
+                if delta.type == "text_delta":
+                    if not printed_text:
+                        console.print("\n[bold purple]AI:[/bold purple] ", end="")
+                        printed_text = True
+                    console.print(delta.text, end="", markup=False, highlight=False)
+                    blocks[event.index]["text"] += delta.text
+                elif delta.type == "input_json_delta":
+                    partial_json[event.index] += delta.partial_json
+            elif event.type == "content_block_stop":
+                if event.index in partial_json:
+                    blocks[event.index]["input"] = json.loads(partial_json.pop(event.index) or "{}")
+            elif event.type == "message_delta":
+                stop_reason = event.delta.stop_reason
+                usage["output_tokens"] = event.usage.output_tokens
+    finally:
+        status.stop()
+        if printed_text:
+            console.print()
+    end_time = time.time()
+
+    # Empty text blocks are rejected when sent back, so leave them out of the history
+    content = [blocks[index] for index in sorted(blocks) if blocks[index]["type"] != "text" or blocks[index]["text"]]
+    return {
+        "content": content,
+        "stop_reason": stop_reason,
+        "usage": usage,
+        "ttft": first_token_time - start_time if first_token_time is not None else None,
+        "total_time": end_time - start_time
+    }
+
+def get_tool_path_key(args: Dict[str, Any]) -> Optional[str]:
+    """Return the normalized path a tool call operates on, or None if it has no path argument.
+
+    The path is resolved with find_file as the tools resolve it, so notes and notes.txt
+    share a lock when both name the same file.
+    """
+    for arg_name in TOOL_PATH_ARGUMENTS:
+        if isinstance(args.get(arg_name), str):
+            file_result = find_file(args[arg_name])
+            path = file_result["file_path"] if file_result["status"] == "found" else args[arg_name]
+            return os.path.normcase(os.path.realpath(path))
+    return None
+
+async def invoke_tool(tool_name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    """Await async tools directly and run blocking ones on the tool executor."""
+    tool_function = TOOL_MAP[tool_name]
+    if asyncio.iscoroutinefunction(tool_function):
+        return await tool_function(**args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(tool_executor, functools.partial(tool_function, **args))
+
+async def run_tool_call(tool_call, path_locks: Dict[str, asyncio.Lock]) -> Dict[str, Any]:
+    """Run a single tool call, serialized with other calls on the same path."""
     try:
-        tool_name = tool_call.name
-        function_args = tool_call.input
+        tool_name = tool_call["name"]
+        args = tool_call["input"]
 
         if not tool_name or tool_name not in TOOL_MAP:
             return {"status": "error", "message": f"Unknown tool: {tool_name}"}
 
-        # Execute the tool
-        result = TOOL_MAP[tool_name](**function_args)
-        return result
+        # Resolved before the first await, so calls on one path queue for its lock in order
+        path_key = get_tool_path_key(args)
+        if path_key is None:
+            return await invoke_tool(tool_name, args)
+        # asyncio.Lock wakes waiters in FIFO order, so calls on one path keep their original order
+        async with path_locks.setdefault(path_key, asyncio.Lock()):
+            return await invoke_tool(tool_name, args)
     except Exception as e:
         return {"status": "error", "message": f"Error executing tool: {str(e)}"}
 
-def run_agent():
-    """Run the agent in an interactive loop."""
-    console = Console()
+async def execute_tool_calls(tool_calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Execute the tool calls of one response concurrently and return their results in order.
+
+    Calls on the same file run one after another, and tools in EXCLUSIVE_TOOLS wait
+    for every earlier call to finish and block later ones until they are done, so a
+    command never sees a half-applied batch of edits.
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(tool_calls)
+    path_locks: Dict[str, asyncio.Lock] = {}
+    pending = {}
+
+    async def drain_pending():
+        if pending:
+            outcomes = await asyncio.gather(*pending.values())
+            for index, outcome in zip(pending.keys(), outcomes):
+                results[index] = outcome
+            pending.clear()
+
+    for index, tool_call in enumerate(tool_calls):
+        if tool_call["name"] in EXCLUSIVE_TOOLS:
+            await drain_pending()
+            results[index] = await run_tool_call(tool_call, path_locks)
+        else:
+            pending[index] = asyncio.create_task(run_tool_call(tool_call, path_locks))
+
+    await drain_pending()
+    return results
+
+def display_tool_result(result: Dict[str, Any]) -> None:
+    """Print a tool result in the console."""
+    if result["status"] == "success":
+        if "content" in result:
+            console.print(Panel(result["content"], title="File Content", border_style="green"))
+        elif "diff" in result:
+            # Show only what changed, even when the full file was requested
+            console.print(f"\n[green]Result:[/green] {result.get('message', '')}")
+            if result["diff"]:
+                console.print(Panel(Syntax(result["diff"].rstrip("\n"), "diff", word_wrap=True), title="Changes", border_style="green"))
+        else:
+            console.print(f"\n[green]Result:[/green] {result.get('message', '')}")
+            if "stdout" in result and result["stdout"]:
+                console.print(Panel(result["stdout"], title="Output", border_style="blue"))
+    else:
+        console.print(f"\n[orange1]Hmm...:[/orange1] {result.get('message', '')}")
+        if "stderr" in result and result["stderr"]:
+            console.print(Panel(result["stderr"], title="Additional Information", border_style="orange1"))
+
+def check_turn_budget(usages: List[Dict[str, Any]], start_time: float) -> Optional[str]:
+    """Return why the current turn must stop before another request, or None to continue."""
+    total_tokens = sum(usage["total_tokens"] for usage in usages)
+    elapsed = time.time() - start_time
+    if len(usages) >= AGENT_MAX_ITERATIONS:
+        return f"reached the limit of {AGENT_MAX_ITERATIONS} requests"
+    if total_tokens >= AGENT_MAX_TOKENS:
+        return f"used {total_tokens:,} of {AGENT_MAX_TOKENS:,} tokens"
+    if elapsed >= AGENT_MAX_SECONDS:
+        return f"ran for {elapsed:.0f}s of {AGENT_MAX_SECONDS}s"
+    return None
+
+async def run_turn(system_prompt: str, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Answer the latest user message, running tools until the model ends its turn.
+
+    Every assistant response is kept in the history with its tool_use blocks, each
+    followed by a user message holding their results, so the history stays valid
+    even when a budget stops the loop early. Returns the combined token usage.
+    """
+    usages = []
+    start_time = time.time()
+    status_message = "Thinking..."
+
+    while True:
+        # Text is printed while it streams in
+        response = await stream_message(system_prompt, messages, status_message)
+        usages.append(get_token_usage(response))
+        if response["content"]:
+            messages.append({"role": "assistant", "content": response["content"]})
+
+        tool_calls = [block for block in response["content"] if block["type"] == "tool_use"]
+        if not tool_calls:
+            if response["stop_reason"] != "end_turn":
+                console.print(f"\n[yellow]Response stopped early: {response['stop_reason']}[/yellow]")
+            break
+
+        # Run every tool call of the response at once; results come back in call order
+        for tool_call in tool_calls:
+            console.print(f"\n[bold yellow]Executing tool:[/bold yellow] {tool_call['name']}")
+        results = await execute_tool_calls(tool_calls)
+        for result in results:
+            display_tool_result(result)
+
+        # All results go back in a single user message, one tool_result block per call
+        messages.append({
+            "role": "user",
+            "content": [
+                {"type": "tool_result", "tool_use_id": tool_call["id"], "content": json.dumps(result)}
+                for tool_call, result in zip(tool_calls, results)
+            ]
+        })
 
+        stop_reason = check_turn_budget(usages, start_time)
+        if stop_reason:
+            console.print(f"\n[yellow]Stopped the tool loop: {stop_reason}. Reply to let the agent continue.[/yellow]")
+            break
+        status_message = "Getting follow-up..."
+
+    return combine_token_usage(usages)
+
+def trim_failed_turn(messages: List[Dict[str, Any]], turn_start: int) -> None:
+    """Cut the history of a failed turn back to its last complete tool round.
+
+    Rounds whose tool_use blocks all got their tool_result stay, so the model still
+    sees the edits that already ran. An assistant message still waiting for its
+    results is dropped, and so is the user message if no round completed.
+    """
+    while len(messages) > turn_start and messages[-1]["role"] == "assistant" and any(
+        block["type"] == "tool_use" for block in messages[-1]["content"]
+    ):
+        messages.pop()
+    if len(messages) == turn_start + 1:
+        del messages[turn_start:]
+
+async def run_agent():
+    """Run the agent in an interactive loop."""
     # Define the system prompt separately
     system_prompt = """You are an AI assistant with access to tools for file manipulation and command execution.
 You can help users create, modify, and view files, as well as execute commands.
@@ -444,157 +1117,28 @@ Always adapt your command syntax to the operating system the user is running."""
         console.print(f"- [cyan]{tool['name']}[/cyan]: {tool['description']}")
     console.print()
 
-    while True:
-        user_input = console.input("[bold green]You:[/bold green] ")
-        if user_input.lower() in ['exit', 'quit']:
-            console.print("[yellow]Exiting agent.[/yellow]")
-            break
-
-        messages.append({"role": "user", "content": user_input})
-
-        try:
-            with console.status("[bold blue]Thinking...[/bold blue]"):
-                # Start timing the response
-                start_time = time.time()
-                response = client.messages.create(
-                    model=MODEL,
-                    system=system_prompt,  # Pass system prompt as a separate parameter
-                    messages=messages,
-                    tools=TOOLS,
-                    max_tokens=4096
-                )
-                # Calculate response time
-                response_time = time.time() - start_time
-
-            # Get token usage from the response with timing information
-            usage = get_token_usage(response, response_time)
-
-            assistant_message = {"role": "assistant", "content": response.content[0].text}
-
-            # Handle tool calls if present
-            if hasattr(response, 'content') and response.content:
-                # Check if any content block is a tool_use type
-                has_tool_calls = any(
-                    hasattr(content_item, 'type') and content_item.type == 'tool_use'
-                    for content_item in response.content
-                )
-
-                if has_tool_calls:
-                    # Extract text content (if any)
-                    text_content = next((item.text for item in response.content
-                                        if hasattr(item, 'type') and item.type == 'text'), "")
-
-                    if text_content:
-                        console.print(f"\n[bold purple]AI:[/bold purple] {text_content}")
-
-                    # Create assistant content array more directly
-                    assistant_content = []
-                    for item in response.content:
-                        if item.type == 'text':
-                            assistant_content.append({"type": "text", "text": item.text})
-                        elif item.type == 'tool_use':
-                            assistant_content.append({
-                                "type": "tool_use",
-                                "id": item.id,
-                                "name": item.name,
-                                "input": item.input
-                            })
-
-                    # Add the assistant message with tool use to the conversation history
-                    messages.append({"role": "assistant", "content": assistant_content})
-
-                    # Extract and process tool calls
-                    tool_calls = [item for item in response.content
-                                if hasattr(item, 'type') and item.type == 'tool_use']
-
-                    # Execute each tool call and add the results to the conversation
-                    for tool_call in tool_calls:
-                        tool_name = tool_call.name  # Access name directly on the tool_use block
-                        console.print(f"\n[bold yellow]Executing tool:[/bold yellow] {tool_name}")
-                        result = execute_tool_call(tool_call)
-
-                        # Format the result for display
-                        if result["status"] == "success":
-                            if "content" in result:
-                                console.print(Panel(result["content"], title="File Content", border_style="green"))
-                            elif "updated_content" in result:
-                                console.print(f"\n[green]Result:[/green] {result.get('message', '')}")
-                                console.print(Panel(result["updated_content"], title="Updated File Content", border_style="green"))
-                            else:
-                                console.print(f"\n[green]Result:[/green] {result.get('message', '')}")
-                                if "stdout" in result and result["stdout"]:
-                                    console.print(Panel(result["stdout"], title="Output", border_style="blue"))
-                        else:
-                            console.print(f"\n[orange1]Hmm...:[/orange1] {result.get('message', '')}")
-                            if "stderr" in result and result["stderr"]:
-                                console.print(Panel(result["stderr"], title="Additional Information", border_style="orange1"))
-
-                        # Add tool result to messages as a user message with tool_result content
-                        messages.append({
-                            "role": "user",
-                            "content": [{
-                                "type": "tool_result",
-                                "tool_use_id": tool_call.id,
-                                "content": json.dumps(result)
-                            }]
-                        })
-
-                    # Get a follow-up response from the assistant
-                    with console.status("[bold blue]Getting follow-up...[/bold blue]"):
-                        # Start timing the follow-up response
-                        follow_up_start_time = time.time()
-                        follow_up = client.messages.create(
-                            model=MODEL,
-                            system=system_prompt,  # Pass system prompt as a separate parameter
-                            messages=messages,
-                            tools=TOOLS,
-                            max_tokens=4096
-                        )
-                        # Calculate follow-up response time
-                        follow_up_response_time = time.time() - follow_up_start_time
-
-                    # Get token usage from the follow-up response with timing information
-                    follow_up_usage = get_token_usage(follow_up, follow_up_response_time)
-
-                    # Extract text from the follow-up response
-                    follow_up_text = next((item.text for item in follow_up.content
-                                        if hasattr(item, 'type') and item.type == 'text'), "")
-
-                    # Create a simple text-only assistant message for the follow-up
-                    assistant_message = {"role": "assistant", "content": follow_up_text}
-                    messages.append(assistant_message)
-                    console.print(f"\n[bold purple]AI:[/bold purple] {follow_up_text}")
-
-                    # Display combined token usage
-                    total_output_tokens = usage["output_tokens"] + follow_up_usage["output_tokens"]
-                    total_response_time = (response_time if response_time else 0) + (follow_up_response_time if follow_up_response_time else 0)
-                    
-                    # Calculate combined tokens per second
-                    total_tokens_per_second = None
-                    if total_response_time > 0:
-                        total_tokens_per_second = total_output_tokens / total_response_time
-                    
-                    total_usage = {
-                        "input_tokens": usage["input_tokens"] + follow_up_usage["input_tokens"],
-                        "output_tokens": total_output_tokens,
-                        "tokens_per_second": total_tokens_per_second,
-                        "total_tokens": usage["total_tokens"] + follow_up_usage["total_tokens"]
-                    }
-                    display_token_usage(console, total_usage)
-                else:
-                    # No tool calls, just regular text response
-                    text_content = next((item.text for item in response.content
-                                        if hasattr(item, 'type') and item.type == 'text'), "")
+    try:
+        while True:
+            # Read input on a thread so the event loop stays free
+            user_input = await asyncio.to_thread(console.input, "[bold green]You:[/bold green] ")
+            if user_input.lower() in ['exit', 'quit']:
+                console.print("[yellow]Exiting agent.[/yellow]")
+                break
 
-                    assistant_message = {"role": "assistant", "content": text_content}
-                    messages.append(assistant_message)
-                    console.print(f"\n[bold purple]AI:[/bold purple] {text_content}")
+            turn_start = len(messages)
+            messages.append({"role": "user", "content": user_input})
 
-                    # Display token usage
-                    display_token_usage(console, usage)
+            try:
+                usage = await run_turn(system_prompt, messages)
 
-        except Exception as e:
-            console.print(f"[bold red]Error:[/bold red] {str(e)}")
+                # One line for every request of the turn
+                display_token_usage(console, usage)
+            except Exception as e:
+                # Keep completed tool rounds but leave no tool_use without its tool_result
+                trim_failed_turn(messages, turn_start)
+                console.print(f"[bold red]Error:[/bold red] {str(e)}")
+    finally:
+        tool_executor.shutdown(wait=False)
 
 if __name__ == "__main__":
-    run_agent()
\ No newline at end of file
+    asyncio.run(run_agent())
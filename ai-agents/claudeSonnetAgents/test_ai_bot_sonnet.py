@@ -0,0 +1,519 @@
+#!/usr/bin/env -S uv run --script
+
+# /// script
+# dependencies = [
+#   "anthropic>=0.45.2",
+#   "python-dotenv>=1.0.0",
+#   "rich>=13.7.0",
+#   "pytest>=8.3.5",
+# ]
+# ///
+
+"""
+Tests for the Claude Sonnet agent
+
+The Messages API is replaced by a local stub that records each request and replays
+scripted stream events, so these tests run without an API key or network access.
+
+Run with:
+    uv run pytest test_ai_bot_sonnet.py -v
+"""
+
+import os
+import copy
+import json
+import hashlib
+import time
+import asyncio
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+# The agent exits at import time without an API key; the stub never uses it
+os.environ.setdefault("ANTHROPIC_API_KEY", "test-key")
+
+# The script name is not a valid module name, so load it from its path
+spec = importlib.util.spec_from_file_location(
+    "ai_bot_sonnet", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai-bot-sonnet_v1.02.py")
+)
+bot = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bot)
+
+def text_events(text, usage=None, stop_reason="end_turn"):
+    """Build the stream events of a response with a single text block."""
+    usage = usage or {"input_tokens": 10}
+    return [
+        SimpleNamespace(type="message_start", message=SimpleNamespace(usage=SimpleNamespace(**usage))),
+        SimpleNamespace(type="content_block_start", index=0, content_block=SimpleNamespace(type="text")),
+        SimpleNamespace(type="content_block_delta", index=0, delta=SimpleNamespace(type="text_delta", text=text)),
+        SimpleNamespace(type="content_block_stop", index=0),
+        SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason=stop_reason),
+                        usage=SimpleNamespace(output_tokens=5)),
+    ]
+
+def tool_use_events(tool_id, name, arguments_json):
+    """Build the stream events of a response with one tool_use block split over two deltas."""
+    middle = len(arguments_json) // 2
+    return [
+        SimpleNamespace(type="message_start", message=SimpleNamespace(usage=SimpleNamespace(input_tokens=10))),
+        SimpleNamespace(type="content_block_start", index=0,
+                        content_block=SimpleNamespace(type="tool_use", id=tool_id, name=name)),
+        SimpleNamespace(type="content_block_delta", index=0,
+                        delta=SimpleNamespace(type="input_json_delta", partial_json=arguments_json[:middle])),
+        SimpleNamespace(type="content_block_delta", index=0,
+                        delta=SimpleNamespace(type="input_json_delta", partial_json=arguments_json[middle:])),
+        SimpleNamespace(type="content_block_stop", index=0),
+        SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason="tool_use"),
+                        usage=SimpleNamespace(output_tokens=5)),
+    ]
+
+async def replay(events):
+    """Yield scripted stream events the way the async client's stream does."""
+    for event in events:
+        yield event
+
+class StubMessages:
+    """Stands in for client.messages: records requests and replays scripted event streams.
+
+    A scripted exception instead of a stream is raised by its request.
+    """
+
+    def __init__(self):
+        self.streams = []
+        self.requests = []
+
+    async def create(self, **kwargs):
+        # Deep copy so later changes to the history do not alter what was sent
+        self.requests.append(copy.deepcopy(kwargs))
+        stream = self.streams.pop(0)
+        if isinstance(stream, Exception):
+            raise stream
+        return replay(stream)
+
+@pytest.fixture
+def stub_messages(monkeypatch):
+    """Route the agent's Messages API calls to a StubMessages instance."""
+    stub = StubMessages()
+    monkeypatch.setattr(bot.client, "messages", stub)
+    return stub
+
+def count_breakpoints(request):
+    """Count the cache_control markers anywhere in a request."""
+    blocks = list(request["tools"])
+    blocks += request["system"] if isinstance(request["system"], list) else []
+    for message in request["messages"]:
+        if isinstance(message["content"], list):
+            blocks += message["content"]
+    return sum(1 for block in blocks if "cache_control" in block)
+
+def test_stream_message_assembles_text_and_tool_input(stub_messages):
+    """Test that streamed text and partial tool input JSON are assembled into content blocks."""
+    stub_messages.streams = [tool_use_events("tool_1", "view_file", '{"file_path": "notes.txt"}')]
+    response = asyncio.run(bot.stream_message("system prompt", [{"role": "user", "content": "show notes"}]))
+
+    assert response["content"] == [
+        {"type": "tool_use", "id": "tool_1", "name": "view_file", "input": {"file_path": "notes.txt"}}
+    ]
+    assert response["stop_reason"] == "tool_use"
+    assert response["ttft"] is not None and response["total_time"] >= response["ttft"]
+
+def test_cache_breakpoints_on_tools_system_and_latest_turn(stub_messages):
+    """Test that breakpoints sit on the last tool, the system prompt and the newest message only."""
+    messages = [
+        {"role": "user", "content": "first question"},
+        {"role": "assistant", "content": "first answer"},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "tool_1", "content": "{}"}]},
+    ]
+    original = copy.deepcopy(messages)
+    stub_messages.streams = [text_events("done")]
+    asyncio.run(bot.stream_message("system prompt", messages))
+
+    request = stub_messages.requests[0]
+    assert request["tools"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert all("cache_control" not in tool for tool in request["tools"][:-1])
+    assert request["system"] == [{"type": "text", "text": "system prompt", "cache_control": {"type": "ephemeral"}}]
+    assert request["messages"][-1]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert request["messages"][:-1] == original[:-1]
+    assert count_breakpoints(request) == 3
+    # The history and the tool definitions are left untouched
+    assert messages == original
+    assert all("cache_control" not in tool for tool in bot.TOOLS)
+
+def test_cache_breakpoint_rolls_forward(stub_messages):
+    """Test that each request carries one rolling breakpoint, on its newest message."""
+    messages = [{"role": "user", "content": "hello"}]
+    stub_messages.streams = [text_events("hi"), text_events("again")]
+    asyncio.run(bot.stream_message("system prompt", messages))
+    messages += [{"role": "assistant", "content": "hi"}, {"role": "user", "content": "and now?"}]
+    asyncio.run(bot.stream_message("system prompt", messages))
+
+    first, second = stub_messages.requests
+    assert first["messages"][0]["content"] == [{"type": "text", "text": "hello", "cache_control": {"type": "ephemeral"}}]
+    assert second["messages"][0]["content"] == "hello"
+    assert second["messages"][-1]["content"][-1]["text"] == "and now?"
+    assert count_breakpoints(second) == 3
+
+def test_token_usage_reports_cache_reads(stub_messages):
+    """Test that cache creation and read tokens are counted and shown with the hit ratio."""
+    usage = {"input_tokens": 100, "cache_creation_input_tokens": 300, "cache_read_input_tokens": 1600}
+    stub_messages.streams = [text_events("cached", usage=usage)]
+    response = asyncio.run(bot.stream_message("system prompt", [{"role": "user", "content": "hi"}]))
+
+    token_usage = bot.get_token_usage(response)
+    assert (token_usage["cache_creation_tokens"], token_usage["cache_read_tokens"]) == (300, 1600)
+    assert token_usage["total_tokens"] == 100 + 300 + 1600 + 5
+
+    with bot.console.capture() as capture:
+        bot.display_token_usage(bot.console, token_usage)
+    assert "80% hit" in capture.get()
+
+def test_decode_speed_excludes_time_to_first_token():
+    """Test that tokens per second count decode time only and turns add up their requests."""
+    response = {"usage": {"input_tokens": 10, "output_tokens": 100}, "ttft": 3.0, "total_time": 5.0}
+    usage = bot.get_token_usage(response)
+    assert (usage["decode_time"], usage["tokens_per_second"]) == (2.0, 50.0)
+
+    second = bot.get_token_usage({"usage": {"input_tokens": 10, "output_tokens": 50}, "ttft": 1.0, "total_time": 4.0})
+    combined = bot.combine_token_usage([usage, second])
+    assert combined["ttft"] == 3.0 and combined["total_time"] == 9.0
+    assert combined["tokens_per_second"] == 150 / 5.0 and combined["requests"] == 2
+
+    with bot.console.capture() as capture:
+        bot.display_token_usage(bot.console, combined)
+    output = capture.get()
+    assert "TTFT: 3.00s" in output and "Latency: 9.00s" in output and "Decode: 30.00 t/s" in output
+
+def test_edit_tools_return_diffs(tmp_path, monkeypatch):
+    """Test that edits return a compact diff and hash, and the whole file only on request."""
+    test_file = tmp_path / "long.py"
+    test_file.write_text("".join(f"line_{i} = {i}\n" for i in range(1, 201)))
+
+    result = bot.replace_text(str(test_file), "line_100 = 100", "line_100 = 'hundred'")
+    assert "updated_content" not in result
+    assert "-line_100 = 100\n+line_100 = 'hundred'\n" in result["diff"]
+    assert " line_97 = 97\n" in result["diff"] and "line_96 = 96" not in result["diff"]
+    assert result["sha256"] == hashlib.sha256(test_file.read_bytes()).hexdigest()
+
+    result = bot.insert_line(str(test_file), 1, "# header", return_content=True)
+    assert result["diff"].startswith("--- a/long.py\n+++ b/long.py\n@@ -1,3 +1,4 @@\n+# header\n")
+    assert result["updated_content"] == test_file.read_text()
+
+    result = bot.create_file(str(tmp_path / "new.txt"), "one\ntwo")
+    assert "content" not in result and result["lines"] == 2
+
+    assert bot.make_diff("end.txt", "a\nb", "a\nc").endswith("-b\n\\ No newline at end of file\n+c\n\\ No newline at end of file\n")
+    monkeypatch.setattr(bot, "EDIT_DIFF_MAX_CHARS", 50)
+    assert bot.make_diff("big.txt", "x\n" * 100, "y\n" * 100).endswith("[diff cut; use view_file to see the rest]\n")
+
+def test_apply_edits_is_all_or_nothing(tmp_path):
+    """Test that apply_edits applies many edits in one pass, or none if any anchor fails."""
+    test_file = tmp_path / "module.py"
+    test_file.write_text("import os\n\ndef old_name():\n    return old_name\n")
+
+    result = bot.apply_edits(str(test_file), [
+        {"search_text": "old_name", "replace_text": "new_name"},
+        {"line_number": 1, "content": "import sys"},
+        {"line_number": 5, "content": "# end"},
+    ])
+    assert result["status"] == "success"
+    assert test_file.read_text() == "import sys\nimport os\n\ndef new_name():\n    return new_name\n# end\n"
+    added = [line for line in result["diff"].splitlines() if line.startswith("+") and not line.startswith("+++")]
+    assert added == ["+import sys", "+def new_name():", "+    return new_name", "+# end"]
+
+    changed = test_file.read_text()
+    for edits in (
+        [{"search_text": "new_name", "replace_text": "x"}, {"search_text": "missing", "replace_text": "y"}],
+        [{"search_text": "def new_name", "replace_text": "x"}, {"search_text": "new_name():", "replace_text": "y"}],
+        [{"line_number": 99, "content": "z"}],
+    ):
+        result = bot.apply_edits(str(test_file), edits)
+        assert result["status"] == "error" and "No edits applied" in result["message"]
+        assert test_file.read_text() == changed
+    assert os.listdir(tmp_path) == ["module.py"]
+
+def test_atomic_write_leaves_no_temp_file(tmp_path, monkeypatch):
+    """Test that a failed write keeps the original file and removes its temporary file."""
+    test_file = tmp_path / "module.py"
+    test_file.write_text("original\n")
+    test_file.chmod(0o750)
+
+    def failing_replace(source, destination):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(bot.os, "replace", failing_replace)
+    result = bot.apply_edits(str(test_file), [{"search_text": "original", "replace_text": "changed"}])
+    assert result == {"status": "error", "message": "disk full"}
+    assert test_file.read_text() == "original\n"
+    assert os.listdir(tmp_path) == ["module.py"]
+
+    monkeypatch.undo()
+    bot.write_file_atomic(str(test_file), "changed\n")
+    assert test_file.read_text() == "changed\n"
+    assert test_file.stat().st_mode & 0o777 == 0o750
+    assert os.listdir(tmp_path) == ["module.py"]
+
+def tool_call(name, index, **args):
+    """Build a tool_use block as stream_message returns it."""
+    return {"type": "tool_use", "id": f"tool_{index}", "name": name, "input": args}
+
+def test_tool_calls_run_concurrently_in_order(monkeypatch):
+    """Test that the reads of one response overlap and their results keep the call order."""
+    def slow_view(file_path):
+        time.sleep(0.3)
+        return {"status": "success", "file_path": file_path}
+
+    monkeypatch.setitem(bot.TOOL_MAP, "view_file", slow_view)
+    calls = [tool_call("view_file", index, file_path=f"file_{index}.txt") for index in range(6)]
+
+    start = time.perf_counter()
+    results = asyncio.run(bot.execute_tool_calls(calls))
+    elapsed = time.perf_counter() - start
+
+    assert [result["file_path"] for result in results] == [f"file_{index}.txt" for index in range(6)]
+    assert elapsed < 1.0
+
+def test_edit_tools_run_on_the_tool_executor(monkeypatch, tmp_path):
+    """Test that edit and view tools all run on the shared thread pool."""
+    used = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            used.append(fn.func.__name__)
+            return super().submit(fn, *args, **kwargs)
+
+    with RecordingExecutor(max_workers=2) as pool:
+        monkeypatch.setattr(bot, "tool_executor", pool)
+        target = tmp_path / "notes.txt"
+        target.write_text("alpha\n")
+        results = asyncio.run(bot.execute_tool_calls([
+            tool_call("replace_text", 0, file_path=str(target), search_text="alpha", replace_text="beta"),
+            tool_call("view_file", 1, file_path=str(tmp_path / "other.txt")),
+        ]))
+
+    assert sorted(used) == ["replace_text", "view_file"]
+    assert results[0]["status"] == "success"
+    assert target.read_text() == "beta\n"
+
+def test_same_path_calls_keep_their_order(monkeypatch, tmp_path):
+    """Test that edits to one file run one after another, in the order they were requested."""
+    target = tmp_path / "notes.txt"
+    target.write_text("one\n")
+    calls = [
+        tool_call("replace_text", 0, file_path=str(target), search_text="one", replace_text="two"),
+        tool_call("replace_text", 1, file_path=str(target), search_text="two", replace_text="three"),
+        tool_call("view_file", 2, file_path=str(target)),
+    ]
+    results = asyncio.run(bot.execute_tool_calls(calls))
+
+    assert [result["status"] for result in results] == ["success"] * 3
+    assert results[2]["content"] == "three\n"
+
+def test_edits_naming_one_file_differently_share_a_lock(monkeypatch, tmp_path):
+    """Test that edits naming one file differently share a lock and apply in order."""
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    (workspace / "notes.txt").write_text("one\n")
+    monkeypatch.chdir(workspace)
+    assert bot.get_tool_path_key({"file_path": "notes"}) == bot.get_tool_path_key({"file_path": "notes.txt"})
+
+    results = asyncio.run(bot.execute_tool_calls([
+        tool_call("replace_text", 0, file_path="notes", search_text="one", replace_text="two"),
+        tool_call("replace_text", 1, file_path="notes.txt", search_text="two", replace_text="three"),
+        tool_call("apply_edits", 2, file_path="notes", edits=[{"line_number": 2, "content": "four"}]),
+    ]))
+
+    assert [result["status"] for result in results] == ["success"] * 3
+    assert (workspace / "notes.txt").read_text() == "three\nfour\n"
+
+def test_exclusive_tools_wait_for_earlier_calls(monkeypatch):
+    """Test that execute_command starts only after the calls before it have finished."""
+    events = []
+    lock = threading.Lock()
+
+    def slow_view(file_path):
+        time.sleep(0.2)
+        with lock:
+            events.append(f"view {file_path}")
+        return {"status": "success"}
+
+    async def command(command):
+        events.append(f"command {command}")
+        return {"status": "success"}
+
+    monkeypatch.setitem(bot.TOOL_MAP, "view_file", slow_view)
+    monkeypatch.setitem(bot.TOOL_MAP, "execute_command", command)
+    asyncio.run(bot.execute_tool_calls([
+        tool_call("view_file", 0, file_path="a"),
+        tool_call("view_file", 1, file_path="b"),
+        tool_call("execute_command", 2, command="ls"),
+    ]))
+
+    assert sorted(events[:2]) == ["view a", "view b"]
+    assert events[2] == "command ls"
+
+def test_failing_tool_returns_an_error_result(monkeypatch):
+    """Test that an exception in one tool becomes its error result without affecting the others."""
+    def broken(file_path):
+        raise OSError("disk on fire")
+
+    monkeypatch.setitem(bot.TOOL_MAP, "view_file", broken)
+    results = asyncio.run(bot.execute_tool_calls([
+        tool_call("view_file", 0, file_path="a"),
+        tool_call("missing_tool", 1),
+    ]))
+
+    assert results[0] == {"status": "error", "message": "Error executing tool: disk on fire"}
+    assert results[1] == {"status": "error", "message": "Unknown tool: missing_tool"}
+
+def test_run_turn_loops_until_end_turn(stub_messages, monkeypatch):
+    """Test that tool rounds continue until end_turn and every tool_use gets its tool_result."""
+    monkeypatch.setitem(bot.TOOL_MAP, "view_file", lambda file_path: {"status": "success", "file_path": file_path})
+    stub_messages.streams = [
+        tool_use_events("tool_1", "view_file", '{"file_path": "a.txt"}'),
+        tool_use_events("tool_2", "view_file", '{"file_path": "b.txt"}'),
+        text_events("both files read"),
+    ]
+    messages = [{"role": "user", "content": "read a and b"}]
+    usage = asyncio.run(bot.run_turn("system prompt", messages))
+
+    assert [message["role"] for message in messages] == ["user", "assistant", "user", "assistant", "user", "assistant"]
+    assert messages[2]["content"][0]["tool_use_id"] == "tool_1"
+    assert messages[4]["content"][0]["tool_use_id"] == "tool_2"
+    assert messages[-1]["content"] == [{"type": "text", "text": "both files read"}]
+    assert usage["requests"] == 3
+    assert usage["output_tokens"] == 15
+
+    with bot.console.capture() as capture:
+        bot.display_token_usage(bot.console, usage)
+    assert "Requests: 3" in capture.get()
+
+def test_run_turn_stops_at_the_iteration_budget(stub_messages, monkeypatch):
+    """Test that the iteration budget ends the loop with the history still valid."""
+    monkeypatch.setattr(bot, "AGENT_MAX_ITERATIONS", 2)
+    monkeypatch.setitem(bot.TOOL_MAP, "view_file", lambda file_path: {"status": "success"})
+    stub_messages.streams = [tool_use_events(f"tool_{index}", "view_file", '{"file_path": "a.txt"}') for index in range(5)]
+    messages = [{"role": "user", "content": "keep reading"}]
+    usage = asyncio.run(bot.run_turn("system prompt", messages))
+
+    assert usage["requests"] == 2
+    assert len(stub_messages.streams) == 3
+    assert messages[-1]["content"][0]["type"] == "tool_result"
+
+def test_run_turn_stops_at_the_token_budget(stub_messages, monkeypatch):
+    """Test that the cumulative token budget is checked before each follow-up request."""
+    monkeypatch.setattr(bot, "AGENT_MAX_TOKENS", 20)
+    monkeypatch.setitem(bot.TOOL_MAP, "view_file", lambda file_path: {"status": "success"})
+    stub_messages.streams = [tool_use_events(f"tool_{index}", "view_file", '{"file_path": "a.txt"}') for index in range(5)]
+    usage = asyncio.run(bot.run_turn("system prompt", [{"role": "user", "content": "keep reading"}]))
+
+    # Each stubbed request uses 15 tokens, so the second one crosses the budget
+    assert usage["requests"] == 2
+    assert usage["total_tokens"] == 30
+
+def test_failed_turn_keeps_completed_tool_rounds(stub_messages, monkeypatch, tmp_path):
+    """Test that an error in a follow-up request keeps the results of edits that already ran."""
+    target = tmp_path / "notes.txt"
+    target.write_text("one\n")
+    monkeypatch.setattr(bot, "tool_executor", ThreadPoolExecutor(max_workers=2))
+    inputs = iter(["edit the notes", "what happened?", "exit"])
+    monkeypatch.setattr(bot.console, "input", lambda prompt: next(inputs))
+    arguments = json.dumps({"file_path": str(target), "search_text": "one", "replace_text": "two"})
+    stub_messages.streams = [
+        tool_use_events("tool_1", "replace_text", arguments),
+        ConnectionError("connection reset"),
+        text_events("The edit went through."),
+    ]
+    asyncio.run(bot.run_agent())
+
+    assert target.read_text() == "two\n"
+    history = stub_messages.requests[2]["messages"]
+    assert [message["role"] for message in history] == ["user", "assistant", "user", "user"]
+    assert history[1]["content"][0]["id"] == "tool_1"
+    assert history[2]["content"][0]["tool_use_id"] == "tool_1"
+    assert history[3]["content"][-1]["text"] == "what happened?"
+
+def test_trim_failed_turn_drops_unanswered_tool_use():
+    """Test that a failed turn loses only its unanswered tool_use, or everything if no round completed."""
+    first_round = [
+        {"role": "user", "content": "edit"},
+        {"role": "assistant", "content": [tool_call("replace_text", 1)]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "tool_1", "content": "{}"}]},
+    ]
+    messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": [{"type": "text", "text": "hello"}]}]
+    messages += first_round + [{"role": "assistant", "content": [tool_call("view_file", 2)]}]
+    bot.trim_failed_turn(messages, 2)
+    assert messages[2:] == first_round
+
+    messages = [{"role": "user", "content": "edit"}, {"role": "assistant", "content": [tool_call("view_file", 1)]}]
+    bot.trim_failed_turn(messages, 0)
+    assert messages == []
+
+def tool_round(index, size):
+    """Build an assistant view_file call and the user message with its result of about `size` chars."""
+    result = json.dumps({"status": "success", "content": "x" * size, "file_path": f"file_{index}.txt"})
+    return [
+        {"role": "assistant", "content": [tool_call("view_file", index, file_path=f"file_{index}.txt")]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"tool_{index}", "content": result}]},
+    ]
+
+@pytest.fixture
+def clearing(monkeypatch):
+    """Use small clearing thresholds and a fresh record of cleared results."""
+    monkeypatch.setattr(bot, "cleared_tool_results", {})
+    monkeypatch.setattr(bot, "CONTEXT_KEEP_TOOL_RESULTS", 2)
+    monkeypatch.setattr(bot, "CONTEXT_CLEAR_TRIGGER_TOKENS", 5000)
+
+def test_clearing_replaces_old_results_and_keeps_pairs(clearing):
+    """Test that results older than the pinned ones become placeholders with their tool_use_id."""
+    messages = [{"role": "user", "content": "read six files"}]
+    for index in range(6):
+        messages += tool_round(index, 8000)
+    saved = bot.clear_stale_tool_results(messages)
+
+    results = [message["content"][0] for message in messages[2::2]]
+    assert [result["tool_use_id"] for result in results] == [f"tool_{index}" for index in range(6)]
+    for result in results[:4]:
+        placeholder = json.loads(result["content"])
+        assert placeholder["status"] == "success"
+        assert "view_file result cleared" in placeholder["message"]
+    assert all(len(result["content"]) > 8000 for result in results[4:])
+    assert 4 * 1900 < saved < 4 * 2000
+
+def test_clearing_waits_for_the_trigger(clearing):
+    """Test that stale results are kept until they add up to the trigger, then cleared together."""
+    messages = [{"role": "user", "content": "read files"}]
+    for index in range(4):
+        messages += tool_round(index, 8000)
+    assert bot.clear_stale_tool_results(messages) == 0
+
+    messages += tool_round(4, 8000)
+    cleared = bot.clear_stale_tool_results(messages)
+    snapshot = copy.deepcopy(messages)
+
+    # One more stale result is below the trigger, so the cleared prefix stays the same
+    messages += tool_round(5, 8000)
+    assert bot.clear_stale_tool_results(messages) == cleared
+    assert messages[:len(snapshot)] == snapshot
+
+def test_stream_message_reports_cleared_tokens(stub_messages, clearing):
+    """Test that requests carry the placeholders and usage reports the tokens saved."""
+    messages = [{"role": "user", "content": "read files"}]
+    for index in range(5):
+        messages += tool_round(index, 8000)
+    stub_messages.streams = [text_events("done")]
+    response = asyncio.run(bot.stream_message("system prompt", messages))
+
+    sent = stub_messages.requests[0]["messages"]
+    assert len(sent[2]["content"][0]["content"]) < 300
+    usage = bot.get_token_usage(response)
+    assert usage["cleared_tokens"] > 5000
+
+    with bot.console.capture() as capture:
+        bot.display_token_usage(bot.console, usage)
+    assert f"Cleared: ~{usage['cleared_tokens']:,}" in capture.get()
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -5,13 +5,55 @@
 #   "openai-agents>=0.0.6",
 #   "rich>=13.9.4",
 #   "openai>=1.68.2",
+#   "httpx>=0.27.0",
+#   "pillow>=10.0.0",
 # ]
 # ///
 
+"""
+Image description utility for LM Studio.
+
+Run without arguments for an interactive test of text and vision requests, or pass
+a directory or manifest to caption many images headlessly:
+
+    uv run image_describe.py photos/ --output captions.jsonl
+    uv run image_describe.py --manifest images.txt --output captions.jsonl --concurrency 8
+
+Bulk mode writes one JSONL record per image as soon as it is described. Rerunning
+with the same output file skips images that already have a description, so an
+interrupted run can be resumed.
+"""
+
 from openai import OpenAI
-import base64
 import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from typing import Any, Dict, List, Optional, Set
 from dotenv import load_dotenv
+# Only the shared modules are imported, not the agent with its tools and caches
+import image_pipeline
+import lm_studio_backends
+from image_pipeline import (
+    preprocess_image,
+    build_vision_content,
+    read_file_bytes,
+    vision_cache_params,
+    image_description_cache,
+    ImageDescriptionCache,
+    is_image_file,
+    get_preprocess_pool,
+    IMAGE_CACHE_ENABLED,
+    BATCH_CONCURRENCY,
+    VISION_MODEL,
+    VISION_PROMPT,
+    VISION_MAX_TOKENS,
+    VISION_TEMPERATURE,
+    VISION_TIMEOUT
+)
 
 # LM Studio configuration
 LM_STUDIO_BASE_URL = "http://localhost:1234/v1"
@@ -36,6 +78,14 @@ def check_model_capabilities():
         print(f"Error checking model capabilities: {str(e)}")
         return False
 
+def get_loaded_model_id():
+    """Return the id of the model loaded in LM Studio, used in image cache keys"""
+    try:
+        models = client.models.list()
+        return models.data[0].id if models.data else VISION_MODEL
+    except Exception:
+        return VISION_MODEL
+
 def send_text_message(message):
     """Send a simple text message to test the LM Studio connection"""
     try:
@@ -69,32 +119,27 @@ def send_message_with_vision(messages, image_path):
         if not os.path.exists(image_path):
             return f"Error: Image file '{image_path}' not found."
             
-        # Get the file size and check if it's reasonable
-        file_size = os.path.getsize(image_path) / (1024 * 1024)  # Size in MB
-        print(f"Image file size: {file_size:.2f} MB")
-        
-        if file_size > 4:
-            return f"Error: Image file is too large ({file_size:.2f} MB). Please use an image smaller than 4MB."
-        
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-            
-        print(f"Successfully encoded image, length: {len(encoded_string)} characters")
+        # Reuse a cached description of the same image bytes, shared with the v4 agent
+        raw = read_file_bytes(image_path)
+        model_id = get_loaded_model_id()
+        cache_key = ImageDescriptionCache.make_key(raw, VISION_PROMPT, model_id, vision_cache_params())
+        if IMAGE_CACHE_ENABLED:
+            cached_description = image_description_cache.get(cache_key)
+            if cached_description is not None:
+                print("Using cached description")
+                return cached_description
+
+        # Sniff the real format, downscale to the model's resolution and re-encode
+        prepared = preprocess_image(image_path, raw)
+        if prepared["status"] != "success":
+            return f"Error: {prepared['message']}"
+
+        source_width, source_height = prepared["source_size"]
+        print(f"Image: {source_width}x{source_height}, {prepared['source_bytes'] / 1024:.0f} KB "
+              f"-> {len(prepared['images'])} part(s), {prepared['encoded_bytes'] / 1024:.0f} KB")
 
         # Construct the message with the image data
-        message = {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": "Analyze this image and tell me what you see."},
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{encoded_string}",
-                        "detail": "high"
-                    }
-                }
-            ]
-        }
+        message = {"role": "user", "content": build_vision_content(VISION_PROMPT, prepared["images"])}
 
         # Combine the new message with the existing conversation history
         all_messages = messages + [message]
@@ -103,23 +148,253 @@ def send_message_with_vision(messages, image_path):
 
         # Call the OpenAI ChatCompletion API via LM Studio
         response = client.chat.completions.create(
-            model="local-model",  # LM Studio uses the currently loaded model
+            model=VISION_MODEL,  # LM Studio uses the currently loaded model
             messages=all_messages,
-            max_tokens=500,
-            temperature=0.7
+            max_tokens=VISION_MAX_TOKENS,
+            temperature=VISION_TEMPERATURE
         )
         
         print("Received response from LM Studio")
         
-        return response.choices[0].message.content
+        description = response.choices[0].message.content
+        if IMAGE_CACHE_ENABLED and description:
+            image_description_cache.put(cache_key, description, {"path": image_path, "model": model_id, "prompt": VISION_PROMPT})
+        return description
 
     except FileNotFoundError:
         return "Error: Image file not found."
     except Exception as e:
         return f"An error occurred: {str(e)}"
 
+def list_images(directory: str) -> List[str]:
+    """Return every image file under a directory, recursively and in sorted order."""
+    images = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if is_image_file(path):
+                images.append(path)
+    return images
+
+def read_manifest(manifest_path: str) -> List[str]:
+    """Read image paths from a manifest, one per line.
+
+    Blank lines and lines starting with '#' are ignored. Relative paths are resolved
+    against the manifest's directory.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    paths = []
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                paths.append(os.path.join(base_dir, line))
+    return paths
+
+def load_completed(output_path: str) -> Set[str]:
+    """Return the paths that already have a description in a JSONL output file."""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A run that was killed mid-write can leave a partial last line
+                continue
+            if record.get("description") is not None and "error" not in record:
+                completed.add(record["path"])
+    return completed
+
+def hash_bulk_image(image_path: str, prompt: str, model_id: str) -> Dict[str, Any]:
+    """Return the content hash of an image and its key in the shared description cache."""
+    raw = read_file_bytes(image_path)
+    return {
+        "sha256": hashlib.sha256(raw).hexdigest(),
+        "cache_key": ImageDescriptionCache.make_key(raw, prompt, model_id, vision_cache_params())
+    }
+
+async def prepare_bulk_image(image_path: str, executor, prompt: str, model_id: str) -> Dict[str, Any]:
+    """Look an image up in the description cache, and preprocess it on `executor` on a miss."""
+    # Keyed like the interactive path and the v4 agent, so all three share descriptions
+    identity = await asyncio.to_thread(hash_bulk_image, image_path, prompt, model_id)
+    if IMAGE_CACHE_ENABLED:
+        description = await asyncio.to_thread(image_description_cache.get, identity["cache_key"])
+        if description is not None:
+            return dict(identity, status="cached", description=description)
+    # Worker processes re-read the file rather than receiving the bytes through a pipe
+    loop = asyncio.get_running_loop()
+    prepared = await loop.run_in_executor(executor, preprocess_image, image_path)
+    return dict(prepared, **identity)
+
+async def get_bulk_model_id() -> str:
+    """Return the id of the model loaded in LM Studio for bulk records, or VISION_MODEL if it cannot be asked"""
+    try:
+        response = await lm_studio_backends.backend_pool.pick().client.models.list()
+        return response.data[0].id if response.data else VISION_MODEL
+    except Exception:
+        return VISION_MODEL
+
+async def describe_bulk_image(path: str, prepared_future, model_id: str, prompt: str) -> Dict[str, Any]:
+    """Send one preprocessed image to LM Studio and build its JSONL record."""
+    record: Dict[str, Any] = {"path": path}
+    try:
+        prepared = await prepared_future
+        record["sha256"] = prepared.get("sha256")
+        if prepared["status"] == "cached":
+            record.update(description=prepared["description"], model=model_id, cached=True)
+            return record
+        if prepared["status"] != "success":
+            record["error"] = prepared["message"]
+            return record
+
+        message = {"role": "user", "content": build_vision_content(prompt, prepared["images"])}
+        started = time.perf_counter()
+        # Spread over every configured endpoint and retried, like the agent's own vision requests
+        response = await lm_studio_backends.request_retrier.call(
+            "Vision",
+            lm_studio_backends.backend_pool.create,
+            model=VISION_MODEL,
+            messages=[message],
+            max_tokens=VISION_MAX_TOKENS,
+            temperature=VISION_TEMPERATURE,
+            timeout=VISION_TIMEOUT
+        )
+        record["latency"] = round(time.perf_counter() - started, 3)
+        record["description"] = response.choices[0].message.content
+        record["model"] = model_id
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            record["tokens"] = {"prompt": usage.prompt_tokens, "completion": usage.completion_tokens}
+        if IMAGE_CACHE_ENABLED and record["description"]:
+            metadata = {"path": path, "model": model_id, "prompt": prompt}
+            await asyncio.to_thread(image_description_cache.put, prepared["cache_key"], record["description"], metadata)
+    except Exception as e:
+        record["error"] = str(e)
+    return record
+
+async def describe_bulk(
+    image_paths: List[str],
+    output_path: str,
+    concurrency: int = BATCH_CONCURRENCY,
+    prompt: str = VISION_PROMPT,
+    executor=None
+) -> Dict[str, Any]:
+    """Describe many images and append one JSONL record per image to output_path.
+
+    Reading and preprocessing run on a process pool (or `executor`) while up to
+    `concurrency` requests are in flight; at most `concurrency` images are prepared
+    ahead of the requests, so memory use stays flat however many images there are.
+    Images already described in output_path are skipped, and images in the shared
+    description cache are written without a request. Returns aggregate stats.
+    """
+    completed = load_completed(output_path)
+    pending = [path for path in image_paths if path not in completed]
+    executor = executor or get_preprocess_pool()
+    model_id = await get_bulk_model_id()
+    loop = asyncio.get_running_loop()
+    prepared_queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    stats = {"total": len(image_paths), "skipped": len(image_paths) - len(pending), "described": 0,
+             "cached": 0, "failed": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency": 0.0}
+
+    print(f"{len(pending)} images to describe ({stats['skipped']} already done), "
+          f"{concurrency} requests at a time")
+
+    async def prepare_stage():
+        # Submitting in order keeps the preprocessing pool busy ahead of the requests
+        for path in pending:
+            await prepared_queue.put((path, loop.create_task(prepare_bulk_image(path, executor, prompt, model_id))))
+        for _ in range(concurrency):
+            await prepared_queue.put(None)
+
+    started = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output:
+        async def request_worker():
+            while True:
+                item = await prepared_queue.get()
+                if item is None:
+                    return
+                path, prepared_future = item
+                record = await describe_bulk_image(path, prepared_future, model_id, prompt)
+                # Each record is flushed right away; it doubles as the resume checkpoint
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+
+                done = stats["described"] + stats["failed"] + 1
+                if "error" in record:
+                    stats["failed"] += 1
+                    print(f"[{done}/{len(pending)}] {path}: {record['error']}")
+                elif record.get("cached"):
+                    stats["described"] += 1
+                    stats["cached"] += 1
+                    print(f"[{done}/{len(pending)}] {path} (cached)")
+                else:
+                    stats["described"] += 1
+                    stats["latency"] += record["latency"]
+                    stats["prompt_tokens"] += record.get("tokens", {}).get("prompt", 0)
+                    stats["completion_tokens"] += record.get("tokens", {}).get("completion", 0)
+                    print(f"[{done}/{len(pending)}] {path} ({record['latency']:.1f}s)")
+
+        await asyncio.gather(prepare_stage(), *(request_worker() for _ in range(concurrency)))
+
+    elapsed = time.perf_counter() - started
+    stats["elapsed"] = elapsed
+    stats["images_per_minute"] = stats["described"] / elapsed * 60 if elapsed > 0 else 0.0
+    return stats
+
+def print_bulk_stats(stats: Dict[str, Any]) -> None:
+    """Print the aggregate results of a bulk run."""
+    requested = stats["described"] - stats["cached"]
+    average_latency = stats["latency"] / requested if requested else 0.0
+    print(f"\nDescribed {stats['described']} images ({stats['cached']} from the description cache), "
+          f"{stats['failed']} failed, {stats['skipped']} skipped (already done)")
+    print(f"Elapsed: {stats['elapsed']:.1f}s, throughput: {stats['images_per_minute']:.1f} images/min, "
+          f"average request latency: {average_latency:.2f}s")
+    print(f"Tokens: {stats['prompt_tokens']} prompt, {stats['completion_tokens']} completion")
+
+async def run_bulk(args) -> int:
+    """Collect the images named on the command line and describe them."""
+    image_paths = []
+    for source in args.sources:
+        if os.path.isdir(source):
+            image_paths.extend(list_images(source))
+        else:
+            image_paths.append(source)
+    if args.manifest:
+        image_paths.extend(read_manifest(args.manifest))
+    if not image_paths:
+        print("No images found.")
+        return 1
+
+    lm_studio_backends.backend_pool.start()
+    try:
+        stats = await describe_bulk(image_paths, args.output, args.concurrency, args.prompt)
+    finally:
+        await lm_studio_backends.backend_pool.stop()
+        # Every endpoint's client shares this connection pool
+        await lm_studio_backends.http_client.aclose()
+        image_pipeline.shutdown_preprocess_pool()
+    print_bulk_stats(stats)
+    return 0 if stats["failed"] == 0 else 1
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Parse the command line; with no sources or manifest the script runs interactively."""
+    parser = argparse.ArgumentParser(description="Describe images with the vision model loaded in LM Studio.")
+    parser.add_argument("sources", nargs="*", help="Image files or directories to describe (runs headless)")
+    parser.add_argument("--manifest", help="File listing image paths, one per line")
+    parser.add_argument("--output", default="descriptions.jsonl", help="JSONL file to write (and resume from)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Vision requests in flight at once")
+    parser.add_argument("--prompt", default=VISION_PROMPT, help="Prompt sent with each image")
+    return parser.parse_args(argv)
+
 # Example usage
 if __name__ == "__main__":
+    cli_args = parse_args()
+    if cli_args.sources or cli_args.manifest:
+        sys.exit(asyncio.run(run_bulk(cli_args)))
+
     print("Testing LM Studio connection...")
     
     # Check if LM Studio is running and what models are available
@@ -147,6 +422,7 @@ if __name__ == "__main__":
         # Print the response
         print("\nAgent Response:" + "-" * 29)
         print(response)
+        print(f"\nImage cache: {image_description_cache.hits} hits, {image_description_cache.misses} misses")
     else:
         print("Vision test skipped.")
         
@@ -0,0 +1,280 @@
+"""
+Image preprocessing and description cache shared by the LM Studio vision agent and
+image_describe.py.
+
+This module only depends on Pillow and rich, so the worker processes that preprocess
+images import it without starting any of the agent's clients, pools or caches.
+"""
+
+import io
+import os
+import json
+import time
+import base64
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+from PIL import Image, ImageOps
+from rich.console import Console
+
+console = Console()
+
+WARNING_STYLE = "yellow"
+
+# Vision request parameters
+VISION_MODEL = "local-model"  # LM Studio uses the currently loaded model
+VISION_PROMPT = "Analyze this image and tell me what you see."
+VISION_MAX_TOKENS = 600
+VISION_TEMPERATURE = 0.7
+VISION_TIMEOUT = 120
+
+# Image preprocessing parameters
+IMAGE_MAX_SIDE = 1024                # Longest side sent to the vision model, close to its native resolution
+IMAGE_MAX_PIXELS = 100_000_000       # Pixel budget for input images; larger images are refused
+IMAGE_JPEG_QUALITY = 85
+IMAGE_PASSTHROUGH_BYTES = 256 * 1024  # Small JPEG/PNG files within IMAGE_MAX_SIDE are sent unchanged
+IMAGE_TILING_ENABLED = False          # Also send detail tiles for very large images
+IMAGE_TILE_THRESHOLD = 3              # Tile when the long side exceeds this many times IMAGE_MAX_SIDE
+IMAGE_TILE_GRID = 2                   # Tiles per side (2 -> 2x2 tiles plus an overview)
+
+# Image description cache (shared by the agent and image_describe.py)
+IMAGE_CACHE_ENABLED = True
+IMAGE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "lm_studio_agents", "image_descriptions")
+IMAGE_CACHE_MAX_BYTES = 16 * 1024 * 1024  # Least recently used entries are evicted beyond this size
+
+# Batch image description
+BATCH_CONCURRENCY = 4              # Vision requests in flight at once
+BATCH_PREPROCESS_WORKERS = None    # Processes used for preprocessing; None uses the CPU count
+
+# Magic bytes of the image formats the vision pipeline accepts
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """Return the MIME type of an image from its leading magic bytes."""
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def encode_image(image: Image.Image) -> bytes:
+    """Encode an image as JPEG, flattening any transparency onto white."""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+def preprocess_image(image_path: str, raw: Optional[bytes] = None) -> Dict[str, Any]:
+    """Prepare an image for a vision request.
+
+    The format is taken from the file's magic bytes rather than its extension. Images
+    are limited by IMAGE_MAX_PIXELS instead of file size, downscaled so the long side
+    is at most IMAGE_MAX_SIDE and re-encoded as JPEG. Small JPEG/PNG files that already
+    fit are sent unchanged. With IMAGE_TILING_ENABLED, very large images also yield
+    IMAGE_TILE_GRID x IMAGE_TILE_GRID detail tiles after the overview.
+
+    Returns {"status": "success", "images": [{"mime_type", "data", "width", "height"}], ...}
+    with base64 data, or {"status": "error", "message": ...}. Pass `raw` to reuse file
+    bytes that were already read.
+    """
+    try:
+        if raw is None:
+            with open(image_path, "rb") as image_file:
+                raw = image_file.read()
+        mime_type = sniff_image_type(raw[:16])
+        if mime_type is None:
+            return {"status": "error", "message": f"Unsupported or unrecognized image format: {image_path}"}
+
+        with Image.open(io.BytesIO(raw)) as image:
+            width, height = image.size
+            if width * height > IMAGE_MAX_PIXELS:
+                return {
+                    "status": "error",
+                    "message": f"Image is too large ({width}x{height} = {width * height:,} pixels). "
+                               f"The limit is {IMAGE_MAX_PIXELS:,} pixels."
+                }
+
+            long_side = max(width, height)
+            if (long_side <= IMAGE_MAX_SIDE and mime_type in ("image/jpeg", "image/png")
+                    and len(raw) <= IMAGE_PASSTHROUGH_BYTES):
+                parts = [(mime_type, raw, width, height)]
+            else:
+                # Let the JPEG decoder downscale while decoding, which is far cheaper than a full decode
+                image.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+                image = ImageOps.exif_transpose(image)
+                full_size = image.copy()
+                overview = image.copy()
+                overview.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+                parts = [("image/jpeg", encode_image(overview), overview.width, overview.height)]
+
+                if IMAGE_TILING_ENABLED and long_side > IMAGE_MAX_SIDE * IMAGE_TILE_THRESHOLD:
+                    # Tiles come from the full-resolution decode so they carry real detail
+                    if full_size.size != (width, height):
+                        with Image.open(io.BytesIO(raw)) as original:
+                            full_size = ImageOps.exif_transpose(original)
+                            full_size.load()
+                    tile_width = full_size.width // IMAGE_TILE_GRID
+                    tile_height = full_size.height // IMAGE_TILE_GRID
+                    for row in range(IMAGE_TILE_GRID):
+                        for column in range(IMAGE_TILE_GRID):
+                            box = (column * tile_width, row * tile_height,
+                                   (column + 1) * tile_width, (row + 1) * tile_height)
+                            tile = full_size.crop(box)
+                            tile.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+                            parts.append(("image/jpeg", encode_image(tile), tile.width, tile.height))
+
+        images = [
+            {"mime_type": part_mime, "data": base64.b64encode(data).decode("utf-8"), "width": part_width, "height": part_height}
+            for part_mime, data, part_width, part_height in parts
+        ]
+        return {
+            "status": "success",
+            "images": images,
+            "source_mime_type": mime_type,
+            "source_size": (width, height),
+            "source_bytes": len(raw),
+            "encoded_bytes": sum(len(part[1]) for part in parts)
+        }
+    except Exception as e:
+        return {"status": "error", "message": f"Error preparing image: {str(e)}"}
+
+class ImageDescriptionCache:
+    """On-disk, content-addressed cache of image descriptions.
+
+    Entries are keyed on a hash of the image bytes together with everything else that
+    shapes the description (prompt, model id, sampling and preprocessing settings),
+    stored as one JSON file each, and evicted least recently used first once the
+    directory grows past its size limit. Hits refresh the entry's mtime, which is
+    what the LRU order is based on, so the cache works across restarts and across
+    the agent and image_describe.py.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(image_bytes: bytes, prompt: str, model_id: str, params: Dict[str, Any]) -> str:
+        """Return the cache key for an image and the request that describes it."""
+        digest = hashlib.sha256(image_bytes)
+        digest.update(json.dumps({"prompt": prompt, "model": model_id, "params": params}, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached description for a key, or None."""
+        path = self.entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["description"]
+
+    def put(self, key: str, description: str, metadata: Dict[str, Any]) -> None:
+        """Store a description, then evict old entries if the cache is over its limit."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            entry = dict(metadata, description=description, created=time.time())
+            temp_path = self.entry_path(key) + f".{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(temp_path, self.entry_path(key))
+            self.evict()
+        except OSError as e:
+            console.print(f"[{WARNING_STYLE}]Could not write image description cache: {str(e)}[/{WARNING_STYLE}]")
+
+    def evict(self) -> None:
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(".json"):
+                    info = entry.stat()
+                    entries.append((info.st_mtime, info.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+image_description_cache = ImageDescriptionCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+# Worker processes for batch image preprocessing, started on first use
+preprocess_pool = None
+
+def get_preprocess_pool() -> ProcessPoolExecutor:
+    """Return the process pool used to preprocess batches of images."""
+    global preprocess_pool
+    if preprocess_pool is None:
+        # Spawned workers behave the same on every platform and do not inherit the event loop
+        preprocess_pool = ProcessPoolExecutor(
+            max_workers=BATCH_PREPROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return preprocess_pool
+
+def shutdown_preprocess_pool() -> None:
+    """Stop the preprocessing workers, if they were started."""
+    global preprocess_pool
+    if preprocess_pool is not None:
+        preprocess_pool.shutdown(cancel_futures=True)
+        preprocess_pool = None
+
+def vision_cache_params() -> Dict[str, Any]:
+    """Return the settings besides prompt and model that change an image's description."""
+    return {
+        "max_tokens": VISION_MAX_TOKENS,
+        "temperature": VISION_TEMPERATURE,
+        "max_side": IMAGE_MAX_SIDE,
+        "jpeg_quality": IMAGE_JPEG_QUALITY,
+        "tiles": IMAGE_TILE_GRID if IMAGE_TILING_ENABLED else 0
+    }
+
+def read_file_bytes(path: str) -> bytes:
+    """Read a whole file as bytes."""
+    with open(path, "rb") as f:
+        return f.read()
+
+def build_vision_content(prompt: str, images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Build the content list of a vision request from a prompt and preprocessed images."""
+    content = [{"type": "text", "text": prompt}]
+    for image in images:
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": f"data:{image['mime_type']};base64,{image['data']}"}
+        })
+    return content
+
+def is_image_file(path: str) -> bool:
+    """Return True if a file starts with the magic bytes of a supported image format."""
+    try:
+        with open(path, "rb") as f:
+            return sniff_image_type(f.read(16)) is not None
+    except OSError:
+        return False
@@ -26,6 +26,8 @@ Note: This script requires LM Studio to be running on http://localhost:1234/v1
 import os
 import sys
 import json
+import codecs
+import signal
 import subprocess
 from typing import AsyncGenerator, Dict, Any
 from rich.console import Console
@@ -89,6 +91,12 @@ THINKING_PHRASES = [
     "Executing..."
 ]
 
+# Command execution parameters
+COMMAND_TIMEOUT = 300       # Wall-clock limit in seconds for a single command
+COMMAND_IDLE_TIMEOUT = 60   # Stop a command that produces no output for this many seconds
+COMMAND_STDOUT_STYLE = "dim"
+COMMAND_STDERR_STYLE = "yellow"
+
 # Tool definitions following OpenAI API format
 TOOLS = [
     {
@@ -346,25 +354,111 @@ def insert_line(file_path: str, line_number: int, content: str) -> Dict[str, Any
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-def execute_command(command: str) -> Dict[str, Any]:
-    """Execute a bash command."""
+def kill_process_tree(process) -> None:
+    """Kill a command's shell and every process it started."""
+    if process.returncode is not None:
+        return
     try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            encoding='utf-8'
-        )
+        if os.name == "nt":
+            # taskkill /T walks the child process tree on Windows
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+        else:
+            # The shell was started in its own session, so its pid is also the process group id
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, OSError):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+async def execute_command(command: str) -> Dict[str, Any]:
+    """Execute a bash command, streaming its output to the console as lines arrive."""
+    try:
+        if os.name == "nt":
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
+            )
+        else:
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        last_output_time = start_time
+        output = {"stdout": [], "stderr": []}
+
+        async def pump(stream, stream_name):
+            nonlocal last_output_time
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            style = COMMAND_STDOUT_STYLE if stream_name == "stdout" else COMMAND_STDERR_STYLE
+            partial_line = ""
+            while True:
+                data = await stream.read(4096)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    last_output_time = loop.time()
+                    output[stream_name].append(text)
+                    # Echo complete lines to the console as they arrive
+                    *lines, partial_line = (partial_line + text).split("\n")
+                    for line in lines:
+                        console.print(line, style=style, markup=False, highlight=False)
+                if not data:
+                    if partial_line:
+                        console.print(partial_line, style=style, markup=False, highlight=False)
+                    break
 
-        message = f"Command executed successfully: '{command}'" if result.returncode == 0 else f"Command failed with return code {result.returncode}: '{command}'"
+        io_task = asyncio.ensure_future(asyncio.gather(
+            pump(process.stdout, "stdout"),
+            pump(process.stderr, "stderr"),
+            process.wait()
+        ))
+
+        timeout_message = None
+        try:
+            while not io_task.done():
+                await asyncio.wait({io_task}, timeout=0.5)
+                now = loop.time()
+                if io_task.done():
+                    break
+                if now - start_time > COMMAND_TIMEOUT:
+                    timeout_message = f"Command timed out after {COMMAND_TIMEOUT}s: '{command}'"
+                elif now - last_output_time > COMMAND_IDLE_TIMEOUT:
+                    timeout_message = f"Command produced no output for {COMMAND_IDLE_TIMEOUT}s and was stopped: '{command}'"
+                if timeout_message:
+                    kill_process_tree(process)
+                    # Give the pipes a moment to drain, then stop reading regardless
+                    await asyncio.wait({io_task}, timeout=2)
+                    io_task.cancel()
+                    await asyncio.gather(io_task, return_exceptions=True)
+                    break
+        except asyncio.CancelledError:
+            kill_process_tree(process)
+            io_task.cancel()
+            # Retrieve the outcome so the abandoned readers do not log a warning
+            io_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            raise
+
+        returncode = process.returncode if process.returncode is not None else -1
+        if timeout_message:
+            message = timeout_message
+        elif returncode == 0:
+            message = f"Command executed successfully: '{command}'"
+        else:
+            message = f"Command failed with return code {returncode}: '{command}'"
 
         return {
-            "status": "success" if result.returncode == 0 else "error",
+            "status": "success" if returncode == 0 and not timeout_message else "error",
             "message": message,
-            "stdout": result.stdout,
-            "stderr": result.stderr,
-            "returncode": result.returncode
+            "stdout": "".join(output["stdout"]),
+            "stderr": "".join(output["stderr"]),
+            "returncode": returncode
         }
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -402,19 +496,6 @@ TOOL_MAP = {
     "view_file": view_file
 }
 
-def execute_tool_call(tool_call) -> str:
-    """Execute a tool call and return the result as a string."""
-    try:
-        tool_name = tool_call["function"]["name"]
-        if tool_name not in TOOL_MAP:
-            return json.dumps({"status": "error", "message": f"Unknown tool: {tool_name}"})
-        
-        args = json.loads(tool_call["function"]["arguments"])
-        result = TOOL_MAP[tool_name](**args)
-        return json.dumps(result)
-    except Exception as e:
-        return json.dumps({"status": "error", "message": f"Error executing tool: {str(e)}"})
-
 def create_lm_agent() -> Agent:
     """Creates an LM Studio agent using the default model from LM Studio."""
     # Define instructions for the AI model
@@ -544,6 +625,8 @@ async def run_lm_agent(prompt: str, agent: Agent, model_name: str) -> AsyncGener
                     try:
                         args = json.loads(tool_call["function"]["arguments"])
                         result = TOOL_MAP[tool_call["function"]["name"]](**args)
+                        if asyncio.iscoroutine(result):
+                            result = await result
                         
                         tool_response = {
                             "role": "tool",
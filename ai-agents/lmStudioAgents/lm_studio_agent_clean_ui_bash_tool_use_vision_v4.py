@@ -5,6 +5,9 @@
 #   "openai-agents>=0.0.6",
 #   "rich>=13.9.4",
 #   "openai>=1.68.2",
+#   "httpx>=0.27.0",
+#   "pillow>=10.0.0",
+#   "watchdog>=4.0.0",
 # ]
 # ///
 
@@ -26,18 +29,70 @@ Note: This script requires LM Studio to be running on http://localhost:1234/v1
 import os
 import sys
 import json
+import codecs
+import signal
 import subprocess
-import base64
-from typing import AsyncGenerator, Dict, Any
+import atexit
+import shutil
+import tempfile
+import hashlib
+import difflib
+import mmap
+import array
+import bisect
+import sqlite3
+import threading
+import functools
+import itertools
+import collections
+import contextlib
+import glob
+import re
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Dict, Any, List, Optional
 from rich.console import Console
 from rich.panel import Panel
 from rich.text import Text
+import io
 import asyncio
-from openai import AsyncOpenAI, RateLimitError
+from openai import RateLimitError
+from openai.types.chat import ChatCompletionChunk
 from agents import Agent
 import time
 import random
 from rich.live import Live
+try:
+    # Optional: with watchdog the file index follows file system events instead of polling
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+# LM Studio endpoints and the image pipeline are shared with image_describe.py
+from lm_studio_backends import (
+    LM_STUDIO_BASE_URLS,
+    http_client,
+    backend_pool,
+    request_retrier,
+    CircuitOpenError
+)
+import image_pipeline
+from image_pipeline import (
+    preprocess_image,
+    build_vision_content,
+    read_file_bytes,
+    vision_cache_params,
+    image_description_cache,
+    ImageDescriptionCache,
+    is_image_file,
+    get_preprocess_pool,
+    IMAGE_CACHE_ENABLED,
+    BATCH_CONCURRENCY,
+    VISION_MODEL,
+    VISION_PROMPT,
+    VISION_MAX_TOKENS,
+    VISION_TEMPERATURE,
+    VISION_TIMEOUT
+)
 
 # Initialize console for rich output
 console = Console()
@@ -45,15 +100,8 @@ console = Console()
 # Initialize conversation history
 conversation_history = []
 
-# LM Studio configuration
-LM_STUDIO_BASE_URL = "http://localhost:1234/v1"
-LM_STUDIO_API_KEY = "dummy-key"
-
-# Create AsyncOpenAI client configured for LM Studio
-openai_client = AsyncOpenAI(
-    base_url=LM_STUDIO_BASE_URL,
-    api_key=LM_STUDIO_API_KEY
-)
+# Id of the model loaded in LM Studio, set at startup (or looked up on first use)
+active_model_id = None
 
 # Define color styles that work well in Windows terminals
 USER_STYLE = "bold magenta"  
@@ -79,6 +127,61 @@ API_PRESENCE_PENALTY = 0.5   # Number between -2.0 and 2.0
 API_N = 1  # Must be exactly 1 as per OpenAI API requirements
 API_PARALLEL_TOOL_CALLS = True
 API_TOOL_CHOICE = "auto"  # Can be "auto", "required", or "none"
+API_STREAM_OPTIONS = {"include_usage": True}  # Ask for a final usage chunk on streamed responses
+
+# Response cache for repeated chat requests (opt-in, useful for regression scripts and demos)
+RESPONSE_CACHE_ENABLED = False
+RESPONSE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "lm_studio_agents", "responses.sqlite3")
+RESPONSE_CACHE_TTL = 7 * 24 * 3600             # Seconds a cached response stays valid
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024    # Least recently used responses are evicted beyond this size
+RESPONSE_CACHE_KEY_PARAMS = (                  # Request parameters that change the response
+    "model", "messages", "tools", "tool_choice", "temperature", "top_p", "max_tokens",
+    "frequency_penalty", "presence_penalty", "n", "parallel_tool_calls", "stream_options"
+)
+
+# Batch image description (describe_images)
+BATCH_MAX_IMAGES = 64              # Images described per describe_images call; the rest are reported as skipped
+BATCH_DESCRIPTION_CHARS = 1000     # Longest description per image in the aggregated tool result
+
+# Conversation history budget
+HISTORY_CONTEXT_LENGTH_DEFAULT = 8192  # Used when LM Studio does not report the loaded context length
+HISTORY_MAX_TOKENS = None              # Fixed history budget; None derives it from the context length
+HISTORY_SAFETY_MARGIN = 512            # Tokens kept free to absorb estimation error
+HISTORY_CHARS_PER_TOKEN = 4.0          # Initial estimate, recalibrated from reported usage
+HISTORY_MESSAGE_OVERHEAD = 4           # Chat template tokens added per message
+HISTORY_COMPACTION_TARGET = 0.5        # Fraction of the budget the history shrinks to when it overflows
+
+# Background summarization of old turns
+SUMMARY_ENABLED = True
+SUMMARY_TRIGGER = 0.8          # Summarize once the history uses this fraction of its budget
+SUMMARY_IDLE_DELAY = 2.0       # Seconds the user must be idle before the summarizer starts
+SUMMARY_MAX_TOKENS = 512
+SUMMARY_MESSAGE_CHARS = 2000   # Longest excerpt of a single message fed to the summarizer
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_ACKNOWLEDGEMENT = "Understood. I will keep this summary in mind."
+
+# Tool execution parameters
+TOOL_MAX_WORKERS = 8  # Upper bound on tool calls running at the same time
+TOOL_PATH_ARGUMENTS = ("file_path", "image_path")  # Arguments used for per-path serialization
+EXCLUSIVE_TOOLS = {"execute_command"}  # Tools that run alone, after every earlier call has finished
+SPECULATIVE_TOOLS = {"view_file", "describe_image", "read_command_output"}  # Read-only tools started before the stream ends
+READ_ONLY_TOOLS = SPECULATIVE_TOOLS | {"describe_images"}  # Batches are read-only but too costly to start and discard
+
+# File content cache parameters
+FILE_CACHE_MAX_CHARS = 32 * 1024 * 1024  # Characters of decoded file contents kept for this session, least recently used evicted
+FILE_VIEW_DEDUP = True                   # view_file of an unchanged file refers back to the earlier result
+
+# Workspace file index parameters
+FILE_INDEX_ENABLED = True
+FILE_INDEX_MAX_FILES = 500_000    # Files indexed at most; the rest of the tree is left to the directory scan
+FILE_INDEX_WATCH = True           # Follow file system events with watchdog when it is installed
+FILE_INDEX_POLL_INTERVAL = 2.0    # Seconds between checks of directory mtimes for added or removed files, without watchdog
+FILE_INDEX_MIN_SCORE = 0.5        # Weakest fuzzy match find_file reports
+FILE_INDEX_MAX_SUGGESTIONS = 10
+FILE_INDEX_IGNORED_DIRS = {".git", ".hg", ".svn", "__pycache__", "node_modules", ".venv", ".mypy_cache", ".pytest_cache"}
+
+# Shared pool for running blocking tool implementations off the event loop
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
 
 # Interface messages
 WELCOME_MESSAGE = "Master, would you like to code? You will be pleased."
@@ -97,6 +200,24 @@ THINKING_PHRASES = [
     "Executing..."
 ]
 
+# Command execution parameters
+COMMAND_TIMEOUT = 300       # Wall-clock limit in seconds for a single command
+COMMAND_IDLE_TIMEOUT = 60   # Stop a command that produces no output for this many seconds
+COMMAND_STDOUT_STYLE = "dim"
+COMMAND_STDERR_STYLE = "yellow"
+COMMAND_OUTPUT_HEAD_BYTES = 8 * 1024   # Bytes kept from the start of each output stream
+COMMAND_OUTPUT_TAIL_BYTES = 8 * 1024   # Bytes kept from the end of each output stream
+COMMAND_OUTPUT_PAGE_BYTES = 16 * 1024  # Largest page read_command_output returns at once
+
+# File viewing parameters
+VIEW_FILE_MAX_BYTES = 64 * 1024         # Larger results are cut at a line boundary with a hint on how to page
+VIEW_FILE_INDEX_BLOCK = 64 * 1024       # Bytes per block of the sparse newline index used for ranged views
+VIEW_FILE_INDEX_CACHE_ENTRIES = 16      # Files whose newline index is kept between calls
+
+# Edit result parameters
+EDIT_DIFF_CONTEXT_LINES = 3      # Unchanged lines shown around each change in edit diffs
+EDIT_DIFF_MAX_CHARS = 16 * 1024  # Longer diffs are cut; view_file shows the rest
+
 # Tool definitions following OpenAI API format
 TOOLS = [
     {
@@ -124,7 +245,7 @@ TOOLS = [
         "type": "function",
         "function": {
             "name": "replace_text",
-            "description": "Replace text in a file",
+            "description": "Replace text in a file. Returns a unified diff of the change",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -139,6 +260,10 @@ TOOLS = [
                     "replace_text": {
                         "type": "string",
                         "description": "Text to replace with"
+                    },
+                    "return_content": {
+                        "type": "boolean",
+                        "description": "Also return the full updated file (default false; a diff is always returned)"
                     }
                 },
                 "required": ["file_path", "search_text", "replace_text"]
@@ -149,7 +274,7 @@ TOOLS = [
         "type": "function",
         "function": {
             "name": "insert_line",
-            "description": "Insert a line at a specific position in a file",
+            "description": "Insert a line at a specific position in a file. Returns a unified diff of the change",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -164,12 +289,53 @@ TOOLS = [
                     "content": {
                         "type": "string",
                         "description": "Content to insert"
+                    },
+                    "return_content": {
+                        "type": "boolean",
+                        "description": "Also return the full updated file (default false; a diff is always returned)"
                     }
                 },
                 "required": ["file_path", "line_number", "content"]
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "apply_edits",
+            "description": "Apply several edits to one file at once. Every edit is checked against the current file "
+                           "first; if any fails nothing is written. Prefer this over repeated replace_text/insert_line calls. "
+                           "Returns one unified diff",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "file_path": {
+                        "type": "string",
+                        "description": "Path to the file"
+                    },
+                    "edits": {
+                        "type": "array",
+                        "description": "Edits to apply. Each is either {search_text, replace_text} (replaces every "
+                                       "occurrence) or {line_number, content} (inserts before that line of the original file)",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "search_text": {"type": "string"},
+                                "replace_text": {"type": "string"},
+                                "line_number": {"type": "integer"},
+                                "content": {"type": "string"}
+                            }
+                        }
+                    },
+                    "return_content": {
+                        "type": "boolean",
+                        "description": "Also return the full updated file (default false; a diff is always returned)"
+                    }
+                },
+                "required": ["file_path", "edits"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -187,17 +353,51 @@ TOOLS = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "read_command_output",
+            "description": "Read part of a command's full output when execute_command returned a truncated result with an output handle",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "handle": {
+                        "type": "string",
+                        "description": "Output handle from the execute_command result"
+                    },
+                    "offset": {
+                        "type": "integer",
+                        "description": "Byte offset to start reading from (default 0)"
+                    },
+                    "length": {
+                        "type": "integer",
+                        "description": f"Number of bytes to read (at most {COMMAND_OUTPUT_PAGE_BYTES})"
+                    }
+                },
+                "required": ["handle"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
             "name": "view_file",
-            "description": "View the contents of a file",
+            "description": "View the contents of a file. Pass start_line/end_line to view part of a large file; "
+                           "ranged and oversized results come back with line numbers and a hint on how to page",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "file_path": {
                         "type": "string",
                         "description": "Path to the file to view"
+                    },
+                    "start_line": {
+                        "type": "integer",
+                        "description": "First line to view (1-based, optional)"
+                    },
+                    "end_line": {
+                        "type": "integer",
+                        "description": "Last line to view, inclusive (optional)"
                     }
                 },
                 "required": ["file_path"]
@@ -220,9 +420,566 @@ TOOLS = [
                 "required": ["image_path"]
             }
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "describe_images",
+            "description": "Describe several images in one call. Accepts image files, directories and glob patterns (e.g. 'photos/*.png') and returns one combined result",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "paths": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "Image files, directories or glob patterns to describe"
+                    }
+                },
+                "required": ["paths"]
+            }
+        }
     }
 ]
 
+class FileContentCache:
+    """Session cache of decoded file contents, validated by (realpath, mtime_ns, size).
+
+    Reads through the cache return the stored text as long as the file's mtime and
+    size are unchanged, and writes made by the edit tools refresh the entry, so a
+    replace_text after a view_file does not decode the file again. The cache also
+    remembers which tool call last returned each file's content, so an unchanged
+    file that is still visible in the conversation is not sent a second time.
+    """
+
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self.entries = collections.OrderedDict()  # realpath -> (mtime_ns, size, text, digest, lossy)
+        self.total_chars = 0
+        self.views: Dict[str, Any] = {}  # realpath -> (digest, tool_call_id) of the last full view
+        self.stubs: Dict[str, str] = {}  # tool_call_id of an "unchanged" result -> tool_call_id it refers to
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.lock = threading.Lock()
+
+    def store(self, real_path: str, info: os.stat_result, text: str, lossy: bool = False) -> Dict[str, Any]:
+        """Cache the decoded text of a file as of `info`, evicting the least recently used entries.
+
+        The limit counts characters of decoded text, which is what the cache holds.
+        """
+        digest = hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+        entry = (info.st_mtime_ns, info.st_size, text, digest, lossy)
+        with self.lock:
+            previous = self.entries.pop(real_path, None)
+            if previous is not None:
+                self.total_chars -= len(previous[2])
+            if len(text) <= self.max_chars:
+                self.entries[real_path] = entry
+                self.total_chars += len(text)
+            while self.total_chars > self.max_chars and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_chars -= len(evicted[2])
+        return {"file_path": real_path, "text": text, "sha256": digest}
+
+    def read(self, file_path: str, errors: str = "strict") -> Dict[str, Any]:
+        """Return the decoded text, real path and content hash of a file.
+
+        With errors="strict" a file that is not valid UTF-8 raises UnicodeDecodeError,
+        as open() would; with errors="replace" invalid bytes are substituted.
+        """
+        real_path = os.path.realpath(file_path)
+        info = os.stat(real_path)
+        with self.lock:
+            entry = self.entries.get(real_path)
+            if entry is not None and entry[:2] == (info.st_mtime_ns, info.st_size) and not (entry[4] and errors == "strict"):
+                self.entries.move_to_end(real_path)
+                self.hits += 1
+                return {"file_path": real_path, "text": entry[2], "sha256": entry[3]}
+            self.misses += 1
+
+        lossy = False
+        try:
+            with open(real_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except UnicodeDecodeError:
+            if errors == "strict":
+                raise
+            with open(real_path, 'r', encoding='utf-8', errors=errors) as f:
+                text = f.read()
+            lossy = True
+        return self.store(real_path, info, text, lossy)
+
+    def write(self, file_path: str, text: str, atomic: bool = False) -> Dict[str, Any]:
+        """Write text to a file and keep the cache entry in step with it.
+
+        With atomic=True the text goes to a temporary file in the same directory that
+        then replaces the original, so the file is never seen half-written.
+        """
+        real_path = os.path.realpath(file_path)
+        if not atomic:
+            with open(file_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            return self.store(real_path, os.stat(real_path), text)
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(real_path), prefix=f".{os.path.basename(real_path)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+            shutil.copymode(real_path, temp_path)
+            os.replace(temp_path, real_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
+        return self.store(real_path, os.stat(real_path), text)
+
+    def dedupe_view(self, tool_call_id: str, result: Dict[str, Any], history: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Replace a view_file result with a reference if the same content is still in the history."""
+        if not FILE_VIEW_DEDUP or result.get("status") != "success" or "sha256" not in result:
+            return result
+        real_path, digest = result["file_path"], result["sha256"]
+        previous = self.views.get(real_path)
+        if previous is not None and previous[0] == digest and any(
+            message.get("role") == "tool" and message.get("tool_call_id") == previous[1] for message in history
+        ):
+            self.deduplicated += 1
+            self.stubs[tool_call_id] = previous[1]
+            return self.unchanged_result(real_path, digest, previous[1])
+        self.views[real_path] = (digest, tool_call_id)
+        return result
+
+    @staticmethod
+    def unchanged_result(real_path: str, digest: str, tool_call_id: str) -> Dict[str, Any]:
+        """Build the result that refers back to the tool call holding a file's content."""
+        return {
+            "status": "unchanged",
+            "file_path": real_path,
+            "sha256": digest,
+            "message": f"File unchanged since tool call {tool_call_id}; its content is in that result."
+        }
+
+    def expand_views(self, kept: List[Dict[str, Any]], dropped: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Return the kept history with references to dropped view_file results expanded.
+
+        When compaction or summarization drops the result an "unchanged" reference points
+        to, the first kept reference gets the dropped content back and later references
+        point to it instead. Expanded messages are new dicts, so cached token counts of
+        the old ones are not reused.
+        """
+        dropped_results = {
+            message["tool_call_id"]: message for message in dropped
+            if message.get("role") == "tool" and "tool_call_id" in message
+        }
+        if not dropped_results:
+            return kept
+
+        holders = {}  # dropped tool_call_id -> kept tool_call_id that now holds its content
+        expanded = []
+        for message in kept:
+            tool_call_id = message.get("tool_call_id")
+            referenced = self.stubs.get(tool_call_id) if message.get("role") == "tool" else None
+            if referenced in dropped_results:
+                if referenced not in holders:
+                    message = dict(message, content=dropped_results[referenced]["content"])
+                    holders[referenced] = tool_call_id
+                    del self.stubs[tool_call_id]
+                else:
+                    stub = json.loads(message["content"])
+                    message = dict(message, content=json.dumps(
+                        self.unchanged_result(stub["file_path"], stub["sha256"], holders[referenced])
+                    ))
+                    self.stubs[tool_call_id] = holders[referenced]
+            expanded.append(message)
+
+        for real_path, (digest, tool_call_id) in list(self.views.items()):
+            if tool_call_id in holders:
+                self.views[real_path] = (digest, holders[tool_call_id])
+            elif tool_call_id in dropped_results:
+                del self.views[real_path]
+        for tool_call_id in dropped_results:
+            self.stubs.pop(tool_call_id, None)
+        return expanded
+
+file_content_cache = FileContentCache(FILE_CACHE_MAX_CHARS)
+
+def compile_gitignore_pattern(pattern: str) -> "re.Pattern":
+    """Translate a .gitignore glob into a regular expression for paths with "/" separators.
+
+    "*", "?" and bracket expressions never match "/". "**/" at the start and "/**/" in
+    the middle match any number of directories, including none, and a trailing "/**"
+    matches everything inside.
+    """
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i) and i + 2 == len(pattern) and (i == 0 or pattern[i - 1] == "/"):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            members = pattern[i + 1:end].replace("\\", "\\\\")
+            regex += f"[^/{members[1:]}]" if members[0] in "!^" else f"[{members}]"
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex)
+
+def parse_gitignore(path: str) -> List[Any]:
+    """Return the rules of a .gitignore file as (regex, negated, directory_only, anchored) tuples."""
+    rules = []
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return rules
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        if line.startswith("\\"):
+            line = line[1:]
+        directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        # A pattern with a slash before its end is matched against the path from the .gitignore's directory
+        anchored = "/" in line
+        line = line.lstrip("/")
+        if line:
+            rules.append((compile_gitignore_pattern(line), negated, directory_only, anchored))
+    return rules
+
+def name_trigrams(name: str) -> set:
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+class FileIndex:
+    """In-memory index of every file below the workspace root, kept current in the background.
+
+    The tree is walked once on a daemon thread, skipping FILE_INDEX_IGNORED_DIRS and
+    anything matched by .gitignore files along the way. Afterwards, if watchdog is
+    installed, the thread rescans the directories whose entries file system events
+    report as created, deleted or moved. Otherwise it polls the mtime of each indexed
+    directory, which changes whenever an entry is added, removed or renamed, and
+    rescans only the directories that changed.
+
+    Lookups go through lowercase basenames: an exact name is a dictionary hit, and
+    otherwise the names holding the query's rarest trigrams are ranked by prefix,
+    substring and trigram (Dice) similarity. Either way directory segments of the
+    query that appear in a candidate's path add a bonus.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.directories: Dict[str, Any] = {}   # relative dir -> (mtime_ns, file names, subdir names)
+        self.ignore_rules: Dict[str, List[Any]] = {}  # relative dir -> rules of its .gitignore
+        self.paths_by_name: Dict[str, set] = {}  # lowercase basename -> relative paths
+        self.names_by_trigram: Dict[str, set] = {}  # trigram -> lowercase basenames
+        self.file_count = 0
+        self.truncated = False
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.changed = threading.Event()
+        self.dirty_dirs: set = set()  # relative dirs reported by file system events, not yet rescanned
+        self.watching = False
+        self.thread = None
+
+    def start(self, root: Optional[str] = None) -> None:
+        """Build the index on a background thread and keep refreshing it."""
+        if self.thread is None:
+            self.root = os.path.abspath(root or os.getcwd())
+            self.thread = threading.Thread(target=self.run, name="file-index", daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.changed.set()
+
+    def run(self) -> None:
+        try:
+            self.build(self.root)
+        except OSError:
+            return
+        observer = self.start_watcher()
+        if observer is None:
+            while not self.stopped.wait(FILE_INDEX_POLL_INTERVAL):
+                try:
+                    self.refresh()
+                except OSError:
+                    pass
+            return
+        try:
+            while True:
+                self.changed.wait()
+                if self.stopped.is_set():
+                    break
+                self.changed.clear()
+                self.rescan_dirty()
+        finally:
+            observer.stop()
+
+    def start_watcher(self):
+        """Follow file system events below the root with watchdog, or return None to poll instead."""
+        if not FILE_INDEX_WATCH or Observer is None:
+            return None
+        try:
+            observer = Observer()
+            observer.schedule(self, self.root, recursive=True)
+            observer.daemon = True
+            observer.start()
+        except Exception:
+            # For example when the inotify watch limit is reached
+            return None
+        self.watching = True
+        return observer
+
+    def dispatch(self, event) -> None:
+        """Note the directories whose entries a watchdog event changed; runs on the observer's thread."""
+        # Content changes do not add or remove names, so they leave the index as it is
+        if event.event_type not in ("created", "deleted", "moved"):
+            return
+        for path in (event.src_path, getattr(event, "dest_path", None)):
+            if not path:
+                continue
+            rel_path = os.path.relpath(os.fsdecode(path), self.root).replace(os.sep, "/")
+            if rel_path == ".." or rel_path.startswith("../"):
+                continue
+            with self.lock:
+                self.dirty_dirs.add(rel_path.rsplit("/", 1)[0] if "/" in rel_path else "")
+        self.changed.set()
+
+    def rescan_dirty(self) -> None:
+        """Rescan the indexed directories that file system events reported."""
+        with self.lock:
+            dirty_dirs, self.dirty_dirs = self.dirty_dirs, set()
+        for rel_dir in sorted(dirty_dirs):
+            # Events inside ignored or not yet indexed directories are covered by their parent's rescan
+            if rel_dir in self.directories:
+                try:
+                    self.walk(rel_dir)
+                except OSError:
+                    pass
+
+    def build(self, root: str) -> None:
+        """Index the tree below root; called on the background thread, or directly in tests."""
+        self.root = os.path.abspath(root)
+        self.walk("")
+        self.ready.set()
+
+    def is_ignored(self, parent: str, name: str, is_dir: bool) -> bool:
+        """Apply the .gitignore rules of every directory from the root down to parent."""
+        if is_dir and name in FILE_INDEX_IGNORED_DIRS:
+            return True
+        rel_path = f"{parent}/{name}" if parent else name
+        ignored = False
+        segments = parent.split("/") if parent else []
+        for depth in range(len(segments) + 1):
+            base = "/".join(segments[:depth])
+            for pattern, negated, directory_only, anchored in self.ignore_rules.get(base, ()):
+                if directory_only and not is_dir:
+                    continue
+                target = rel_path[len(base) + 1:] if base else rel_path
+                if pattern.fullmatch(target if anchored else name):
+                    ignored = not negated
+        return ignored
+
+    def scan_directory(self, rel_dir: str):
+        """List a directory's indexable files and subdirectories."""
+        abs_dir = os.path.join(self.root, rel_dir)
+        mtime_ns = os.stat(abs_dir).st_mtime_ns
+        rules = parse_gitignore(os.path.join(abs_dir, ".gitignore"))
+        if rules:
+            self.ignore_rules[rel_dir] = rules
+        else:
+            self.ignore_rules.pop(rel_dir, None)
+        files, subdirs = set(), set()
+        with os.scandir(abs_dir) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if not self.is_ignored(rel_dir, entry.name, is_dir):
+                    (subdirs if is_dir else files).add(entry.name)
+        return mtime_ns, files, subdirs
+
+    def walk(self, rel_dir: str) -> None:
+        """Rescan a directory and walk every subdirectory that was not indexed before."""
+        pending = [rel_dir]
+        while pending:
+            current = pending.pop()
+            try:
+                mtime_ns, files, subdirs = self.scan_directory(current)
+            except FileNotFoundError:
+                self.remove_tree(current)
+                continue
+            except OSError:
+                continue
+            old_subdirs = self.directories.get(current, (0, set(), set()))[2]
+            with self.lock:
+                old_files = self.directories.get(current, (0, set(), set()))[1]
+                for name in old_files - files:
+                    self.remove_file(f"{current}/{name}" if current else name)
+                for name in sorted(files - old_files):
+                    self.add_file(f"{current}/{name}" if current else name)
+                self.directories[current] = (mtime_ns, files, subdirs)
+            for name in old_subdirs - subdirs:
+                self.remove_tree(f"{current}/{name}" if current else name)
+            pending.extend(f"{current}/{name}" if current else name for name in subdirs - old_subdirs)
+
+    def refresh(self) -> None:
+        """Rescan the directories whose mtime changed since they were indexed."""
+        for rel_dir in list(self.directories):
+            entry = self.directories.get(rel_dir)
+            if entry is None:
+                continue
+            try:
+                mtime_ns = os.stat(os.path.join(self.root, rel_dir)).st_mtime_ns
+            except FileNotFoundError:
+                self.remove_tree(rel_dir)
+                continue
+            if mtime_ns != entry[0]:
+                self.walk(rel_dir)
+
+    def add_file(self, rel_path: str) -> None:
+        if self.file_count >= FILE_INDEX_MAX_FILES:
+            self.truncated = True
+            return
+        name = rel_path.rsplit("/", 1)[-1].lower()
+        paths = self.paths_by_name.get(name)
+        if paths is None:
+            paths = self.paths_by_name[name] = set()
+            for trigram in name_trigrams(name):
+                self.names_by_trigram.setdefault(trigram, set()).add(name)
+        if rel_path not in paths:
+            paths.add(rel_path)
+            self.file_count += 1
+
+    def remove_file(self, rel_path: str) -> None:
+        name = rel_path.rsplit("/", 1)[-1].lower()
+        paths = self.paths_by_name.get(name)
+        if paths is None or rel_path not in paths:
+            return
+        paths.discard(rel_path)
+        self.file_count -= 1
+        if not paths:
+            del self.paths_by_name[name]
+            for trigram in name_trigrams(name):
+                names = self.names_by_trigram.get(trigram)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del self.names_by_trigram[trigram]
+
+    def remove_tree(self, rel_dir: str) -> None:
+        """Forget a directory and everything below it."""
+        prefix = rel_dir + "/"
+        with self.lock:
+            for current in [d for d in self.directories if d == rel_dir or d.startswith(prefix)]:
+                for name in self.directories.pop(current)[1]:
+                    self.remove_file(f"{current}/{name}" if current else name)
+                self.ignore_rules.pop(current, None)
+
+    def lookup(self, query: str, limit: int = FILE_INDEX_MAX_SUGGESTIONS) -> List[Any]:
+        """Return up to `limit` (score, relative path) pairs for a file name or partial path, best first."""
+        segments = [segment for segment in query.replace(os.sep, "/").lower().split("/") if segment not in ("", ".")]
+        if not segments:
+            return []
+        name, wanted_dirs = segments[-1], segments[:-1]
+        query_trigrams = name_trigrams(name)
+        scored = []
+        with self.lock:
+            if name in self.paths_by_name:
+                # An exact name beats every fuzzy match, so only its paths need ranking
+                candidates = [name]
+            elif query_trigrams:
+                # A name sharing at least a third of the query's trigrams holds one of the rarest ones
+                rarest = sorted(query_trigrams, key=lambda trigram: len(self.names_by_trigram.get(trigram, ())))
+                needed = -(-len(query_trigrams) // 3)
+                candidates = set()
+                for trigram in rarest[:len(rarest) - needed + 1]:
+                    candidates.update(self.names_by_trigram.get(trigram, ()))
+            else:
+                candidates = [candidate for candidate in self.paths_by_name if name in candidate]
+            for candidate in candidates:
+                if candidate == name:
+                    score = 1.0
+                elif candidate.startswith(name):
+                    score = 0.9
+                elif name in candidate:
+                    score = 0.8
+                else:
+                    shared = sum(1 for trigram in query_trigrams if trigram in candidate)
+                    score = 2 * shared / (len(query_trigrams) + max(1, len(candidate) - 2))
+                if score < FILE_INDEX_MIN_SCORE:
+                    continue
+                for rel_path in self.paths_by_name[candidate]:
+                    scored.append((score + self.segment_bonus(rel_path, wanted_dirs), rel_path))
+        scored.sort(key=lambda item: (-item[0], item[1].count("/"), item[1]))
+        return scored[:limit]
+
+    @staticmethod
+    def segment_bonus(rel_path: str, wanted_dirs: List[str]) -> float:
+        """Reward candidates whose directories contain the query's directories in order."""
+        matched = 0
+        remaining = iter(rel_path.lower().split("/")[:-1])
+        for wanted in wanted_dirs:
+            if any(segment == wanted for segment in remaining):
+                matched += 1
+        return 0.1 * matched
+
+    def find(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """Resolve a path that does not exist to indexed files, in find_file's result format.
+
+        Only a single file whose path ends with the query, such as src/pkg/util.py for
+        util.py or pkg/util.py, is resolved; prefix, substring and fuzzy matches come
+        back as suggestions so an edit never lands on a file the model did not name.
+        Returns None while the index is still being built, for paths outside the root
+        and when nothing matches, so the caller can fall back to a directory scan.
+        """
+        if not self.ready.is_set():
+            self.start()
+            return None
+        query = file_path
+        if os.path.isabs(file_path):
+            query = os.path.relpath(file_path, self.root)
+            if query.startswith(".."):
+                return None
+        matches = self.lookup(query)
+        if not matches:
+            return None
+        suffix = "/".join(segment for segment in query.replace(os.sep, "/").split("/") if segment not in ("", "."))
+        exact = [rel_path for _, rel_path in matches if rel_path == suffix or rel_path.endswith("/" + suffix)]
+        if len(exact) == 1:
+            matched_path = os.path.join(self.root, exact[0])
+            return {
+                "status": "found",
+                "file_path": matched_path,
+                "message": f"Found similar file: {matched_path}"
+            }
+        suggestions = [rel_path for _, rel_path in matches]
+        return {
+            "status": "suggestions",
+            "suggestions": suggestions,
+            "message": f"No exact match; possible matches: {', '.join(suggestions)}"
+        }
+
+file_index = FileIndex()
+
 def find_file(file_path: str) -> Dict[str, Any]:
     """Find a file by name, with fuzzy matching if exact match not found."""
     # First check if the path exists as provided
@@ -259,6 +1016,13 @@ def find_file(file_path: str) -> Dict[str, Any]:
         # Use the provided directory
         directory = directory or "."
     
+    # Look the path up in the workspace index, which covers every subdirectory
+    if FILE_INDEX_ENABLED:
+        index_result = file_index.find(file_path)
+        if index_result is not None:
+            return index_result
+    
+    # Fall back to the single directory while the index is being built or has no match yet
     try:
         files = os.listdir(directory)
         matches = [f for f in files if f.startswith(base_name)]
@@ -267,17 +1031,11 @@ def find_file(file_path: str) -> Dict[str, Any]:
             matches = [f for f in files if base_name.lower() in f.lower()]
         
         if matches:
-            if len(matches) == 1:
-                matched_path = os.path.join(directory, matches[0])
-                return {
-                    "status": "found",
-                    "file_path": matched_path,
-                    "message": f"Found similar file: {matched_path}"
-                }
+            # Partial names are only suggested, never resolved, so edits cannot land on the wrong file
             return {
                 "status": "suggestions",
                 "suggestions": matches,
-                "message": f"Multiple possible matches found: {', '.join(matches)}"
+                "message": f"No exact match; possible matches: {', '.join(matches)}"
             }
         
         abs_directory = os.path.abspath(directory)
@@ -291,43 +1049,66 @@ def find_file(file_path: str) -> Dict[str, Any]:
             "message": f"Error searching for files: {str(e)}"
         }
 
+def make_diff(file_path: str, old_text: str, new_text: str) -> str:
+    """Return a unified diff between two versions of a file, cut to EDIT_DIFF_MAX_CHARS."""
+    name = os.path.basename(file_path)
+    lines = []
+    for line in difflib.unified_diff(
+        old_text.splitlines(keepends=True), new_text.splitlines(keepends=True),
+        fromfile=f"a/{name}", tofile=f"b/{name}", n=EDIT_DIFF_CONTEXT_LINES
+    ):
+        lines.append(line if line.endswith("\n") else line + "\n\\ No newline at end of file\n")
+    diff = "".join(lines)
+    if len(diff) > EDIT_DIFF_MAX_CHARS:
+        diff = diff[:EDIT_DIFF_MAX_CHARS] + "\n... [diff cut; use view_file to see the rest]\n"
+    return diff
+
+def make_edit_result(message: str, written: Dict[str, Any], old_text: str, return_content: bool) -> Dict[str, Any]:
+    """Build an edit tool's result: a diff and content hash, plus the full file only on request."""
+    result = {
+        "status": "success",
+        "message": message,
+        "file_path": written["file_path"],
+        "diff": make_diff(written["file_path"], old_text, written["text"]),
+        "sha256": written["sha256"]
+    }
+    if return_content:
+        result["updated_content"] = written["text"]
+    return result
+
 def create_file(file_path: str, content: str) -> Dict[str, Any]:
     """Create a new file with the specified content."""
     try:
         os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        written = file_content_cache.write(file_path, content)
+        # The model already has the content it sent, so only confirm what was written
         return {
             "status": "success", 
             "message": f"File created at {file_path}",
-            "content": content
+            "lines": len(content.splitlines()),
+            "sha256": written["sha256"]
         }
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-def replace_text(file_path: str, search_text: str, replace_text: str) -> Dict[str, Any]:
+def replace_text(file_path: str, search_text: str, replace_text: str, return_content: bool = False) -> Dict[str, Any]:
     """Replace text in a file."""
     try:
         file_result = find_file(file_path)
         
         if file_result["status"] == "found":
             actual_path = file_result["file_path"]
-            with open(actual_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            content = file_content_cache.read(actual_path)["text"]
 
             if search_text not in content:
                 return {"status": "error", "message": f"Text '{search_text}' not found in {actual_path}"}
 
             new_content = content.replace(search_text, replace_text)
-            with open(actual_path, 'w', encoding='utf-8') as f:
-                f.write(new_content)
+            written = file_content_cache.write(actual_path, new_content)
 
-            return {
-                "status": "success", 
-                "message": f"Replaced '{search_text}' with '{replace_text}' in {actual_path}",
-                "updated_content": new_content,
-                "file_path": actual_path
-            }
+            return make_edit_result(
+                f"Replaced '{search_text}' with '{replace_text}' in {actual_path}", written, content, return_content
+            )
         elif file_result["status"] == "suggestions":
             return {
                 "status": "error",
@@ -337,31 +1118,107 @@ def replace_text(file_path: str, search_text: str, replace_text: str) -> Dict[st
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-def insert_line(file_path: str, line_number: int, content: str) -> Dict[str, Any]:
+def insert_line(file_path: str, line_number: int, content: str, return_content: bool = False) -> Dict[str, Any]:
     """Insert a line at a specific position in a file."""
     try:
         file_result = find_file(file_path)
         
         if file_result["status"] == "found":
             actual_path = file_result["file_path"]
-            with open(actual_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
+            old_content = file_content_cache.read(actual_path)["text"]
+            lines = io.StringIO(old_content).readlines()
 
             if line_number < 1 or line_number > len(lines) + 1:
                 return {"status": "error", "message": f"Invalid line number: {line_number}. File has {len(lines)} lines."}
 
             lines.insert(line_number - 1, content if content.endswith('\n') else content + '\n')
-            updated_content = ''.join(lines)
-            
-            with open(actual_path, 'w', encoding='utf-8') as f:
-                f.writelines(lines)
+            written = file_content_cache.write(actual_path, ''.join(lines))
 
+            return make_edit_result(
+                f"Inserted line at position {line_number} in {actual_path}", written, old_content, return_content
+            )
+        elif file_result["status"] == "suggestions":
             return {
-                "status": "success", 
-                "message": f"Inserted line at position {line_number} in {actual_path}",
-                "updated_content": updated_content,
-                "file_path": actual_path
+                "status": "error",
+                "message": f"File '{file_path}' not found. Did you mean one of these? {', '.join(file_result['suggestions'])}"
             }
+        return {"status": "error", "message": file_result["message"]}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+def plan_edits(text: str, edits: List[Dict[str, Any]]):
+    """Resolve every edit against the original text and return (new_text, errors).
+
+    Replacements apply to every occurrence of their search_text, as replace_text does,
+    and insertions go before their line_number in the original numbering. Nothing is
+    applied if any edit fails to match or two edits overlap.
+    """
+    line_starts = [0]
+    for line in io.StringIO(text).readlines():
+        line_starts.append(line_starts[-1] + len(line))
+
+    spans, errors = [], []
+    for number, edit in enumerate(edits, 1):
+        if not isinstance(edit, dict):
+            errors.append(f"Edit {number}: expected an object")
+        elif "search_text" in edit:
+            search_text = edit["search_text"]
+            start = text.find(search_text) if search_text else -1
+            if start < 0:
+                errors.append(f"Edit {number}: text '{search_text}' not found")
+            while start >= 0:
+                spans.append((start, start + len(search_text), edit.get("replace_text", ""), number))
+                start = text.find(search_text, start + len(search_text))
+        elif "line_number" in edit:
+            line_number = edit["line_number"]
+            if not isinstance(line_number, int) or line_number < 1 or line_number > len(line_starts):
+                errors.append(f"Edit {number}: invalid line number {line_number}, file has {len(line_starts) - 1} lines")
+                continue
+            content = edit.get("content", "")
+            content = content if content.endswith("\n") else content + "\n"
+            offset = line_starts[line_number - 1]
+            if offset == len(text) and text and not text.endswith("\n"):
+                content = "\n" + content
+            spans.append((offset, offset, content, number))
+        else:
+            errors.append(f"Edit {number}: needs search_text and replace_text, or line_number and content")
+
+    # Insertions at an offset go before a replacement starting there; ties keep the given order
+    spans.sort(key=lambda span: (span[0], span[1] > span[0], span[3]))
+    previous_end, previous_number = 0, None
+    for start, end, _, number in spans:
+        if start < previous_end:
+            errors.append(f"Edit {number} overlaps edit {previous_number}")
+        if end > previous_end:
+            previous_end, previous_number = end, number
+    if errors:
+        return None, errors
+
+    pieces, position = [], 0
+    for start, end, replacement, _ in spans:
+        pieces.append(text[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(text[position:])
+    return "".join(pieces), []
+
+def apply_edits(file_path: str, edits: List[Dict[str, Any]], return_content: bool = False) -> Dict[str, Any]:
+    """Apply several edits to a file in one read and one atomic write."""
+    try:
+        if not edits:
+            return {"status": "error", "message": "No edits given"}
+        file_result = find_file(file_path)
+        
+        if file_result["status"] == "found":
+            actual_path = file_result["file_path"]
+            content = file_content_cache.read(actual_path)["text"]
+
+            new_content, errors = plan_edits(content, edits)
+            if errors:
+                return {"status": "error", "message": f"No edits applied to {actual_path}: {'; '.join(errors)}"}
+            written = file_content_cache.write(actual_path, new_content, atomic=True)
+
+            return make_edit_result(f"Applied {len(edits)} edits to {actual_path}", written, content, return_content)
         elif file_result["status"] == "suggestions":
             return {
                 "status": "error",
@@ -371,31 +1228,324 @@ def insert_line(file_path: str, line_number: int, content: str) -> Dict[str, Any
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-def execute_command(command: str) -> Dict[str, Any]:
-    """Execute a bash command."""
-    try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            encoding='utf-8'
+# Full output of truncated commands, spilled to a temp directory for this session
+command_output_dir = None
+command_output_files: Dict[str, str] = {}
+command_counter = itertools.count(1)
+
+def get_command_output_dir() -> str:
+    """Create the session's command output directory on first use."""
+    global command_output_dir
+    if command_output_dir is None:
+        command_output_dir = tempfile.mkdtemp(prefix="lm_agent_output_")
+        atexit.register(shutil.rmtree, command_output_dir, True)
+    return command_output_dir
+
+class BoundedOutputCapture:
+    """Keeps the head and tail of an output stream in memory and spills the rest to disk.
+
+    Memory stays bounded by COMMAND_OUTPUT_HEAD_BYTES + COMMAND_OUTPUT_TAIL_BYTES. Once
+    the stream outgrows that, the full stream is written to a session temp file that
+    read_command_output can page through using the capture's handle.
+    """
+
+    def __init__(self, handle: str):
+        self.handle = handle
+        self.head = b""
+        self.tail = b""
+        self.total_bytes = 0
+        self.spill_file = None
+
+    def write(self, data: bytes):
+        """Record the next chunk of output."""
+        self.total_bytes += len(data)
+        if len(self.head) < COMMAND_OUTPUT_HEAD_BYTES:
+            room = COMMAND_OUTPUT_HEAD_BYTES - len(self.head)
+            self.head += data[:room]
+            data = data[room:]
+
+        if self.spill_file is None and self.total_bytes > COMMAND_OUTPUT_HEAD_BYTES + COMMAND_OUTPUT_TAIL_BYTES:
+            # Everything seen so far is still in memory, so the spill file starts complete
+            path = os.path.join(get_command_output_dir(), f"{self.handle}.log")
+            self.spill_file = open(path, "wb")
+            self.spill_file.write(self.head + self.tail + data)
+            command_output_files[self.handle] = path
+        elif self.spill_file is not None:
+            self.spill_file.write(data)
+
+        if data:
+            self.tail = (self.tail + data)[-COMMAND_OUTPUT_TAIL_BYTES:]
+
+    def close(self):
+        """Flush the spill file, if any."""
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+    @property
+    def truncated(self) -> bool:
+        return self.spill_file is not None
+
+    def text(self) -> str:
+        """Return the full output, or its head and tail around an omission marker."""
+        if not self.truncated:
+            return (self.head + self.tail).decode("utf-8", errors="replace")
+        omitted = self.total_bytes - len(self.head) - len(self.tail)
+        marker = (
+            f"\n... [{omitted:,} bytes omitted; call read_command_output with handle "
+            f"'{self.handle}' and offset {len(self.head)} to read them] ...\n"
         )
+        return self.head.decode("utf-8", errors="replace") + marker + self.tail.decode("utf-8", errors="replace")
+
+def kill_process_tree(process) -> None:
+    """Kill a command's shell and every process it started."""
+    if process.returncode is not None:
+        return
+    try:
+        if os.name == "nt":
+            # taskkill /T walks the child process tree on Windows
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+        else:
+            # The shell was started in its own session, so its pid is also the process group id
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, OSError):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
 
-        message = f"Command executed successfully: '{command}'" if result.returncode == 0 else f"Command failed with return code {result.returncode}: '{command}'"
+async def execute_command(command: str) -> Dict[str, Any]:
+    """Execute a bash command, streaming its output to the console as lines arrive."""
+    try:
+        if os.name == "nt":
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
+            )
+        else:
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
 
-        return {
-            "status": "success" if result.returncode == 0 else "error",
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        last_output_time = start_time
+        command_id = f"cmd{next(command_counter)}"
+        output = {
+            "stdout": BoundedOutputCapture(f"{command_id}_stdout"),
+            "stderr": BoundedOutputCapture(f"{command_id}_stderr")
+        }
+
+        async def pump(stream, stream_name):
+            nonlocal last_output_time
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            style = COMMAND_STDOUT_STYLE if stream_name == "stdout" else COMMAND_STDERR_STYLE
+            partial_line = ""
+            while True:
+                data = await stream.read(4096)
+                if data:
+                    last_output_time = loop.time()
+                    output[stream_name].write(data)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    # Echo complete lines to the console as they arrive
+                    *lines, partial_line = (partial_line + text).split("\n")
+                    for line in lines:
+                        console.print(line, style=style, markup=False, highlight=False)
+                if not data:
+                    if partial_line:
+                        console.print(partial_line, style=style, markup=False, highlight=False)
+                    break
+
+        io_task = asyncio.ensure_future(asyncio.gather(
+            pump(process.stdout, "stdout"),
+            pump(process.stderr, "stderr"),
+            process.wait()
+        ))
+
+        timeout_message = None
+        try:
+            while not io_task.done():
+                await asyncio.wait({io_task}, timeout=0.5)
+                now = loop.time()
+                if io_task.done():
+                    break
+                if now - start_time > COMMAND_TIMEOUT:
+                    timeout_message = f"Command timed out after {COMMAND_TIMEOUT}s: '{command}'"
+                elif now - last_output_time > COMMAND_IDLE_TIMEOUT:
+                    timeout_message = f"Command produced no output for {COMMAND_IDLE_TIMEOUT}s and was stopped: '{command}'"
+                if timeout_message:
+                    kill_process_tree(process)
+                    # Give the pipes a moment to drain, then stop reading regardless
+                    await asyncio.wait({io_task}, timeout=2)
+                    io_task.cancel()
+                    await asyncio.gather(io_task, return_exceptions=True)
+                    break
+        except asyncio.CancelledError:
+            kill_process_tree(process)
+            io_task.cancel()
+            # Retrieve the outcome so the abandoned readers do not log a warning
+            io_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            raise
+        finally:
+            for capture in output.values():
+                capture.close()
+
+        returncode = process.returncode if process.returncode is not None else -1
+        if timeout_message:
+            message = timeout_message
+        elif returncode == 0:
+            message = f"Command executed successfully: '{command}'"
+        else:
+            message = f"Command failed with return code {returncode}: '{command}'"
+
+        result = {
+            "status": "success" if returncode == 0 and not timeout_message else "error",
             "message": message,
-            "stdout": result.stdout,
-            "stderr": result.stderr,
-            "returncode": result.returncode
+            "stdout": output["stdout"].text(),
+            "stderr": output["stderr"].text(),
+            "returncode": returncode
         }
+        # Point the model at the full output when either stream was cut down
+        handles = {name: capture.handle for name, capture in output.items() if capture.truncated}
+        if handles:
+            result["output_handles"] = handles
+            result["output_bytes"] = {name: output[name].total_bytes for name in handles}
+        return result
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-def view_file(file_path: str) -> Dict[str, Any]:
-    """View the contents of a file."""
+def read_command_output(handle: str, offset: int = 0, length: int = COMMAND_OUTPUT_PAGE_BYTES) -> Dict[str, Any]:
+    """Read a page of a truncated command's full output."""
+    try:
+        if handle not in command_output_files:
+            return {"status": "error", "message": f"Unknown output handle: {handle}"}
+
+        path = command_output_files[handle]
+        total_bytes = os.path.getsize(path)
+        offset = max(0, offset)
+        length = max(0, min(length, COMMAND_OUTPUT_PAGE_BYTES))
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+
+        next_offset = offset + len(data)
+        return {
+            "status": "success",
+            "handle": handle,
+            "offset": offset,
+            "content": data.decode("utf-8", errors="replace"),
+            "total_bytes": total_bytes,
+            "next_offset": next_offset if next_offset < total_bytes else None
+        }
+    except Exception as e:
+        return {"status": "error", "message": f"Error reading command output: {str(e)}"}
+
+class LineIndex:
+    """Sparse newline index of a file, for finding the byte offset of a line without a full scan.
+
+    Only the number of newlines before each VIEW_FILE_INDEX_BLOCK-sized block is stored,
+    so the index of a 200 MB file has about 3,200 entries. Locating a line is a binary
+    search over the blocks plus a scan of at most one block.
+    """
+
+    def __init__(self, data, block_size: int = VIEW_FILE_INDEX_BLOCK):
+        self.block_size = block_size
+        self.size = len(data)
+        self.newlines_before = array.array("q", [0])
+        for offset in range(0, self.size, block_size):
+            self.newlines_before.append(self.newlines_before[-1] + data[offset:offset + block_size].count(b"\n"))
+        newline_count = self.newlines_before[-1]
+        # A last line without a trailing newline still counts as a line
+        self.total_lines = newline_count + (1 if self.size and data[self.size - 1:self.size] != b"\n" else 0)
+
+    def line_start(self, data, line_number: int) -> int:
+        """Return the byte offset where a 1-based line starts, or the file size past the last line."""
+        newlines = line_number - 1
+        if newlines <= 0:
+            return 0
+        if newlines > self.newlines_before[-1]:
+            return self.size
+        block = bisect.bisect_left(self.newlines_before, newlines) - 1
+        offset = block * self.block_size
+        for _ in range(newlines - self.newlines_before[block]):
+            offset = data.find(b"\n", offset) + 1
+        return offset
+
+# Newline indexes of recently viewed files, validated by (mtime_ns, size)
+line_index_cache = collections.OrderedDict()
+line_index_lock = threading.Lock()
+
+def get_line_index(real_path: str, info: os.stat_result, data) -> LineIndex:
+    """Return the cached newline index of a file, rebuilding it when the file changed."""
+    key = (info.st_mtime_ns, info.st_size)
+    with line_index_lock:
+        cached = line_index_cache.get(real_path)
+        if cached is not None and cached[0] == key:
+            line_index_cache.move_to_end(real_path)
+            return cached[1]
+    index = LineIndex(data)
+    with line_index_lock:
+        line_index_cache[real_path] = (key, index)
+        while len(line_index_cache) > VIEW_FILE_INDEX_CACHE_ENTRIES:
+            line_index_cache.popitem(last=False)
+    return index
+
+def view_file_range(real_path: str, start_line: Optional[int], end_line: Optional[int]) -> Dict[str, Any]:
+    """Return numbered lines of a file, read through mmap and cut to VIEW_FILE_MAX_BYTES."""
+    with open(real_path, 'rb') as f:
+        info = os.fstat(f.fileno())
+        if info.st_size == 0:
+            return {"status": "success", "file_path": real_path, "content": "", "total_lines": 0}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            index = get_line_index(real_path, info, data)
+            start_line = max(1, start_line or 1)
+            end_line = min(index.total_lines, end_line or index.total_lines)
+            if start_line > index.total_lines:
+                return {"status": "error", "message": f"start_line {start_line} is past the end of the file ({index.total_lines} lines)"}
+            if end_line < start_line:
+                return {"status": "error", "message": f"end_line {end_line} is before start_line {start_line}"}
+
+            start = index.line_start(data, start_line)
+            end = index.line_start(data, end_line + 1)
+            cut = end - start > VIEW_FILE_MAX_BYTES
+            partial_line = False
+            if cut:
+                # Stop after the last complete line that fits, or cut the first line if it alone is too long
+                boundary = data.rfind(b"\n", start, start + VIEW_FILE_MAX_BYTES)
+                partial_line = boundary < 0
+                end = start + VIEW_FILE_MAX_BYTES if partial_line else boundary + 1
+            lines = data[start:end].split(b"\n")
+
+    if lines[-1] == b"" and len(lines) > 1:
+        lines.pop()
+    last_line = start_line + len(lines) - 1
+    texts = [line.rstrip(b"\r").decode("utf-8", errors="replace") for line in lines]
+    content = "\n".join(f"{number:6d}  {text}" for number, text in enumerate(texts, start_line))
+    result = {
+        "status": "success",
+        "file_path": real_path,
+        "start_line": start_line,
+        "end_line": last_line,
+        "total_lines": index.total_lines,
+        "content": content
+    }
+    if cut:
+        message = f"Result cut at {VIEW_FILE_MAX_BYTES:,} bytes."
+        if partial_line:
+            message = f"Line {last_line} is longer than {VIEW_FILE_MAX_BYTES:,} bytes and was cut."
+        if last_line < end_line:
+            result["next_start_line"] = last_line + 1
+            message += f" Call view_file with start_line={last_line + 1} to continue."
+        result["message"] = message
+    return result
+
+def view_file(file_path: str, start_line: Optional[int] = None, end_line: Optional[int] = None) -> Dict[str, Any]:
+    """View the contents of a file, or a range of its lines."""
     try:
         # Use find_file to locate the file
         file_result = find_file(file_path)
@@ -407,19 +1557,127 @@ def view_file(file_path: str) -> Dict[str, Any]:
             suggestions_str = ", ".join(file_result["suggestions"])
             return {"status": "error", "message": f"File not found. Did you mean one of: {suggestions_str}?"}
         
-        # Read the file contents
-        with open(file_result["file_path"], 'r', encoding='utf-8', errors='replace') as f:
-            content = f.read()
+        real_path = os.path.realpath(file_result["file_path"])
+        if start_line is not None or end_line is not None or os.path.getsize(real_path) > VIEW_FILE_MAX_BYTES:
+            return view_file_range(real_path, start_line, end_line)
+        
+        # Read the file contents, reusing the cached text if the file is unchanged
+        cached = file_content_cache.read(real_path, errors='replace')
         
-        return {"status": "success", "content": content}
+        return {"status": "success", "content": cached["text"], "file_path": cached["file_path"], "sha256": cached["sha256"]}
     except Exception as e:
         return {"status": "error", "message": f"Error viewing file: {str(e)}"}
 
-def describe_image(image_path: str) -> Dict[str, Any]:
+async def get_active_model_id() -> str:
+    """Return the id of the loaded model, asking LM Studio once if it is not known yet."""
+    global active_model_id
+    if active_model_id is None:
+        try:
+            response = await backend_pool.pick().client.models.list()
+            active_model_id = response.data[0].id if response.data else VISION_MODEL
+        except Exception:
+            return VISION_MODEL
+    return active_model_id
+
+def text_only_history() -> List[Dict[str, Any]]:
+    """Return the conversation history with image parts removed, for vision requests.
+
+    Previous images are left out so describing several images does not overload the
+    context window.
+    """
+    history = []
+    for msg in conversation_history:
+        if isinstance(msg.get("content", ""), str):
+            history.append(msg)
+        elif isinstance(msg.get("content", []), list):
+            # For messages with content as a list (like previous vision requests)
+            # only include the text part, not the image data
+            new_content = [item for item in msg["content"] if item.get("type") == "text"]
+            if new_content:
+                text_only_copy = msg.copy()
+                text_only_copy["content"] = new_content
+                history.append(text_only_copy)
+    return history
+
+async def describe_image_file(
+    image_path: str,
+    history: List[Dict[str, Any]],
+    preprocess_executor=None,
+    request_limit: Optional[asyncio.Semaphore] = None,
+    quiet: bool = False
+) -> Dict[str, Any]:
+    """Describe an existing image file, using the description cache when possible.
+
+    Preprocessing runs in a worker thread, or on `preprocess_executor` when given.
+    `request_limit` bounds how many vision requests run at the same time, and `quiet`
+    suppresses the per-step progress messages.
+    """
+    # Look the image up by content before doing any preprocessing or inference
+    raw = await asyncio.to_thread(read_file_bytes, image_path)
+    model_id = await get_active_model_id()
+    cache_key = ImageDescriptionCache.make_key(raw, VISION_PROMPT, model_id, vision_cache_params())
+    if IMAGE_CACHE_ENABLED:
+        cached_description = await asyncio.to_thread(image_description_cache.get, cache_key)
+        if cached_description is not None:
+            if not quiet:
+                console.print(f"[{INFO_STYLE}]Using cached description for {image_path}[/{INFO_STYLE}]")
+            return {"status": "success", "description": cached_description, "cached": True}
+
+    # Sniff, downscale and re-encode the image off the event loop
+    if preprocess_executor is None:
+        prepared = await asyncio.to_thread(preprocess_image, image_path, raw)
+    else:
+        # Worker processes re-read the file rather than receiving the bytes through a pipe
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(preprocess_executor, preprocess_image, image_path)
+    if prepared["status"] != "success":
+        return prepared
+
+    if not quiet:
+        source_width, source_height = prepared["source_size"]
+        sent_sizes = ", ".join(f"{image['width']}x{image['height']}" for image in prepared["images"])
+        console.print(
+            f"[{INFO_STYLE}]Prepared image: {source_width}x{source_height} "
+            f"({prepared['source_bytes'] / 1024:.0f} KB) -> {sent_sizes} "
+            f"({prepared['encoded_bytes'] / 1024:.0f} KB)[/{INFO_STYLE}]"
+        )
+
+    # Construct the message with the image data
+    message = {
+        "role": "user",
+        "content": build_vision_content(VISION_PROMPT, prepared["images"])
+    }
+    all_messages = history + [message]
+
+    async with request_limit or contextlib.nullcontext():
+        if not quiet:
+            console.print(f"[{INFO_STYLE}]Sending vision request to LM Studio...[/{INFO_STYLE}]")
+
+        # Call the OpenAI ChatCompletion API via LM Studio on the shared connection pool
+        response = await request_retrier.call(
+            "Vision",
+            backend_pool.create,
+            model=VISION_MODEL,
+            messages=all_messages,
+            max_tokens=VISION_MAX_TOKENS,
+            temperature=VISION_TEMPERATURE,
+            timeout=VISION_TIMEOUT
+        )
+
+    if not quiet:
+        console.print(f"[{INFO_STYLE}]Received vision response from LM Studio[/{INFO_STYLE}]")
+
+    description = response.choices[0].message.content
+    if IMAGE_CACHE_ENABLED and description:
+        metadata = {"path": image_path, "model": model_id, "prompt": VISION_PROMPT}
+        await asyncio.to_thread(image_description_cache.put, cache_key, description, metadata)
+    return {"status": "success", "description": description}
+
+async def describe_image(image_path: str) -> Dict[str, Any]:
     """Describe the contents of an image using the LM Studio vision model."""
     try:
         # Use find_file to locate the image
-        file_result = find_file(image_path)
+        file_result = await asyncio.to_thread(find_file, image_path)
         
         if file_result["status"] == "not_found":
             # Ask the user for the exact path
@@ -445,99 +1703,121 @@ def describe_image(image_path: str) -> Dict[str, Any]:
                 "message": f"Error: Image file '{actual_path}' not found. Please provide the exact path to the image."
             }
             
-        # Get the file size and check if it's reasonable
-        file_size = os.path.getsize(actual_path) / (1024 * 1024)  # Size in MB
-        console.print(f"[{INFO_STYLE}]Image file size: {file_size:.2f} MB[/{INFO_STYLE}]")
-        
-        if file_size > 4:
-            return {"status": "error", "message": f"Error: Image file is too large ({file_size:.2f} MB). Please use an image smaller than 20MB."}
-        
-        # Determine the correct MIME type based on file extension
-        file_extension = os.path.splitext(actual_path)[1].lower()
-        mime_type_map = {
-            '.jpeg': 'image/jpeg',
-            '.png': 'image/png'
-        }
-        mime_type = mime_type_map.get(file_extension, 'image/jpeg')  # Default to jpeg if unknown
-        
-        # Read and encode the image
-        with open(actual_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-            
-        console.print(f"[{INFO_STYLE}]Successfully encoded image, length: {len(encoded_string)} characters[/{INFO_STYLE}]")
+        # The description reaches the conversation history through the tool response,
+        # so nothing is appended here (tool calls may run concurrently with each other)
+        return await describe_image_file(actual_path, text_only_history())
 
-        # Construct the message with the image data
-        message = {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": "Analyze this image and tell me what you see."},
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:{mime_type};base64,{encoded_string}"
-                    }
-                }
-            ]
-        }
+    except Exception as e:
+        console.print(f"[{ERROR_STYLE}]Error in vision processing: {str(e)}[/{ERROR_STYLE}]")
+        return {"status": "error", "message": f"An error occurred: {str(e)}"}
 
-        # Create a clean message history for the vision request (without including previous images)
-        # This prevents context window overload when describing multiple images
-        text_only_history = []
-        for msg in conversation_history:
-            # Only include text messages in the history for the vision request
-            if isinstance(msg.get("content", ""), str):
-                text_only_history.append(msg)
-            elif isinstance(msg.get("content", []), list):
-                # For messages with content as a list (like previous vision requests)
-                # Only include the text part, not the image data
-                new_content = [item for item in msg["content"] if item.get("type") == "text"]
-                if new_content:
-                    text_only_copy = msg.copy()
-                    text_only_copy["content"] = new_content
-                    text_only_history.append(text_only_copy)
-        
-        # Use the filtered conversation history
-        all_messages = text_only_history + [message]
-        
-        console.print(f"[{INFO_STYLE}]Sending vision request to LM Studio...[/{INFO_STYLE}]")
+def expand_image_paths(paths: List[str]) -> Dict[str, List[str]]:
+    """Expand image files, directories and glob patterns into a list of image files.
 
-        # Create a synchronous client for this specific call
-        from openai import OpenAI
-        sync_client = OpenAI(
-            base_url=LM_STUDIO_BASE_URL,
-            api_key=LM_STUDIO_API_KEY
-        )
-        
-        # Call the OpenAI ChatCompletion API via LM Studio
-        response = sync_client.chat.completions.create(
-            model="local-model",  # LM Studio uses the currently loaded model
-            messages=all_messages,
-            max_tokens=600,
-            temperature=0.7,
-        )
-        
-        console.print(f"[{INFO_STYLE}]Received vision response from LM Studio[/{INFO_STYLE}]")
-        
-        description = response.choices[0].message.content
-        
-        # Add a simplified version of the message to the conversation history
-        # This avoids storing the full base64 image data in the history
-        simplified_user_msg = {
-            "role": "user", 
-            "content": f"Describe the image: {actual_path}"
+    Directories and glob matches are filtered to files that look like images; files
+    named explicitly are kept so preprocessing can report why they cannot be used.
+    Returns {"images": [...], "not_found": [...]} with duplicates removed.
+    """
+    images, not_found, seen = [], [], set()
+    for pattern in paths:
+        if os.path.isdir(pattern):
+            candidates = sorted(os.path.join(pattern, name) for name in os.listdir(pattern))
+            candidates = [path for path in candidates if os.path.isfile(path) and is_image_file(path)]
+        elif glob.has_magic(pattern):
+            candidates = sorted(path for path in glob.glob(pattern, recursive=True)
+                                if os.path.isfile(path) and is_image_file(path))
+            if not candidates:
+                not_found.append(pattern)
+        else:
+            file_result = find_file(pattern)
+            if file_result["status"] == "found":
+                candidates = [file_result["file_path"]]
+            else:
+                candidates = []
+                not_found.append(pattern)
+
+        for path in candidates:
+            key = os.path.normcase(os.path.abspath(path))
+            if key not in seen:
+                seen.add(key)
+                images.append(path)
+    return {"images": images, "not_found": not_found}
+
+async def describe_images(paths: List[str]) -> Dict[str, Any]:
+    """Describe a batch of images and return one aggregated result.
+
+    Images are preprocessed on a process pool and up to BATCH_CONCURRENCY vision
+    requests are kept in flight, so preprocessing of later images overlaps inference
+    on earlier ones. Each result is printed as soon as it completes. The requests
+    carry only the prompt and the image, not the conversation history.
+    """
+    try:
+        if isinstance(paths, str):
+            paths = [paths]
+        expanded = await asyncio.to_thread(expand_image_paths, paths)
+        image_paths = expanded["images"]
+        if not image_paths:
+            return {
+                "status": "path_needed",
+                "not_found": expanded["not_found"],
+                "message": f"No images found in: {', '.join(paths)}. Please provide the exact paths to the images."
+            }
+
+        skipped = image_paths[BATCH_MAX_IMAGES:]
+        image_paths = image_paths[:BATCH_MAX_IMAGES]
+        request_limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+        # A single image is not worth starting worker processes for
+        executor = get_preprocess_pool() if len(image_paths) > 1 else None
+        console.print(f"[{INFO_STYLE}]Describing {len(image_paths)} images "
+                      f"({BATCH_CONCURRENCY} requests at a time)...[/{INFO_STYLE}]")
+
+        async def describe_one(index: int, path: str):
+            try:
+                result = await describe_image_file(path, [], executor, request_limit, quiet=True)
+            except Exception as e:
+                result = {"status": "error", "message": str(e)}
+            return index, path, result
+
+        tasks = [asyncio.create_task(describe_one(index, path)) for index, path in enumerate(image_paths)]
+        results: List[Dict[str, Any]] = [{}] * len(image_paths)
+        cached = 0
+        try:
+            for completed, next_result in enumerate(asyncio.as_completed(tasks), 1):
+                index, path, result = await next_result
+                if result.get("status") == "success":
+                    description = result["description"] or ""
+                    cached += bool(result.get("cached"))
+                    if len(description) > BATCH_DESCRIPTION_CHARS:
+                        description = description[:BATCH_DESCRIPTION_CHARS] + "..."
+                    results[index] = {"path": path, "description": description}
+                    console.print(f"[{INFO_STYLE}][{completed}/{len(image_paths)}] {path}[/{INFO_STYLE}]")
+                    console.print(description)
+                else:
+                    results[index] = {"path": path, "error": result.get("message", "Unknown error")}
+                    console.print(f"[{WARNING_STYLE}][{completed}/{len(image_paths)}] {path}: "
+                                  f"{results[index]['error']}[/{WARNING_STYLE}]")
+        finally:
+            # Stop the remaining requests if the batch itself was cancelled
+            for task in tasks:
+                task.cancel()
+
+        described = sum(1 for result in results if "description" in result)
+        aggregated = {
+            "status": "success" if described else "error",
+            "described": described,
+            "failed": len(results) - described,
+            "cached": cached,
+            "images": results
         }
-        conversation_history.append(simplified_user_msg)
-        
-        # Add the assistant's response to the conversation history
-        conversation_history.append({
-            "role": "assistant",
-            "content": description
-        })
-        
-        return {"status": "success", "description": description}
+        if expanded["not_found"]:
+            aggregated["not_found"] = expanded["not_found"]
+        if skipped:
+            aggregated["skipped"] = len(skipped)
+            aggregated["message"] = f"Only the first {BATCH_MAX_IMAGES} images were described; {len(skipped)} were skipped."
+        return aggregated
 
     except Exception as e:
-        console.print(f"[{ERROR_STYLE}]Error in vision processing: {str(e)}[/{ERROR_STYLE}]")
+        console.print(f"[{ERROR_STYLE}]Error in batch vision processing: {str(e)}[/{ERROR_STYLE}]")
         return {"status": "error", "message": f"An error occurred: {str(e)}"}
 
 # Map tool names to their implementations
@@ -545,23 +1825,571 @@ TOOL_MAP = {
     "create_file": create_file,
     "replace_text": replace_text,
     "insert_line": insert_line,
+    "apply_edits": apply_edits,
     "execute_command": execute_command,
+    "read_command_output": read_command_output,
     "view_file": view_file,
-    "describe_image": describe_image
+    "describe_image": describe_image,
+    "describe_images": describe_images
 }
 
-def execute_tool_call(tool_call) -> str:
-    """Execute a tool call and return the result as a string."""
+def get_tool_path_key(args: Dict[str, Any]) -> Optional[str]:
+    """Return the normalized path a tool call operates on, or None if it has no path argument.
+
+    The path is resolved with find_file as the tools resolve it, so util.py and
+    src/pkg/util.py share a lock when both name the same file.
+    """
+    for arg_name in TOOL_PATH_ARGUMENTS:
+        if isinstance(args.get(arg_name), str):
+            file_result = find_file(args[arg_name])
+            path = file_result["file_path"] if file_result["status"] == "found" else args[arg_name]
+            return os.path.normcase(os.path.realpath(path))
+    return None
+
+async def invoke_tool(tool_function, args: Dict[str, Any]) -> Dict[str, Any]:
+    """Await async tools directly and run blocking ones on the tool executor."""
+    if asyncio.iscoroutinefunction(tool_function):
+        return await tool_function(**args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(tool_executor, functools.partial(tool_function, **args))
+
+async def run_tool_call(tool_call, path_locks: Dict[str, asyncio.Lock]) -> Dict[str, Any]:
+    """Run a single tool call on the tool executor, serialized with other calls on the same path."""
+    tool_name = tool_call["function"]["name"]
+    if tool_name not in TOOL_MAP:
+        return {"status": "error", "message": f"Unknown tool: {tool_name}"}
+
+    args = json.loads(tool_call["function"]["arguments"] or "{}")
+    # Resolved before the first await, so calls on one path queue for its lock in order
+    path_key = get_tool_path_key(args)
+    lock = path_locks.setdefault(path_key, asyncio.Lock()) if path_key else None
+
+    if lock is None:
+        return await invoke_tool(TOOL_MAP[tool_name], args)
+    # asyncio.Lock wakes waiters in FIFO order, so calls on one path keep their original order
+    async with lock:
+        return await invoke_tool(TOOL_MAP[tool_name], args)
+
+async def execute_tool_calls(
+    tool_calls: List[Dict[str, Any]],
+    path_locks: Optional[Dict[str, asyncio.Lock]] = None,
+    started: Optional[Dict[int, asyncio.Task]] = None
+) -> List[Any]:
+    """Execute tool calls concurrently and return their results in the original order.
+
+    Each entry is either the tool's result dict or the exception it raised. Calls on
+    the same file run one after another, and tools in EXCLUSIVE_TOOLS wait for every
+    earlier call to finish and block later ones until they are done. Tasks in
+    `started` (keyed by position) were launched speculatively and are reused as-is.
+    """
+    results: List[Any] = [None] * len(tool_calls)
+    path_locks = path_locks if path_locks is not None else {}
+    started = started or {}
+    pending = {}
+
+    async def drain_pending():
+        if pending:
+            outcomes = await asyncio.gather(*pending.values(), return_exceptions=True)
+            for index, outcome in zip(pending.keys(), outcomes):
+                results[index] = outcome
+            pending.clear()
+
+    for index, tool_call in enumerate(tool_calls):
+        if index in started:
+            pending[index] = started[index]
+        elif tool_call["function"]["name"] in EXCLUSIVE_TOOLS:
+            await drain_pending()
+            try:
+                results[index] = await run_tool_call(tool_call, path_locks)
+            except Exception as e:
+                results[index] = e
+        else:
+            pending[index] = asyncio.create_task(run_tool_call(tool_call, path_locks))
+
+    await drain_pending()
+    return results
+
+class JsonCompletenessDetector:
+    """Incrementally detects when a streamed JSON object has been closed.
+
+    Fragments are scanned once as they arrive, tracking nesting depth and string
+    state, so checking completeness after every delta stays linear in total length.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.complete = False
+        self.invalid = False
+
+    def feed(self, fragment: str) -> bool:
+        """Consume the next fragment and return True once the top-level object is closed."""
+        for char in fragment:
+            if self.invalid:
+                break
+            if self.complete:
+                # Anything but whitespace after the closing brace is not a single object
+                if not char.isspace():
+                    self.complete = False
+                    self.invalid = True
+                continue
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                self.started = True
+            elif char in "}]":
+                self.depth -= 1
+                if self.started and self.depth == 0:
+                    self.complete = True
+        return self.complete
+
+class ToolCallSpeculator:
+    """Starts read-only tool calls while the rest of the tool-call stream is still arriving.
+
+    A call in SPECULATIVE_TOOLS is started as soon as its arguments form a complete JSON
+    object, provided every call before it is in READ_ONLY_TOOLS (so no earlier edit can
+    change what it reads). Mutating tools and batch tools still wait for the end of
+    the stream.
+    """
+
+    def __init__(self):
+        self.path_locks: Dict[str, asyncio.Lock] = {}
+        self.detectors: Dict[int, JsonCompletenessDetector] = {}
+        self.tasks: Dict[int, Any] = {}  # index -> (arguments, task)
+
+    def observe(self, tool_calls: List[Dict[str, Any]], index: int, fragment: str):
+        """Feed an argument fragment for `index` and start the call if it is ready."""
+        detector = self.detectors.setdefault(index, JsonCompletenessDetector())
+        if not detector.feed(fragment) or index in self.tasks:
+            return
+
+        if not (tool_calls[index] and tool_calls[index]["function"]["name"] in SPECULATIVE_TOOLS):
+            return
+        if not all(call and call["function"]["name"] in READ_ONLY_TOOLS for call in tool_calls[:index]):
+            return
+
+        try:
+            arguments = json.loads(tool_calls[index]["function"]["arguments"])
+        except json.JSONDecodeError:
+            return
+        snapshot = {
+            "id": tool_calls[index]["id"],
+            "type": "function",
+            "function": {"name": tool_calls[index]["function"]["name"], "arguments": json.dumps(arguments)}
+        }
+        self.tasks[index] = (arguments, asyncio.create_task(run_tool_call(snapshot, self.path_locks)))
+
+    def take_started(self, tool_calls: List[Dict[str, Any]]) -> Dict[int, asyncio.Task]:
+        """Return speculative tasks whose arguments match the final tool calls; discard the rest."""
+        started = {}
+        for index, (arguments, task) in self.tasks.items():
+            try:
+                final_call = tool_calls[index]
+                final_arguments = json.loads(final_call["function"]["arguments"] or "{}")
+            except (IndexError, KeyError, json.JSONDecodeError):
+                final_call, final_arguments = None, None
+            if final_call and final_call["function"]["name"] in SPECULATIVE_TOOLS and final_arguments == arguments:
+                started[index] = task
+            else:
+                task.cancel()
+        self.tasks.clear()
+        return started
+
+    def cancel_pending(self):
+        """Cancel speculative tasks that were never handed over (e.g. the stream failed)."""
+        for _, task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+
+def fetch_model_context_length(model_name: str) -> Optional[int]:
+    """Ask LM Studio's REST API for the context length the model was loaded with."""
+    api_root = backend_pool.pick().base_url.rsplit("/v1", 1)[0]
     try:
-        tool_name = tool_call["function"]["name"]
-        if tool_name not in TOOL_MAP:
-            return json.dumps({"status": "error", "message": f"Unknown tool: {tool_name}"})
-        
-        args = json.loads(tool_call["function"]["arguments"])
-        result = TOOL_MAP[tool_name](**args)
-        return json.dumps(result)
-    except Exception as e:
-        return json.dumps({"status": "error", "message": f"Error executing tool: {str(e)}"})
+        with urllib.request.urlopen(f"{api_root}/api/v0/models/{model_name}", timeout=5) as response:
+            info = json.loads(response.read().decode("utf-8"))
+        return info.get("loaded_context_length") or info.get("max_context_length")
+    except Exception:
+        return None
+
+class HistoryManager:
+    """Keeps the conversation history inside a token budget.
+
+    Token counts are estimated per message from its serialized length and cached by
+    message identity for the messages of the latest request, and the estimate is
+    recalibrated from the usage LM Studio reports. Trimming drops whole turns (a user
+    message with every assistant reply, tool call and tool result that follows it),
+    so tool messages are never orphaned.
+
+    Compaction happens rarely and in large chunks: the history only shrinks once it
+    overflows the budget, and then down to HISTORY_COMPACTION_TARGET of it. Between
+    compactions the prompt only grows at the end, so LM Studio's prompt cache can
+    reuse the whole previous prefix.
+    """
+
+    def __init__(self):
+        self.context_length = HISTORY_CONTEXT_LENGTH_DEFAULT
+        self.token_scale = 1.0  # Reported prompt tokens per estimated token
+        self.token_cache: Dict[int, Any] = {}  # id(message) -> (message, estimated tokens)
+        self.tools_tokens = int(len(json.dumps(TOOLS)) / HISTORY_CHARS_PER_TOKEN)
+        self.last_raw_estimate = 0
+        self.last_usage = None
+        self.last_request_messages: List[Dict[str, Any]] = []
+        self.last_prefix_ratio = 0.0
+        self.compactions = 0
+
+    def message_tokens(self, message: Dict[str, Any]) -> int:
+        """Return the cached, unscaled token estimate for a message."""
+        cached = self.token_cache.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        tokens = int(len(json.dumps(message)) / HISTORY_CHARS_PER_TOKEN) + HISTORY_MESSAGE_OVERHEAD
+        self.token_cache[id(message)] = (message, tokens)
+        return tokens
+
+    def estimate_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        """Estimate the tokens for a list of messages, scaled by observed usage."""
+        return int(sum(self.message_tokens(message) for message in messages) * self.token_scale)
+
+    def budget(self, system_message: Dict[str, Any], max_tokens: int) -> int:
+        """Return the token budget available to the conversation history."""
+        if HISTORY_MAX_TOKENS is not None:
+            return HISTORY_MAX_TOKENS
+        fixed = self.estimate_tokens([system_message]) + int(self.tools_tokens * self.token_scale)
+        return max(0, self.context_length - max_tokens - fixed - HISTORY_SAFETY_MARGIN)
+
+    @staticmethod
+    def group_turns(history: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """Split the history into turns, each starting at a user message."""
+        turns = []
+        for message in history:
+            if message.get("role") == "user" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        # Tool results without their assistant tool call cannot be sent; drop a headless first turn
+        if turns and turns[0][0].get("role") == "tool":
+            turns.pop(0)
+        return turns
+
+    def split_for_compaction(self, history: List[Dict[str, Any]], budget: int):
+        """Split the history into the oldest turns to drop and the newest turns to keep.
+
+        The kept turns fit in HISTORY_COMPACTION_TARGET of the budget, except that the
+        latest turn is always kept, even if it alone exceeds it.
+        """
+        turns = self.group_turns(history)
+        turn_tokens = [self.estimate_tokens(turn) for turn in turns]
+        total = sum(turn_tokens)
+        target = int(budget * HISTORY_COMPACTION_TARGET)
+        first_kept = 0
+        while total > target and first_kept < len(turns) - 1:
+            total -= turn_tokens[first_kept]
+            first_kept += 1
+        return turns[:first_kept], turns[first_kept:]
+
+    def fit(self, history: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+        """Return the history unchanged if it fits the budget, otherwise compact it."""
+        turns = self.group_turns(history)
+        if sum(self.estimate_tokens(turn) for turn in turns) <= budget:
+            return [message for turn in turns for message in turn]
+
+        _, kept_turns = self.split_for_compaction(history, budget)
+        self.compactions += 1
+        kept = [message for turn in kept_turns for message in turn]
+        self.prune_cache(kept)
+        return kept
+
+    def prune_cache(self, history: List[Dict[str, Any]]):
+        """Forget cached counts for messages that are no longer in the history."""
+        live_ids = {id(message) for message in history}
+        self.token_cache = {key: value for key, value in self.token_cache.items() if key in live_ids}
+
+    def record_request(self, messages: List[Dict[str, Any]]):
+        """Remember the estimate and prompt prefix reuse for a request about to be sent."""
+        message_tokens = [self.message_tokens(message) for message in messages]
+        self.last_raw_estimate = sum(message_tokens) + self.tools_tokens
+        # Counts for messages outside this request, such as earlier system messages, are not needed again
+        self.prune_cache(messages)
+
+        # Count the leading messages that are identical to the previous request
+        reused = 0
+        for index, (previous, current) in enumerate(zip(self.last_request_messages, messages)):
+            if previous is not current and previous != current:
+                break
+            reused += message_tokens[index]
+        if reused:
+            reused += self.tools_tokens  # Tools are rendered next to the unchanged system prompt
+        self.last_prefix_ratio = reused / self.last_raw_estimate if self.last_raw_estimate else 0.0
+        self.last_request_messages = list(messages)
+
+    def record_usage(self, usage) -> None:
+        """Remember reported usage and move the token scale towards the observed ratio."""
+        self.last_usage = usage
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        if prompt_tokens and self.last_raw_estimate:
+            observed_scale = prompt_tokens / self.last_raw_estimate
+            self.token_scale = min(3.0, max(0.5, 0.5 * self.token_scale + 0.5 * observed_scale))
+
+history_manager = HistoryManager()
+
+def prepare_history(system_message: Dict[str, Any], max_tokens: int) -> List[Dict[str, Any]]:
+    """Trim the conversation history to its token budget and return the request messages."""
+    global conversation_history
+    budget = history_manager.budget(system_message, max_tokens)
+    trimmed = history_manager.fit(conversation_history, budget)
+    if len(trimmed) != len(conversation_history):
+        kept_ids = {id(message) for message in trimmed}
+        dropped = [message for message in conversation_history if id(message) not in kept_ids]
+        # Kept references to dropped view_file results get that content back
+        conversation_history = file_content_cache.expand_views(trimmed, dropped)
+        console.print(f"[{WARNING_STYLE}]Conversation history compacted: dropped {len(dropped)} older messages to stay within {budget:,} tokens.[/{WARNING_STYLE}]")
+    messages = [system_message] + conversation_history
+    history_manager.record_request(messages)
+    return messages
+
+class HistorySummarizer:
+    """Folds the oldest turns into a running summary while the user is typing.
+
+    It only runs once the history is close to its budget, i.e. when a compaction is
+    coming anyway, and replaces the turns that compaction would drop with a summary
+    turn. The new summary also absorbs the previous one. Nothing is applied unless
+    the request completes, so cancelling it when a prompt arrives leaves the
+    history untouched.
+    """
+
+    def __init__(self):
+        self.summaries_applied = 0
+        self.cancelled_runs = 0
+
+    @staticmethod
+    def render_transcript(turns: List[List[Dict[str, Any]]]) -> str:
+        """Render turns as plain text, shortening long messages such as tool results."""
+        lines = []
+        for turn in turns:
+            for message in turn:
+                content = message.get("content")
+                if message.get("tool_calls"):
+                    calls = ", ".join(
+                        f"{call['function']['name']}({call['function']['arguments']})"
+                        for call in message["tool_calls"] if call
+                    )
+                    content = f"[called tools: {calls}]"
+                if not isinstance(content, str):
+                    content = json.dumps(content)
+                if len(content) > SUMMARY_MESSAGE_CHARS:
+                    content = content[:SUMMARY_MESSAGE_CHARS] + " ...[truncated]"
+                lines.append(f"{message.get('role', 'unknown')}: {content}")
+        return "\n\n".join(lines)
+
+    async def summarize(self, model_name: str, turns: List[List[Dict[str, Any]]]) -> str:
+        """Ask the local model for a summary of the given turns."""
+        stream = await backend_pool.create(
+            model=model_name,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Summarize the conversation below for your own future reference. Keep decisions, "
+                               "facts, file paths, file contents that matter and open tasks. Be concise."
+                },
+                {"role": "user", "content": self.render_transcript(turns)}
+            ],
+            stream=True,
+            temperature=API_TEMPERATURE,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            timeout=API_TIMEOUT_FOLLOWUP
+        )
+        summary = ""
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                summary += chunk.choices[0].delta.content
+        return summary.strip()
+
+    async def run_when_idle(self, model_name: str, system_message: Dict[str, Any]):
+        """Summarize the oldest turns if the history is close to its budget."""
+        global conversation_history
+        try:
+            await asyncio.sleep(SUMMARY_IDLE_DELAY)
+            history = conversation_history
+            history_length = len(history)
+            budget = history_manager.budget(system_message, API_MAX_TOKENS_INITIAL)
+            if history_manager.estimate_tokens(history) <= budget * SUMMARY_TRIGGER:
+                return
+
+            old_turns, kept_turns = history_manager.split_for_compaction(history, budget)
+            if not old_turns:
+                return
+            summary = await self.summarize(model_name, old_turns)
+
+            # Only apply the summary if the history did not change underneath us
+            if not summary or conversation_history is not history or len(history) != history_length:
+                return
+            kept = file_content_cache.expand_views(
+                [message for turn in kept_turns for message in turn],
+                [message for turn in old_turns for message in turn]
+            )
+            conversation_history = [
+                {"role": "user", "content": SUMMARY_PREFIX + summary},
+                {"role": "assistant", "content": SUMMARY_ACKNOWLEDGEMENT}
+            ] + kept
+            history_manager.prune_cache(conversation_history)
+            history_manager.compactions += 1
+            self.summaries_applied += 1
+        except asyncio.CancelledError:
+            self.cancelled_runs += 1
+            raise
+        except Exception:
+            # Summarization is best-effort; the regular compaction still applies
+            pass
+
+history_summarizer = HistorySummarizer()
+
+class ResponseCache:
+    """SQLite cache of streamed chat completions.
+
+    A request is keyed on a canonical hash of the parameters in RESPONSE_CACHE_KEY_PARAMS
+    (model id, messages, tools and sampling settings). The complete list of chunks of a
+    finished stream is stored as JSON and replayed as ChatCompletionChunk objects, tool
+    call deltas and the usage chunk included. Entries expire after `ttl` seconds and the
+    least recently used ones are evicted once the stored chunks exceed `max_bytes`.
+    """
+
+    def __init__(self, path: str, ttl: float, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(request: Dict[str, Any]) -> str:
+        """Return the cache key for the keyword arguments of a chat completion request."""
+        relevant = {name: request.get(name) for name in RESPONSE_CACHE_KEY_PARAMS}
+        canonical = json.dumps(relevant, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, chunks TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        """Return the stored chunks for a key, or None if missing or expired."""
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute("SELECT chunks, created FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            connection.commit()
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, chunks: List[Dict[str, Any]]) -> None:
+        """Store the chunks of a finished stream, then drop expired and excess entries."""
+        data = json.dumps(chunks, separators=(",", ":"))
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, chunks, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now)
+            )
+            connection.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                stale = []
+                for old_key, size in connection.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((old_key,))
+                    total -= size
+                connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+            connection.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES)
+
+async def replay_chunks(chunks: List[Dict[str, Any]]) -> AsyncGenerator[ChatCompletionChunk, None]:
+    """Yield stored chunks as the same objects a live stream produces.
+
+    The usage chunk is marked as replayed, so report_usage does not count it again.
+    """
+    for chunk in chunks:
+        if chunk.get("usage"):
+            chunk = dict(chunk, usage=dict(chunk["usage"], replayed=True))
+        yield ChatCompletionChunk.model_validate(chunk)
+
+async def record_chunks(stream, key: str) -> AsyncGenerator[Any, None]:
+    """Pass a live stream through and store it once it has been read to the end."""
+    chunks = []
+    async for chunk in stream:
+        chunks.append(chunk.model_dump(mode="json", exclude_unset=True))
+        yield chunk
+    # Streams that were interrupted or raised never reach this point and are not stored
+    try:
+        await asyncio.to_thread(response_cache.put, key, chunks)
+    except sqlite3.Error as e:
+        console.print(f"[{WARNING_STYLE}]Could not write response cache: {str(e)}[/{WARNING_STYLE}]")
+
+async def create_chat_completion(label: str = "Chat", **request):
+    """Call chat.completions.create with retries, serving streamed requests from the response cache when enabled.
+
+    Only opening the request is retried; a stream that fails part way is not sent again.
+    """
+    if not (RESPONSE_CACHE_ENABLED and request.get("stream")):
+        return await request_retrier.call(label, backend_pool.create, **request)
+
+    key = ResponseCache.make_key(request)
+    try:
+        chunks = await asyncio.to_thread(response_cache.get, key)
+    except sqlite3.Error as e:
+        console.print(f"[{WARNING_STYLE}]Could not read response cache: {str(e)}[/{WARNING_STYLE}]")
+        chunks = None
+    if chunks is not None:
+        return replay_chunks(chunks)
+    stream = await request_retrier.call(label, backend_pool.create, **request)
+    return record_chunks(stream, key)
+
+def report_usage(usage, label: str) -> None:
+    """Print the tokens a request actually used and feed them back into the estimate."""
+    if usage is None:
+        return
+    if getattr(usage, "replayed", False):
+        # Replayed usage was counted when the response was recorded and says nothing about this prompt
+        console.print(f"[dim]{label} replayed from the response cache[/dim]")
+        return
+    estimate = int(history_manager.last_raw_estimate * history_manager.token_scale)
+    history_manager.record_usage(usage)
+    console.print(
+        f"[dim]{label} tokens: prompt {usage.prompt_tokens:,} (estimated {estimate:,}) | "
+        f"completion {usage.completion_tokens:,} | context {history_manager.context_length:,} | "
+        f"prefix reuse ~{history_manager.last_prefix_ratio:.0%}[/dim]"
+    )
 
 def create_lm_agent() -> Agent:
     """Creates an LM Studio agent using the default model from LM Studio."""
@@ -575,9 +2403,12 @@ def create_lm_agent() -> Agent:
       - `create_file`: Create new files with specified content. Default to the current working directory.   
       - `replace_text`: Replace text within existing files. 
       - `insert_line`: Insert a line at a specific position in a file. 
+      - `apply_edits`: Apply several replacements and insertions to one file at once. Prefer it over repeated `replace_text`/`insert_line` calls on the same file.
       - `view_file`: Display the contents of a file. 
       - `execute_command`: Execute system commands. 
+      - `read_command_output`: Page through the full output of a command whose result was truncated.
       - `describe_image`: Describe the image in detail.
+      - `describe_images`: Describe several images (files, directories or glob patterns) in one call. Prefer it over repeated `describe_image` calls.
     - Always use the appropriate tool for the requested task.
     - Provide clear and concise explanations of what you're doing and why when using tools.
 
@@ -626,19 +2457,15 @@ def create_lm_agent() -> Agent:
 
 async def run_lm_agent(prompt: str, agent: Agent, model_name: str) -> AsyncGenerator[str, None]:
     """Streams an LM response for the given prompt using the provided agent."""
-    global conversation_history
-    
     conversation_history.append({"role": "user", "content": prompt})
     
-    if len(conversation_history) > 50:
-        conversation_history = conversation_history[-50:]
-        console.print(f"[{WARNING_STYLE}]Conversation history trimmed to prevent token limit issues.[/{WARNING_STYLE}]")
-    
     system_message = {"role": "system", "content": agent.instructions}
-    messages = [system_message] + conversation_history
+    messages = prepare_history(system_message, API_MAX_TOKENS_INITIAL)
+    speculator = None
     
     try:
-        stream = await openai_client.chat.completions.create(
+        stream = await create_chat_completion(
+            "Initial",
             model=model_name,
             messages=messages,
             stream=True,
@@ -651,13 +2478,21 @@ async def run_lm_agent(prompt: str, agent: Agent, model_name: str) -> AsyncGener
             frequency_penalty=API_FREQUENCY_PENALTY,
             presence_penalty=API_PRESENCE_PENALTY,
             n=API_N,
-            parallel_tool_calls=API_PARALLEL_TOOL_CALLS
+            parallel_tool_calls=API_PARALLEL_TOOL_CALLS,
+            stream_options=API_STREAM_OPTIONS
         )
         
         assistant_response = ""
         tool_calls = []
+        speculator = ToolCallSpeculator()
+        usage = None
         
         async for chunk in stream:
+            # The usage chunk at the end of the stream carries no choices
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
             if chunk.choices[0].delta.content:
                 content = chunk.choices[0].delta.content
                 assistant_response += content
@@ -679,6 +2514,10 @@ async def run_lm_agent(prompt: str, agent: Agent, model_name: str) -> AsyncGener
                         tool_calls[tool_call_delta.index]["function"]["name"] = tool_call_delta.function.name
                     if tool_call_delta.function.arguments:
                         tool_calls[tool_call_delta.index]["function"]["arguments"] += tool_call_delta.function.arguments
+                        # Start read-only tools as soon as their arguments are complete
+                        speculator.observe(tool_calls, tool_call_delta.index, tool_call_delta.function.arguments)
+        
+        report_usage(usage, "Request")
         
         if assistant_response:
             conversation_history.append({"role": "assistant", "content": assistant_response})
@@ -690,45 +2529,64 @@ async def run_lm_agent(prompt: str, agent: Agent, model_name: str) -> AsyncGener
                 "tool_calls": tool_calls
             })
             
-            for tool_call in tool_calls:
-                if tool_call.get("function", {}).get("name"):
-                    # Always show a minimal notification that a tool is being used
-                    yield f"\n[Using {tool_call['function']['name']}...]\n"
+            runnable_calls = [tool_call for tool_call in tool_calls if tool_call.get("function", {}).get("name")]
+            for tool_call in runnable_calls:
+                # Always show a minimal notification that a tool is being used
+                yield f"\n[Using {tool_call['function']['name']}...]\n"
+
+            # Reuse speculative results only if no tool call was dropped in between
+            started = speculator.take_started(tool_calls) if len(runnable_calls) == len(tool_calls) else {}
+            speculator.cancel_pending()
+
+            # Run the tool calls concurrently; results come back in the original order
+            results = await execute_tool_calls(runnable_calls, speculator.path_locks, started)
+
+            for tool_call, result in zip(runnable_calls, results):
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+
+                    # Special handling for image description - display the result to the user
+                    if tool_call["function"]["name"] == "describe_image":
+                        if result.get("status") == "success":
+                            yield f"\n{result['description']}\n"
+                        elif result.get("status") == "path_needed":
+                            # When image is not found, display message to user asking for the exact path
+                            if "suggestions" in result:
+                                suggestions_str = ", ".join(result["suggestions"])
+                                yield f"\nImage file not found. Did you mean one of: {suggestions_str}?\nPlease provide the exact path to the image.\n"
+                            else:
+                                yield f"\n{result['message']}\n"
+                    elif tool_call["function"]["name"] == "view_file":
+                        # Send an unchanged file only once while its earlier result is still in the window
+                        result = file_content_cache.dedupe_view(tool_call["id"], result, conversation_history)
+                    elif tool_call["function"]["name"] == "describe_images":
+                        # Individual descriptions were already printed as they completed
+                        if "described" in result:
+                            yield (f"\nDescribed {result['described']} of {len(result['images'])} images "
+                                   f"({result['cached']} cached, {result['failed']} failed)\n")
+                        elif result.get("status") == "path_needed":
+                            yield f"\n{result['message']}\n"
                     
-                    try:
-                        args = json.loads(tool_call["function"]["arguments"])
-                        result = TOOL_MAP[tool_call["function"]["name"]](**args)
-                        
-                        # Special handling for image description - display the result to the user
-                        if tool_call["function"]["name"] == "describe_image":
-                            if result.get("status") == "success":
-                                yield f"\n{result['description']}\n"
-                            elif result.get("status") == "path_needed":
-                                # When image is not found, display message to user asking for the exact path
-                                if "suggestions" in result:
-                                    suggestions_str = ", ".join(result["suggestions"])
-                                    yield f"\nImage file not found. Did you mean one of: {suggestions_str}?\nPlease provide the exact path to the image.\n"
-                                else:
-                                    yield f"\n{result['message']}\n"
-                        
-                        tool_response = {
-                            "role": "tool",
-                            "tool_call_id": tool_call["id"],
-                            "content": json.dumps(result)
-                        }
-                        conversation_history.append(tool_response)
-                        
-                    except Exception as e:
-                        conversation_history.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call["id"],
-                            "content": json.dumps({"status": "error", "message": str(e)})
-                        })
-                        yield f"\nError executing tool: {str(e)}\n"
+                    tool_response = {
+                        "role": "tool",
+                        "tool_call_id": tool_call["id"],
+                        "content": json.dumps(result)
+                    }
+                    conversation_history.append(tool_response)
+                    
+                except Exception as e:
+                    conversation_history.append({
+                        "role": "tool",
+                        "tool_call_id": tool_call["id"],
+                        "content": json.dumps({"status": "error", "message": str(e)})
+                    })
+                    yield f"\nError executing tool: {str(e)}\n"
             
-            follow_up_stream = await openai_client.chat.completions.create(
+            follow_up_stream = await create_chat_completion(
+                "Follow-up",
                 model=model_name,
-                messages=[system_message] + conversation_history,
+                messages=prepare_history(system_message, API_MAX_TOKENS_FOLLOWUP),
                 stream=True,
                 temperature=API_TEMPERATURE,
                 max_tokens=API_MAX_TOKENS_FOLLOWUP,
@@ -739,15 +2597,22 @@ async def run_lm_agent(prompt: str, agent: Agent, model_name: str) -> AsyncGener
                 frequency_penalty=API_FREQUENCY_PENALTY,
                 presence_penalty=API_PRESENCE_PENALTY,
                 n=API_N,
-                parallel_tool_calls=API_PARALLEL_TOOL_CALLS
+                parallel_tool_calls=API_PARALLEL_TOOL_CALLS,
+                stream_options=API_STREAM_OPTIONS
             )
             
             follow_up_response = ""
+            follow_up_usage = None
             async for chunk in follow_up_stream:
+                if getattr(chunk, "usage", None):
+                    follow_up_usage = chunk.usage
+                if not chunk.choices:
+                    continue
                 if chunk.choices[0].delta.content:
                     content = chunk.choices[0].delta.content
                     follow_up_response += content
                     yield content
+            report_usage(follow_up_usage, "Follow-up")
             
             if follow_up_response:
                 conversation_history.append({"role": "assistant", "content": follow_up_response})
@@ -755,9 +2620,41 @@ async def run_lm_agent(prompt: str, agent: Agent, model_name: str) -> AsyncGener
     except RateLimitError as e:
         console.print(f"[{ERROR_STYLE}]Rate limit exceeded: {str(e)}[/{ERROR_STYLE}]")
         yield "Rate limit exceeded. Please wait a moment before trying again."
+    except CircuitOpenError as e:
+        console.print(f"[{ERROR_STYLE}]{str(e)}[/{ERROR_STYLE}]")
+        yield f"{str(e)}. Please check that LM Studio is running."
     except Exception as e:
         console.print(f"[{ERROR_STYLE}]Error in API call: {str(e)}[/{ERROR_STYLE}]")
         yield f"Error: {str(e)}"
+    finally:
+        if speculator is not None:
+            speculator.cancel_pending()
+
+def display_session_stats():
+    """Print statistics collected during this session."""
+    cache_lookups = image_description_cache.hits + image_description_cache.misses
+    hit_rate = f" ({image_description_cache.hits / cache_lookups:.0%} hit rate)" if cache_lookups else ""
+    console.print(Panel(
+        f"[{SYSTEM_STYLE}]History:[/{SYSTEM_STYLE}] [{INFO_STYLE}]{len(conversation_history)} messages, "
+        f"~{history_manager.estimate_tokens(conversation_history):,} tokens, "
+        f"{history_manager.compactions} compactions, {history_summarizer.summaries_applied} summaries[/{INFO_STYLE}]\n"
+        f"[{SYSTEM_STYLE}]Prompt cache:[/{SYSTEM_STYLE}] [{INFO_STYLE}]last prefix reuse ~{history_manager.last_prefix_ratio:.0%}[/{INFO_STYLE}]\n"
+        f"[{SYSTEM_STYLE}]Image cache:[/{SYSTEM_STYLE}] [{INFO_STYLE}]{image_description_cache.hits} hits, "
+        f"{image_description_cache.misses} misses{hit_rate}[/{INFO_STYLE}]\n"
+        f"[{SYSTEM_STYLE}]File cache:[/{SYSTEM_STYLE}] [{INFO_STYLE}]{file_content_cache.hits} hits, "
+        f"{file_content_cache.misses} misses, {file_content_cache.deduplicated} repeated views skipped[/{INFO_STYLE}]\n"
+        f"[{SYSTEM_STYLE}]File index:[/{SYSTEM_STYLE}] [{INFO_STYLE}]"
+        + (f"{file_index.file_count:,} files{' (truncated)' if file_index.truncated else ''}, "
+           f"{'watching' if file_index.watching else 'polling'}" if file_index.ready.is_set() else "building")
+        + f"[/{INFO_STYLE}]\n"
+        f"[{SYSTEM_STYLE}]Response cache:[/{SYSTEM_STYLE}] [{INFO_STYLE}]"
+        + (f"{response_cache.hits} hits, {response_cache.misses} misses" if RESPONSE_CACHE_ENABLED else "off")
+        + f"[/{INFO_STYLE}]\n"
+        f"[{SYSTEM_STYLE}]Backends:[/{SYSTEM_STYLE}] [{INFO_STYLE}]{backend_pool.describe()}[/{INFO_STYLE}]\n"
+        f"[{SYSTEM_STYLE}]Retries:[/{SYSTEM_STYLE}] [{INFO_STYLE}]{request_retrier.describe()}[/{INFO_STYLE}]",
+        title="Session Stats",
+        border_style="blue"
+    ))
 
 async def generate_response(prompt: str, agent: Agent, model_name: str):
     """Generates a full response while showing the thinking indicator."""
@@ -797,11 +2694,12 @@ async def generate_response(prompt: str, agent: Agent, model_name: str):
 
 async def main():
     """Runs the interactive LM Studio agent in a streaming conversation loop."""
-    global conversation_history
+    global conversation_history, active_model_id
     
     # Define available commands
     COMMANDS = {
         "help": "Display this list of available commands",
+        "stats": "Show session statistics (history, prompt cache reuse, image cache)",
         "clear or reset": "Clear the conversation history",
         "save": "Save the current conversation to conversation_history.json",
         "load": "Load a previously saved conversation from conversation_history.json",
@@ -813,14 +2711,23 @@ async def main():
     
     try:
         try:
-            response = await openai_client.models.list()
+            # Find the reachable endpoints before the first request is routed
+            await backend_pool.check_health()
+            backend_pool.start()
+            response = await backend_pool.pick().client.models.list()
             if not response.data:
                 console.print(Panel(f"[{ERROR_STYLE}]Error: No models available in LM Studio[/{ERROR_STYLE}]"))
                 console.print(f"[{WARNING_STYLE}]Please ensure you have at least one model loaded in LM Studio[/{WARNING_STYLE}]")
                 sys.exit(1)
                 
             model_name = response.data[0].id
+            active_model_id = model_name
             agent = create_lm_agent()
+            if FILE_INDEX_ENABLED:
+                file_index.start()
+            history_manager.context_length = (
+                await asyncio.to_thread(fetch_model_context_length, model_name) or HISTORY_CONTEXT_LENGTH_DEFAULT
+            )
             
             console.print(Panel(
                 f"[{SYSTEM_STYLE}]LM Studio:[/{SYSTEM_STYLE}] [{INFO_STYLE}]Connected[/{INFO_STYLE}]\n"
@@ -830,7 +2737,8 @@ async def main():
                 f"Max Tokens: {API_MAX_TOKENS_INITIAL}/{API_MAX_TOKENS_FOLLOWUP}, " +
                 f"Top-p: {API_TOP_P}, " +
                 f"Freq Penalty: {API_FREQUENCY_PENALTY}, " +
-                f"Pres Penalty: {API_PRESENCE_PENALTY}[/{INFO_STYLE}]",
+                f"Pres Penalty: {API_PRESENCE_PENALTY}, " +
+                f"Context: {history_manager.context_length:,} tokens[/{INFO_STYLE}]",
                 border_style="green"
             ))
             
@@ -849,13 +2757,23 @@ async def main():
                 f"[{ERROR_STYLE}]Error: {str(e)}[/{ERROR_STYLE}]",
                 border_style="red"
             ))
-            console.print(f"[{WARNING_STYLE}]Please make sure LM Studio is running with the server enabled on port 1234[/{WARNING_STYLE}]")
+            console.print(f"[{WARNING_STYLE}]Please make sure LM Studio is running with the server enabled at {', '.join(LM_STUDIO_BASE_URLS)}[/{WARNING_STYLE}]")
             sys.exit(1)
         
         while True:
             try:
                 console.print("\n> ", end="", style=USER_STYLE)
-                user_input = await asyncio.to_thread(input, "")
+                # Use the time spent typing to summarize old turns; stop as soon as input arrives
+                summary_task = None
+                if SUMMARY_ENABLED:
+                    system_message = {"role": "system", "content": agent.instructions}
+                    summary_task = asyncio.create_task(history_summarizer.run_when_idle(model_name, system_message))
+                try:
+                    user_input = await asyncio.to_thread(input, "")
+                finally:
+                    if summary_task is not None:
+                        summary_task.cancel()
+                        await asyncio.gather(summary_task, return_exceptions=True)
                 user_input = user_input.strip()
                 
                 # Check for help command
@@ -866,6 +2784,11 @@ async def main():
                     console.print("\n[bold]Note:[/bold] For tool usage, ask the assistant directly (e.g., 'create a file')")
                     continue
                 
+                # Check for stats command
+                if user_input.lower() == "stats":
+                    display_session_stats()
+                    continue
+                
                 # Check for save command
                 if user_input.lower() == "save":
                     try:
@@ -896,6 +2819,7 @@ async def main():
                     break
                 elif user_input.lower() in ["clear", "reset"]:
                     conversation_history.clear()
+                    history_manager.prune_cache(conversation_history)
                     console.print("[bold cyan]Conversation history cleared.[/bold cyan]")
                     continue
                 
@@ -912,6 +2836,13 @@ async def main():
     except Exception as e:
         console.print(Panel(f"[{ERROR_STYLE}]Error: {str(e)}[/{ERROR_STYLE}]"))
         sys.exit(1)
+    finally:
+        # Close the pooled keep-alive connections and stop any preprocessing workers
+        await backend_pool.stop()
+        await http_client.aclose()
+        response_cache.close()
+        file_index.stop()
+        image_pipeline.shutdown_preprocess_pool()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
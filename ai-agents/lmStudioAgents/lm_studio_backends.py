@@ -0,0 +1,372 @@
+"""
+LM Studio endpoints shared by the vision agent and image_describe.py: the pooled HTTP
+client, routing across several servers, per-endpoint circuit breakers and retries.
+
+Creating the objects below opens no connections; they are made on first request.
+"""
+
+import time
+import random
+import asyncio
+import collections
+import httpx
+from typing import Any, AsyncGenerator, List, Optional
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIConnectionError, APIStatusError
+from rich.console import Console
+
+console = Console()
+
+INFO_STYLE = "bold white"
+WARNING_STYLE = "yellow"
+
+# LM Studio configuration
+LM_STUDIO_BASE_URL = "http://localhost:1234/v1"
+LM_STUDIO_BASE_URLS = [LM_STUDIO_BASE_URL]  # Servers with the same model loaded; requests go to the least-loaded healthy one
+LM_STUDIO_API_KEY = "dummy-key"
+
+# Backend pool health checks and routing
+BACKEND_HEALTH_INTERVAL = 10.0   # Seconds between health probes of every endpoint
+BACKEND_HEALTH_TIMEOUT = 3.0     # Seconds a probe may take before it counts as failed
+BACKEND_MAX_FAILURES = 2         # Consecutive failures before an endpoint is taken out of rotation
+BACKEND_TTFT_WINDOW = 20         # Recent time-to-first-token samples averaged per endpoint
+BACKEND_DEFAULT_TTFT = 1.0       # Seconds assumed while no endpoint has a sample yet
+
+# Retries and circuit breaker for chat and vision requests (these replace the client's own retries)
+RETRY_MAX_ATTEMPTS = 4                                # Attempts per request, including the first
+RETRY_BASE_DELAY = 0.5                                # Backoff ceiling before the first retry; doubles per retry
+RETRY_MAX_DELAY = 8.0                                 # Longest wait between two attempts
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}  # Responses worth another attempt
+CIRCUIT_FAILURE_THRESHOLD = 5                         # Retryable failures in a row before an endpoint's circuit opens
+CIRCUIT_RESET_TIMEOUT = 30.0                          # Seconds an endpoint's circuit stays open before a trial request
+
+# HTTP connection pool shared by every request to LM Studio (chat, follow-ups and vision)
+HTTP_MAX_CONNECTIONS = 16
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 8
+HTTP_KEEPALIVE_EXPIRY = 60.0  # Seconds an idle connection stays open for reuse
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_READ_TIMEOUT = 120.0
+
+# Keep-alive connection pool shared by the clients of every LM Studio endpoint
+http_client = DefaultAsyncHttpxClient(
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    ),
+    timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+)
+
+def make_openai_client(base_url: str) -> AsyncOpenAI:
+    """Create an AsyncOpenAI client for one LM Studio endpoint on the shared connection pool."""
+    # Retries are handled by request_retrier, and backend_pool feeds each endpoint's circuit breaker
+    return AsyncOpenAI(base_url=base_url, api_key=LM_STUDIO_API_KEY, http_client=http_client, max_retries=0)
+
+# Client of the first configured endpoint; the backend pool routes requests across all of them
+openai_client = make_openai_client(LM_STUDIO_BASE_URLS[0])
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit of every endpoint is open."""
+
+class CircuitBreaker:
+    """Stops requests to an LM Studio endpoint while it keeps failing.
+
+    After `failure_threshold` retryable failures in a row the circuit opens and
+    requests fail at once. After `reset_timeout` seconds one trial request is let
+    through (half-open); its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def allow(self) -> bool:
+        """Return whether a request may be sent now."""
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half-open"
+        if self.state == "half-open":
+            if self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+        return self.state == "closed"
+
+    def available(self) -> bool:
+        """Return whether allow() would let a request through, without claiming the trial."""
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        return not self.trial_in_flight
+
+    def retry_in(self) -> float:
+        """Return the seconds until the next trial request is allowed."""
+        return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+def is_retryable(error: BaseException) -> bool:
+    """Return whether a failed request may succeed if it is sent again."""
+    if isinstance(error, APIConnectionError):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in RETRY_STATUS_CODES
+
+def retry_delay(error: BaseException, retry: int) -> float:
+    """Return the wait before retry number `retry` (1-based), with full jitter.
+
+    A Retry-After header from the server is honored up to RETRY_MAX_DELAY.
+    """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(RETRY_BASE_DELAY * 2 ** (retry - 1), RETRY_MAX_DELAY))
+
+class Backend:
+    """One LM Studio endpoint with its client, circuit breaker, load and recent time to first token."""
+
+    def __init__(self, base_url: str, client: AsyncOpenAI):
+        self.base_url = base_url
+        self.client = client
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.healthy = True
+        self.ttft_samples = collections.deque(maxlen=BACKEND_TTFT_WINDOW)
+
+    def ttft(self) -> Optional[float]:
+        """Return the rolling average time to first token, or None before the first sample."""
+        return sum(self.ttft_samples) / len(self.ttft_samples) if self.ttft_samples else None
+
+class BackendPool:
+    """Routes chat requests across several LM Studio endpoints serving the same model.
+
+    Each request goes to the healthy endpoint with the lowest expected wait, estimated
+    as (requests in flight + 1) x rolling time to first token. Endpoints without a
+    sample yet are assumed to be as fast as the fastest known one, and ties go to the
+    endpoint that has served fewest requests, so new endpoints are tried early.
+
+    A background task probes every endpoint's /models route. An endpoint that fails
+    BACKEND_MAX_FAILURES probes or connection attempts in a row is taken out of
+    rotation until a probe succeeds again. When every endpoint is down, requests are
+    still attempted on all of them rather than refused.
+
+    Each endpoint also has its own circuit breaker, fed by the outcome of every
+    request, so one endpoint that keeps failing is skipped without pausing the
+    others. Requests fail at once with CircuitOpenError only while every circuit
+    is open.
+    """
+
+    def __init__(self, base_urls: List[str], client: Optional[AsyncOpenAI] = None):
+        # The first endpoint reuses the given client so code holding it shares its state
+        self.backends = [
+            Backend(base_url, client if index == 0 and client is not None else make_openai_client(base_url))
+            for index, base_url in enumerate(base_urls)
+        ]
+        self.task: Optional[asyncio.Task] = None
+
+    def pick(self, backends: Optional[List[Backend]] = None) -> Backend:
+        """Return the healthy endpoint with the lowest expected wait, out of `backends` or all of them."""
+        backends = backends or self.backends
+        candidates = [backend for backend in backends if backend.healthy] or backends
+        known = [backend.ttft() for backend in candidates if backend.ttft() is not None]
+        default_ttft = min(known) if known else BACKEND_DEFAULT_TTFT
+
+        def expected_wait(backend: Backend):
+            ttft = backend.ttft()
+            return ((backend.in_flight + 1) * (ttft if ttft is not None else default_ttft), backend.in_flight, backend.requests)
+
+        return min(candidates, key=expected_wait)
+
+    def circuit_open_error(self) -> CircuitOpenError:
+        """Return the error for a request made while every endpoint's circuit is open."""
+        if any(backend.breaker.trial_in_flight for backend in self.backends):
+            return CircuitOpenError("LM Studio is not responding; waiting for a trial request to see if it is back")
+        retry_in = min(backend.breaker.retry_in() for backend in self.backends)
+        return CircuitOpenError(f"LM Studio is not responding; requests are paused for another {max(retry_in, 1):.0f}s")
+
+    def record_failure(self, backend: Backend) -> None:
+        backend.failures += 1
+        if backend.failures >= BACKEND_MAX_FAILURES and backend.healthy:
+            backend.healthy = False
+            console.print(f"[{WARNING_STYLE}]LM Studio endpoint {backend.base_url} is down; taken out of rotation[/{WARNING_STYLE}]")
+
+    def record_success(self, backend: Backend) -> None:
+        backend.failures = 0
+        if not backend.healthy:
+            backend.healthy = True
+            console.print(f"[{INFO_STYLE}]LM Studio endpoint {backend.base_url} is back[/{INFO_STYLE}]")
+
+    async def probe(self, backend: Backend) -> bool:
+        """Check that an endpoint answers its /models route and update its health."""
+        try:
+            await backend.client.with_options(max_retries=0).models.list(timeout=BACKEND_HEALTH_TIMEOUT)
+        except Exception:
+            self.record_failure(backend)
+            return False
+        self.record_success(backend)
+        return True
+
+    async def check_health(self) -> None:
+        """Probe every endpoint at once."""
+        await asyncio.gather(*(self.probe(backend) for backend in self.backends))
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(BACKEND_HEALTH_INTERVAL)
+            await self.check_health()
+
+    def start(self) -> None:
+        """Start probing in the background; a single endpoint has nowhere else to route to."""
+        if self.task is None and len(self.backends) > 1:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def create(self, **request):
+        """Send a chat.completions.create request to the least-loaded healthy endpoint whose circuit is not open.
+
+        Streams are returned wrapped so the endpoint counts as busy until the stream
+        is read to the end, and the arrival of the first chunk is timed.
+        """
+        available = [backend for backend in self.backends if backend.breaker.available()]
+        if not available:
+            raise self.circuit_open_error()
+        backend = self.pick(available)
+        # Claims the trial request if the endpoint's circuit is half-open
+        backend.breaker.allow()
+        # Counted before the first await so concurrent requests see each other's load
+        backend.in_flight += 1
+        backend.requests += 1
+        start_time = time.time()
+        try:
+            response = await backend.client.chat.completions.create(**request)
+        except BaseException as e:
+            backend.in_flight -= 1
+            if isinstance(e, APIConnectionError):
+                self.record_failure(backend)
+            if is_retryable(e):
+                backend.breaker.record_failure()
+            elif isinstance(e, APIStatusError):
+                # The server answered, so it is up even though the request was rejected
+                backend.breaker.record_success()
+            else:
+                backend.breaker.trial_in_flight = False
+            raise
+        self.record_success(backend)
+        backend.breaker.record_success()
+        if not request.get("stream"):
+            backend.in_flight -= 1
+            return response
+        return self.track_stream(backend, response, start_time)
+
+    async def track_stream(self, backend: Backend, stream, start_time: float) -> AsyncGenerator[Any, None]:
+        try:
+            first_chunk = True
+            async for chunk in stream:
+                if first_chunk:
+                    backend.ttft_samples.append(time.time() - start_time)
+                    first_chunk = False
+                yield chunk
+        finally:
+            backend.in_flight -= 1
+
+    def describe(self) -> str:
+        """Return one line per endpoint for the session stats."""
+        lines = []
+        for backend in self.backends:
+            ttft = backend.ttft()
+            lines.append(
+                f"{backend.base_url} {'up' if backend.healthy else 'down'}, circuit {backend.breaker.state}, "
+                f"{backend.requests} requests, {backend.in_flight} in flight, TTFT "
+                + (f"{ttft:.2f}s" if ttft is not None else "n/a")
+            )
+        return "; ".join(lines)
+
+backend_pool = BackendPool(LM_STUDIO_BASE_URLS, openai_client)
+
+class RequestRetrier:
+    """Sends LM Studio requests with exponential backoff.
+
+    Connection errors, timeouts and the status codes in RETRY_STATUS_CODES are
+    retried up to RETRY_MAX_ATTEMPTS times, so a retry sent through backend_pool
+    can land on another endpoint; other errors are raised at once, and so is the
+    CircuitOpenError the pool raises while every endpoint's circuit is open. Each
+    retry is recorded, with the time it added to the request, for the session stats.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.retried_calls = 0
+        self.failed_calls = 0
+        self.fast_failures = 0
+        self.retry_latency = 0.0
+        self.recent = collections.deque(maxlen=20)
+
+    async def call(self, label: str, send, **request):
+        """Await send(**request), retrying retryable failures."""
+        self.calls += 1
+        start_time = time.monotonic()
+        attempt = 1
+        while True:
+            try:
+                response = await send(**request)
+            except CircuitOpenError:
+                self.fast_failures += 1
+                self.failed_calls += 1
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    self.failed_calls += 1
+                    raise
+                if attempt >= RETRY_MAX_ATTEMPTS:
+                    self.failed_calls += 1
+                    self.retry_latency += time.monotonic() - start_time
+                    raise
+                delay = retry_delay(e, attempt)
+                self.retries += 1
+                if attempt == 1:
+                    self.retried_calls += 1
+                self.recent.append({"label": label, "attempt": attempt, "error": type(e).__name__, "delay": delay})
+                console.print(
+                    f"[{WARNING_STYLE}]{label} request failed ({type(e).__name__}); "
+                    f"retry {attempt}/{RETRY_MAX_ATTEMPTS - 1} in {delay:.1f}s[/{WARNING_STYLE}]"
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if attempt > 1:
+                # Everything before the successful attempt was spent on failures and backoff
+                self.retry_latency += time.monotonic() - start_time
+            return response
+
+    def describe(self) -> str:
+        """Return a summary line for the session stats."""
+        return (
+            f"{self.retries} retries on {self.retried_calls} of {self.calls} requests, "
+            f"~{self.retry_latency:.1f}s added, {self.failed_calls} failed ({self.fast_failures} fast)"
+        )
+
+request_retrier = RequestRetrier()
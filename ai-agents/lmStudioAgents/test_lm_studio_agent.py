@@ -21,24 +21,63 @@ Run with:
 """
 
 import os
+import sys
+import json
+import hashlib
 import pytest
+import pytest_asyncio
 import glob
+import time
 import asyncio
+import threading
+import subprocess
+import httpx
+import openai
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from openai.types.chat import ChatCompletionChunk
 
 LM_STUDIO_BASE_URL = "http://localhost:1234/v1"
 LM_STUDIO_API_KEY = "dummy-key"  # LM Studio doesn't need a real API key
 
 # Import functions from the main script
+import lm_studio_agent_clean_ui_bash_tool_use_vision_v4 as agent_module
 from lm_studio_agent_clean_ui_bash_tool_use_vision_v4 import (
     create_file,
     replace_text,
     insert_line,
+    apply_edits,
     view_file,
     execute_command,
+    read_command_output,
     find_file,
+    FileContentCache,
+    FileIndex,
+    LineIndex,
     describe_image,
+    preprocess_image,
+    ImageDescriptionCache,
+    describe_images,
+    ResponseCache,
+    execute_tool_calls,
+    JsonCompletenessDetector,
+    HistoryManager,
+    HistorySummarizer,
+    ToolCallSpeculator,
     create_lm_agent,
-    run_lm_agent
+    run_lm_agent,
+    TOOL_MAP
+)
+import image_pipeline
+import lm_studio_backends
+from image_pipeline import sniff_image_type
+from lm_studio_backends import (
+    BackendPool,
+    CircuitBreaker,
+    CircuitOpenError,
+    RequestRetrier,
+    retry_delay
 )
 
 # Define a fixture for LM Studio connectivity
@@ -98,6 +137,121 @@ def test_find_file():
         if os.path.exists(test_file):
             os.remove(test_file)
 
+def make_workspace(root):
+    """Create a small tree with nested, duplicate and gitignored files."""
+    for rel_path in ["src/pkg/util.py", "tests/util.py", "docs/utilities.md", "build/util.py",
+                     "app.log", "src/pkg/notes.log", "src/pkg/keep.log"]:
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(rel_path)
+    (root / ".gitignore").write_text("# build output\nbuild/\n*.log\n")
+    (root / "src" / ".gitignore").write_text("!pkg/keep.log\n")
+
+def test_file_index_ranks_nested_and_fuzzy_matches(tmp_path):
+    """Test that the index finds files in subdirectories, ranks them and honours .gitignore."""
+    make_workspace(tmp_path)
+    index = FileIndex()
+    index.build(str(tmp_path))
+
+    assert sorted(path for _, path in index.lookup("util.py")) == ["src/pkg/util.py", "tests/util.py"]
+    assert index.lookup("pkg/util.py")[0][1] == "src/pkg/util.py"
+    assert index.lookup("utilit")[0][1] == "docs/utilities.md"
+    assert index.lookup("src/pkg/keep.log")[0][1] == "src/pkg/keep.log"
+    # Ignored directories and patterns are not indexed
+    assert "build/util.py" not in index.paths_by_name["util.py"]
+    assert "app.log" not in index.paths_by_name and "notes.log" not in index.paths_by_name
+    assert index.lookup("nothing_like_this.txt") == []
+
+def test_file_index_refreshes_changed_directories(tmp_path, monkeypatch):
+    """Test that polling picks up added and removed files, and that find_file uses the index."""
+    make_workspace(tmp_path)
+    index = FileIndex()
+    index.build(str(tmp_path))
+    monkeypatch.setattr(agent_module, "file_index", index)
+
+    (tmp_path / "src" / "pkg" / "helpers").mkdir()
+    (tmp_path / "src" / "pkg" / "helpers" / "strings.py").write_text("")
+    (tmp_path / "tests" / "util.py").unlink()
+    index.refresh()
+
+    assert index.lookup("strings.py")[0][1] == "src/pkg/helpers/strings.py"
+    assert [path for _, path in index.lookup("util.py")] == ["src/pkg/util.py"]
+
+    monkeypatch.chdir(tmp_path / "docs")
+    result = find_file("helpers/strings.py")
+    assert result["status"] == "found"
+    assert result["file_path"] == str(tmp_path / "src" / "pkg" / "helpers" / "strings.py")
+
+def test_file_index_follows_file_system_events(tmp_path):
+    """Test that watchdog-style events rescan only the directories they name."""
+    make_workspace(tmp_path)
+    index = FileIndex()
+    index.build(str(tmp_path))
+
+    (tmp_path / "src" / "pkg" / "helpers").mkdir()
+    (tmp_path / "src" / "pkg" / "helpers" / "strings.py").write_text("")
+    (tmp_path / "tests" / "util.py").rename(tmp_path / "tests" / "test_util.py")
+    (tmp_path / "docs" / "utilities.md").write_text("edited")
+    for event in [
+        SimpleNamespace(event_type="created", src_path=str(tmp_path / "src" / "pkg" / "helpers"), is_directory=True),
+        SimpleNamespace(event_type="moved", src_path=str(tmp_path / "tests" / "util.py"),
+                        dest_path=str(tmp_path / "tests" / "test_util.py"), is_directory=False),
+        SimpleNamespace(event_type="modified", src_path=str(tmp_path / "docs" / "utilities.md"), is_directory=False),
+    ]:
+        index.dispatch(event)
+    assert index.changed.is_set()
+    assert index.dirty_dirs == {"src/pkg", "tests"}
+
+    index.rescan_dirty()
+    assert index.lookup("strings.py")[0][1] == "src/pkg/helpers/strings.py"
+    assert index.lookup("test_util.py")[0][1] == "tests/test_util.py"
+    assert [path for _, path in index.lookup("util.py")] == ["src/pkg/util.py"]
+    assert not index.dirty_dirs
+
+def test_gitignore_anchored_and_directory_patterns(tmp_path):
+    """Test that anchored, directory-only and ** patterns match the way git matches them."""
+    for rel_path in ["top.txt", "src/top.txt", "src/main.py", "src/pkg/deep.py", "logs", "out/logs/run.txt",
+                     "a/b.txt", "a/x/y/b.txt", "cache/tmp/data.bin", "cache/keep.bin"]:
+        path = tmp_path / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(rel_path)
+    (tmp_path / ".gitignore").write_text("/top.txt\nsrc/*.py\nlogs/\na/**/b.txt\ncache/**/\n")
+    index = FileIndex()
+    index.build(str(tmp_path))
+    indexed = {path for paths in index.paths_by_name.values() for path in paths}
+
+    # A leading slash or an inner slash anchors the pattern to the .gitignore's directory
+    assert "top.txt" not in indexed and "src/top.txt" in indexed
+    # "*" does not cross directories
+    assert "src/main.py" not in indexed and "src/pkg/deep.py" in indexed
+    # A trailing slash only matches directories, at any depth when there is no other slash
+    assert "logs" in indexed and "out/logs/run.txt" not in indexed
+    # "**/" matches zero or more directories
+    assert "a/b.txt" not in indexed and "a/x/y/b.txt" not in indexed
+    assert "cache/tmp/data.bin" not in indexed and "cache/keep.bin" in indexed
+
+def test_misspelled_names_are_only_suggested(tmp_path, monkeypatch):
+    """Test that fuzzy matches are suggested, never edited, while path suffixes still resolve."""
+    make_workspace(tmp_path)
+    (tmp_path / "tests" / "util.py").unlink()
+    index = FileIndex()
+    index.build(str(tmp_path))
+    monkeypatch.setattr(agent_module, "file_index", index)
+    monkeypatch.chdir(tmp_path / "docs")
+
+    result = find_file("utils.py")
+    assert result["status"] == "suggestions" and "src/pkg/util.py" in result["suggestions"]
+    assert find_file("pkg/util.py")["status"] == "found"
+    assert find_file("util.py")["file_path"] == str(tmp_path / "src" / "pkg" / "util.py")
+
+    for result in (
+        replace_text("utils.py", "src", "edited"),
+        insert_line("utils.py", 1, "edited"),
+        apply_edits("utils.py", [{"search_text": "src", "replace_text": "edited"}]),
+    ):
+        assert result["status"] == "error" and "src/pkg/util.py" in result["message"]
+    assert (tmp_path / "src" / "pkg" / "util.py").read_text() == "src/pkg/util.py"
+
 def test_create_file():
     """Test creating a file."""
     test_file = "test_create_temp.txt"
@@ -136,6 +290,41 @@ def test_view_file():
         if os.path.exists(test_file):
             os.remove(test_file)
 
+def test_line_index_finds_line_offsets():
+    """Test the sparse newline index against a plain scan, with blocks much smaller than the file."""
+    data = "".join(f"line {i}\n" if i % 7 else "\n" for i in range(1, 301)).encode() + b"no trailing newline"
+    index = LineIndex(data, block_size=16)
+    starts = [0] + [i + 1 for i, byte in enumerate(data) if byte == ord("\n")]
+    assert index.total_lines == 301
+    for line_number in (1, 2, 7, 8, 150, 300, 301):
+        assert index.line_start(data, line_number) == starts[line_number - 1]
+    assert index.line_start(data, 302) == len(data)
+
+def test_view_file_ranges_and_paging(tmp_path, monkeypatch):
+    """Test ranged views with line numbers, automatic cutting and reuse of the newline index."""
+    monkeypatch.setattr(agent_module, "VIEW_FILE_MAX_BYTES", 200)
+    test_file = tmp_path / "big.log"
+    test_file.write_text("".join(f"entry {i}\n" for i in range(1, 1001)))
+
+    result = view_file(str(test_file), start_line=900, end_line=902)
+    assert result["content"] == "   900  entry 900\n   901  entry 901\n   902  entry 902"
+    assert (result["end_line"], result["total_lines"]) == (902, 1000)
+    assert "next_start_line" not in result
+    index = agent_module.line_index_cache[str(test_file)][1]
+
+    # The whole file is too large, so the first page comes back with a hint
+    page = view_file(str(test_file))
+    assert page["start_line"] == 1 and page["end_line"] < 1000
+    assert page["next_start_line"] == page["end_line"] + 1
+    assert f"start_line={page['next_start_line']}" in page["message"]
+    assert agent_module.line_index_cache[str(test_file)][1] is index
+
+    # A changed file gets a new index
+    with open(test_file, "a") as f:
+        f.write("entry 1001\n")
+    assert view_file(str(test_file), start_line=1001)["content"] == "  1001  entry 1001"
+    assert view_file(str(test_file), start_line=2000)["status"] == "error"
+
 def test_replace_text():
     """Test replacing text in a file."""
     test_file = "test_replace_temp.txt"
@@ -160,6 +349,51 @@ def test_replace_text():
         if os.path.exists(test_file):
             os.remove(test_file)
 
+def test_edit_tools_return_diffs(tmp_path):
+    """Test that edits return a compact diff and hash, and the whole file only on request."""
+    test_file = tmp_path / "long.py"
+    test_file.write_text("".join(f"line_{i} = {i}\n" for i in range(1, 201)))
+
+    result = replace_text(str(test_file), "line_100 = 100", "line_100 = 'hundred'")
+    assert "updated_content" not in result
+    assert "-line_100 = 100\n+line_100 = 'hundred'\n" in result["diff"]
+    assert " line_97 = 97\n" in result["diff"] and "line_96 = 96" not in result["diff"]
+    assert result["sha256"] == hashlib.sha256(test_file.read_bytes()).hexdigest()
+
+    result = insert_line(str(test_file), 1, "# header", return_content=True)
+    assert result["diff"].startswith("--- a/long.py\n+++ b/long.py\n@@ -1,3 +1,4 @@\n+# header\n")
+    assert result["updated_content"] == test_file.read_text()
+
+    result = create_file(str(tmp_path / "new.txt"), "one\ntwo")
+    assert "content" not in result and result["lines"] == 2
+
+def test_apply_edits_is_all_or_nothing(tmp_path):
+    """Test that apply_edits applies many edits in one pass, or none if any anchor fails."""
+    test_file = tmp_path / "module.py"
+    original = "import os\n\ndef old_name():\n    return old_name\n"
+    test_file.write_text(original)
+
+    result = apply_edits(str(test_file), [
+        {"search_text": "old_name", "replace_text": "new_name"},
+        {"line_number": 1, "content": "import sys"},
+        {"line_number": 5, "content": "# end"},
+    ])
+    assert result["status"] == "success"
+    assert test_file.read_text() == "import sys\nimport os\n\ndef new_name():\n    return new_name\n# end\n"
+    added = [line for line in result["diff"].splitlines() if line.startswith("+") and not line.startswith("+++")]
+    assert added == ["+import sys", "+def new_name():", "+    return new_name", "+# end"]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    changed = test_file.read_text()
+    for edits in (
+        [{"search_text": "new_name", "replace_text": "x"}, {"search_text": "missing", "replace_text": "y"}],
+        [{"search_text": "def new_name", "replace_text": "x"}, {"search_text": "new_name():", "replace_text": "y"}],
+        [{"line_number": 99, "content": "z"}],
+    ):
+        result = apply_edits(str(test_file), edits)
+        assert result["status"] == "error" and "No edits applied" in result["message"]
+        assert test_file.read_text() == changed
+
 def test_insert_line():
     """Test inserting a line in a file."""
     test_file = "test_insert_temp.txt"
@@ -186,14 +420,1105 @@ def test_insert_line():
         if os.path.exists(test_file):
             os.remove(test_file)
 
-def test_execute_command():
+@pytest.mark.asyncio
+async def test_execute_command():
     """Test executing a command."""
     # Test a simple command that should work on all platforms
     command = "echo hello"
     
-    result = execute_command(command)
+    result = await execute_command(command)
     assert result["status"] == "success"
     assert "hello" in result["stdout"]
+    assert result["returncode"] == 0
+
+@pytest.mark.asyncio
+async def test_execute_command_failure_keeps_result_shape():
+    """Test that a failing command reports its stderr and return code."""
+    result = await execute_command("echo oops 1>&2 && exit 3")
+    assert result["status"] == "error"
+    assert result["returncode"] == 3
+    assert "oops" in result["stderr"]
+    assert set(result) == {"status", "message", "stdout", "stderr", "returncode"}
+
+@pytest.mark.asyncio
+async def test_execute_command_truncates_large_output(monkeypatch):
+    """Test that large output keeps only head and tail and can be paged through a handle."""
+    monkeypatch.setattr(agent_module, "COMMAND_OUTPUT_HEAD_BYTES", 100)
+    monkeypatch.setattr(agent_module, "COMMAND_OUTPUT_TAIL_BYTES", 100)
+    result = await execute_command("seq 1 5000")
+    full_output = "".join(f"{i}\n" for i in range(1, 5001))
+
+    assert result["status"] == "success"
+    assert result["stdout"].startswith(full_output[:100])
+    assert result["stdout"].endswith(full_output[-100:])
+    assert len(result["stdout"]) < 400
+    assert result["output_bytes"]["stdout"] == len(full_output)
+    assert "stderr" not in result["output_handles"]
+
+    handle = result["output_handles"]["stdout"]
+    page = read_command_output(handle, 100, 50)
+    assert page["content"] == full_output[100:150]
+    assert page["next_offset"] == 150
+    assert page["total_bytes"] == len(full_output)
+    assert read_command_output(handle, len(full_output) - 10)["next_offset"] is None
+    assert read_command_output("../../etc/passwd")["status"] == "error"
+
+@pytest.mark.asyncio
+async def test_execute_command_idle_timeout(monkeypatch):
+    """Test that a command producing no output is stopped by the idle timeout."""
+    monkeypatch.setattr(agent_module, "COMMAND_IDLE_TIMEOUT", 1)
+    start_time = time.time()
+    result = await execute_command("echo started && sleep 30")
+    assert time.time() - start_time < 10
+    assert result["status"] == "error"
+    assert "no output" in result["message"]
+    assert "started" in result["stdout"]
+
+@pytest.mark.asyncio
+async def test_execute_command_does_not_block_event_loop():
+    """Test that other coroutines keep running while a command executes."""
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.05)
+            ticks += 1
+
+    ticker_task = asyncio.create_task(ticker())
+    try:
+        await execute_command("sleep 1")
+    finally:
+        ticker_task.cancel()
+    assert ticks >= 10
+
+def make_tool_call(call_id, name, args):
+    """Build a tool call dict in the shape run_lm_agent assembles from the stream."""
+    return {"id": call_id, "type": "function", "function": {"name": name, "arguments": json.dumps(args)}}
+
+@pytest.mark.asyncio
+async def test_execute_tool_calls_runs_concurrently(monkeypatch):
+    """Test that independent tool calls overlap instead of running back to back."""
+    def slow_view_file(file_path):
+        time.sleep(0.3)
+        return {"status": "success", "content": file_path}
+
+    monkeypatch.setitem(TOOL_MAP, "view_file", slow_view_file)
+    tool_calls = [make_tool_call(f"call_{i}", "view_file", {"file_path": f"file_{i}.txt"}) for i in range(4)]
+
+    start_time = time.time()
+    results = await execute_tool_calls(tool_calls)
+    elapsed = time.time() - start_time
+
+    assert elapsed < 0.9
+    # Results keep the original tool call order
+    assert [result["content"] for result in results] == [f"file_{i}.txt" for i in range(4)]
+
+def test_file_content_cache_reuses_text_until_the_file_changes(tmp_path, monkeypatch):
+    """Test that reads are served from the cache while (mtime, size) match, and edits refresh it."""
+    cache = FileContentCache(max_chars=1024 * 1024)
+    monkeypatch.setattr(agent_module, "file_content_cache", cache)
+    test_file = tmp_path / "cached.txt"
+    test_file.write_text("alpha\nbeta\n")
+
+    first = view_file(str(test_file))
+    assert view_file(str(test_file)) == first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # The edit reuses the cached text and stores what it wrote
+    assert replace_text(str(test_file), "beta", "gamma")["status"] == "success"
+    assert insert_line(str(test_file), 1, "start")["status"] == "success"
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert view_file(str(test_file))["content"] == "start\nalpha\ngamma\n"
+
+    # A change made outside the tools is picked up from the new size and mtime
+    test_file.write_text("changed elsewhere")
+    assert view_file(str(test_file))["content"] == "changed elsewhere"
+    assert cache.misses == 2
+
+def test_file_content_cache_dedupes_views_in_window(tmp_path, monkeypatch):
+    """Test that a repeated view refers back to an earlier result only while that result is in the history."""
+    cache = FileContentCache(max_chars=1024 * 1024)
+    monkeypatch.setattr(agent_module, "file_content_cache", cache)
+    test_file = tmp_path / "repeat.txt"
+    test_file.write_text("same content")
+    result = view_file(str(test_file))
+
+    history = []
+    assert cache.dedupe_view("call_1", result, history) is result
+    history.append({"role": "tool", "tool_call_id": "call_1", "content": json.dumps(result)})
+
+    repeated = cache.dedupe_view("call_2", dict(result), history)
+    assert repeated["status"] == "unchanged"
+    assert "call_1" in repeated["message"] and "content" not in repeated
+
+    # Once the earlier result has been compacted away the full content is sent again
+    history.clear()
+    assert cache.dedupe_view("call_3", result, history) is result
+    assert cache.deduplicated == 1
+
+@pytest.mark.asyncio
+async def test_execute_tool_calls_serializes_same_path():
+    """Test that edits to the same file are applied in the original order."""
+    test_file = "test_dispatch_temp.txt"
+    tool_calls = [
+        make_tool_call("call_0", "create_file", {"file_path": test_file, "content": "one"}),
+        make_tool_call("call_1", "replace_text", {"file_path": test_file, "search_text": "one", "replace_text": "two"}),
+        make_tool_call("call_2", "insert_line", {"file_path": test_file, "line_number": 1, "content": "zero"}),
+        make_tool_call("call_3", "view_file", {"file_path": test_file}),
+    ]
+
+    try:
+        results = await execute_tool_calls(tool_calls)
+        assert all(result["status"] == "success" for result in results)
+        assert results[3]["content"] == "zero\ntwo"
+    finally:
+        # Clean up
+        if os.path.exists(test_file):
+            os.remove(test_file)
+
+@pytest.mark.asyncio
+async def test_execute_tool_calls_serializes_bare_and_indexed_paths(tmp_path, monkeypatch):
+    """Test that a bare file name and the indexed path it resolves to share one lock."""
+    make_workspace(tmp_path)
+    (tmp_path / "tests" / "util.py").unlink()
+    index = FileIndex()
+    index.build(str(tmp_path))
+    monkeypatch.setattr(agent_module, "file_index", index)
+    monkeypatch.chdir(tmp_path / "docs")
+    events = []
+
+    async def slow_tool(file_path, **kwargs):
+        events.append(("start", file_path))
+        await asyncio.sleep(0.05)
+        events.append(("end", file_path))
+        return {"status": "success"}
+
+    monkeypatch.setitem(TOOL_MAP, "view_file", slow_tool)
+    monkeypatch.setitem(TOOL_MAP, "replace_text", slow_tool)
+    full_path = str(tmp_path / "src" / "pkg" / "util.py")
+    tool_calls = [
+        make_tool_call("call_0", "view_file", {"file_path": "util.py"}),
+        make_tool_call("call_1", "replace_text", {"file_path": full_path, "search_text": "a", "replace_text": "b"}),
+    ]
+
+    await execute_tool_calls(tool_calls)
+    assert events == [("start", "util.py"), ("end", "util.py"), ("start", full_path), ("end", full_path)]
+
+@pytest.mark.asyncio
+async def test_execute_tool_calls_unknown_tool():
+    """Test that an unknown tool produces an error result instead of failing the batch."""
+    results = await execute_tool_calls([make_tool_call("call_0", "no_such_tool", {})])
+    assert results[0]["status"] == "error"
+
+def test_json_completeness_detector():
+    """Test that the detector only reports completion once the top-level object closes."""
+    detector = JsonCompletenessDetector()
+    assert not detector.feed('{"file_path": "a{b}')
+    assert not detector.feed('\\"}.txt", "nested": {"x": [1, ')
+    assert not detector.feed('2]}')
+    assert detector.feed('}')
+    assert detector.feed('  ')
+    # Trailing content means the arguments are not a single object after all
+    assert not detector.feed(', "extra": 1}')
+
+@pytest.mark.asyncio
+async def test_speculator_starts_read_only_calls_early():
+    """Test that read-only calls start before the stream ends and mutating calls do not."""
+    test_file = "test_speculate_temp.txt"
+    with open(test_file, 'w') as f:
+        f.write("speculative")
+
+    try:
+        speculator = ToolCallSpeculator()
+        tool_calls = [make_tool_call("call_0", "view_file", {}), make_tool_call("call_1", "create_file", {})]
+        tool_calls[0]["function"]["arguments"] = ""
+        for fragment in ['{"file_path": ', json.dumps(test_file), '}']:
+            tool_calls[0]["function"]["arguments"] += fragment
+            speculator.observe(tool_calls, 0, fragment)
+        assert 0 in speculator.tasks
+
+        # The create_file call is never started speculatively
+        tool_calls[1]["function"]["arguments"] = '{"file_path": "x", "content": "y"}'
+        speculator.observe(tool_calls, 1, tool_calls[1]["function"]["arguments"])
+        assert 1 not in speculator.tasks
+
+        started = speculator.take_started(tool_calls)
+        result = await started[0]
+        assert result["content"] == "speculative"
+    finally:
+        # Clean up
+        if os.path.exists(test_file):
+            os.remove(test_file)
+
+@pytest.mark.asyncio
+async def test_speculator_does_not_start_image_batches():
+    """Test that describe_images waits for the end of the stream but does not block later reads."""
+    speculator = ToolCallSpeculator()
+    tool_calls = [
+        make_tool_call("call_0", "describe_images", {"paths": ["photos/"]}),
+        make_tool_call("call_1", "view_file", {"file_path": "missing.txt"}),
+    ]
+    for index, call in enumerate(tool_calls):
+        speculator.observe(tool_calls, index, call["function"]["arguments"])
+
+    assert list(speculator.tasks) == [1]
+    speculator.cancel_pending()
+
+@pytest.mark.asyncio
+async def test_speculator_discards_changed_arguments():
+    """Test that a speculative result is dropped when the final arguments differ."""
+    speculator = ToolCallSpeculator()
+    tool_calls = [make_tool_call("call_0", "view_file", {"file_path": "missing_a.txt"})]
+    speculator.observe(tool_calls, 0, tool_calls[0]["function"]["arguments"])
+    assert 0 in speculator.tasks
+
+    tool_calls[0]["function"]["arguments"] = json.dumps({"file_path": "missing_b.txt"})
+    assert speculator.take_started(tool_calls) == {}
+
+def make_chunk(content=None, tool_calls=None):
+    """Build a streamed chat completion chunk with a single choice."""
+    delta = SimpleNamespace(content=content, tool_calls=tool_calls)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+def make_tool_call_delta(index, call_id=None, name=None, arguments=None):
+    """Build a streamed tool call delta."""
+    return SimpleNamespace(index=index, id=call_id, function=SimpleNamespace(name=name, arguments=arguments))
+
+class FakeCompletions:
+    """Stand-in for openai_client.chat.completions that replays scripted streams and responses."""
+
+    def __init__(self, streams):
+        self.streams = list(streams)
+        self.requests = []
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        chunks = self.streams.pop(0)
+        if isinstance(chunks, Exception):
+            # Scripted failures are raised when the request is opened
+            raise chunks
+        if not kwargs.get("stream"):
+            # Non-streaming requests get the scripted response object as-is
+            return chunks
+
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+        return stream()
+
+@pytest.fixture
+def fake_completions(monkeypatch):
+    """Route run_lm_agent's requests to a FakeCompletions instance with a clean history."""
+    fake = FakeCompletions([])
+    monkeypatch.setattr(lm_studio_backends.openai_client.chat, "completions", fake)
+    monkeypatch.setattr(agent_module, "conversation_history", [])
+    return fake
+
+@pytest.mark.asyncio
+async def test_run_lm_agent_with_tool_calls(fake_completions):
+    """Test a full turn: streamed tool calls, concurrent execution and the follow-up request."""
+    test_file = "test_run_agent_temp.txt"
+    with open(test_file, 'w') as f:
+        f.write("from the tool")
+
+    arguments = json.dumps({"file_path": test_file})
+    fake_completions.streams = [
+        [
+            make_chunk(tool_calls=[make_tool_call_delta(0, "call_0", "view_file", arguments[:10])]),
+            make_chunk(tool_calls=[make_tool_call_delta(0, arguments=arguments[10:])]),
+            make_chunk(tool_calls=[make_tool_call_delta(1, "call_1", "view_file", arguments)]),
+        ],
+        [make_chunk(content="Done.")],
+    ]
+
+    try:
+        response_text = ""
+        async for content in run_lm_agent("Show the file", create_lm_agent(), "test-model"):
+            response_text += content
+
+        assert response_text.endswith("Done.")
+        history = agent_module.conversation_history
+        assert [msg["role"] for msg in history] == ["user", "assistant", "tool", "tool", "assistant"]
+        assert [msg["tool_call_id"] for msg in history[2:4]] == ["call_0", "call_1"]
+        assert json.loads(history[2]["content"])["content"] == "from the tool"
+    finally:
+        # Clean up
+        if os.path.exists(test_file):
+            os.remove(test_file)
+
+def make_status_error(status_code, error_class=openai.InternalServerError, headers=None):
+    """Build the error the OpenAI client raises for an HTTP error response."""
+    request = httpx.Request("POST", "http://localhost:1234/v1/chat/completions")
+    response = httpx.Response(status_code, request=request, headers=headers)
+    return error_class(f"Error code: {status_code}", response=response, body=None)
+
+@pytest.fixture
+def retrier(monkeypatch):
+    """Use a fresh retrier with short backoffs, and closed circuits on every endpoint."""
+    fresh = RequestRetrier()
+    monkeypatch.setattr(agent_module, "request_retrier", fresh)
+    for backend in lm_studio_backends.backend_pool.backends:
+        monkeypatch.setattr(backend, "breaker", CircuitBreaker(failure_threshold=5, reset_timeout=30))
+    monkeypatch.setattr(lm_studio_backends, "RETRY_BASE_DELAY", 0.01)
+    return fresh
+
+@pytest.mark.asyncio
+async def test_run_lm_agent_retries_transient_errors(fake_completions, retrier):
+    """Test that a 503 while LM Studio is busy is retried and the turn still completes."""
+    fake_completions.streams = [make_status_error(503), [make_chunk(content="Hello")]]
+
+    response_text = ""
+    async for content in run_lm_agent("Say hello", create_lm_agent(), "test-model"):
+        response_text += content
+
+    assert response_text == "Hello"
+    assert len(fake_completions.requests) == 2
+    assert (retrier.retries, retrier.retried_calls, retrier.failed_calls) == (1, 1, 0)
+    assert retrier.recent[0]["label"] == "Initial"
+    assert retrier.recent[0]["error"] == "InternalServerError"
+    assert retrier.retry_latency > 0
+    assert lm_studio_backends.backend_pool.backends[0].breaker.state == "closed"
+
+@pytest.mark.asyncio
+async def test_run_lm_agent_does_not_retry_rejected_requests(fake_completions, retrier):
+    """Test that a 400 is reported at once and does not count against the circuit breaker."""
+    fake_completions.streams = [make_status_error(400, openai.BadRequestError)]
+
+    response_text = ""
+    async for content in run_lm_agent("Say hello", create_lm_agent(), "test-model"):
+        response_text += content
+
+    assert response_text.startswith("Error:")
+    assert len(fake_completions.requests) == 1
+    assert retrier.retries == 0
+    assert lm_studio_backends.backend_pool.backends[0].breaker.failures == 0
+
+class EndpointCompletions:
+    """Stand-in for one endpoint's chat.completions that is either reachable or refuses connections."""
+
+    def __init__(self, up=True):
+        self.up = up
+        self.requests = 0
+
+    async def create(self, **request):
+        self.requests += 1
+        if not self.up:
+            raise openai.APIConnectionError(request=httpx.Request("POST", "http://localhost:1234/v1/chat/completions"))
+        return "ok"
+
+def make_breaker_pool(monkeypatch, *endpoints):
+    """Build a two-endpoint pool with quick circuit breakers whose clients use the given completions."""
+    monkeypatch.setattr(lm_studio_backends, "CIRCUIT_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(lm_studio_backends, "CIRCUIT_RESET_TIMEOUT", 0.2)
+    monkeypatch.setattr(lm_studio_backends, "RETRY_BASE_DELAY", 0.01)
+    pool = BackendPool([f"http://localhost:{1234 + index}/v1" for index in range(len(endpoints))])
+    for backend, completions in zip(pool.backends, endpoints):
+        monkeypatch.setattr(backend.client.chat, "completions", completions)
+    return pool
+
+@pytest.mark.asyncio
+async def test_one_dead_endpoint_does_not_open_the_circuit_for_all(monkeypatch):
+    """Test that a failing endpoint's circuit opens on its own while the other one keeps serving."""
+    dead, live = EndpointCompletions(up=False), EndpointCompletions()
+    pool = make_breaker_pool(monkeypatch, dead, live)
+    monkeypatch.setattr(lm_studio_backends, "BACKEND_MAX_FAILURES", 100)  # Leave routing around it to the breaker
+    retrier = RequestRetrier()
+
+    for _ in range(6):
+        assert await retrier.call("Test", pool.create, model="stand-in") == "ok"
+
+    assert dead.requests == 2 and live.requests == 6
+    assert retrier.failed_calls == 0 and retrier.fast_failures == 0
+    assert [backend.breaker.state for backend in pool.backends] == ["open", "closed"]
+    assert all(backend.healthy for backend in pool.backends)
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast_and_recovers(monkeypatch):
+    """Test that requests fail fast once every endpoint's circuit is open, and a trial closes it again."""
+    first, second = EndpointCompletions(up=False), EndpointCompletions(up=False)
+    pool = make_breaker_pool(monkeypatch, first, second)
+    monkeypatch.setattr(lm_studio_backends, "RETRY_MAX_ATTEMPTS", 4)
+    retrier = RequestRetrier()
+
+    with pytest.raises(openai.APIConnectionError):
+        await retrier.call("Test", pool.create, model="stand-in")
+    assert first.requests + second.requests == 4
+    assert [backend.breaker.state for backend in pool.backends] == ["open", "open"]
+
+    with pytest.raises(CircuitOpenError, match="paused for another 1s"):
+        await retrier.call("Test", pool.create, model="stand-in")
+    assert first.requests + second.requests == 4
+    assert retrier.fast_failures == 1
+
+    await asyncio.sleep(0.25)
+    # While both trial requests are out, further requests are told so instead of "0s"
+    trials = [backend.breaker.allow() for backend in pool.backends]
+    assert trials == [True, True]
+    with pytest.raises(CircuitOpenError, match="trial request"):
+        await pool.create(model="stand-in")
+    for backend in pool.backends:
+        backend.breaker.trial_in_flight = False
+
+    first.up = second.up = True
+    assert await retrier.call("Test", pool.create, model="stand-in") == "ok"
+    assert "closed" in [backend.breaker.state for backend in pool.backends]
+    assert "circuit closed" in pool.describe()
+
+def test_retry_delay_backs_off_with_jitter(monkeypatch):
+    """Test that backoff ceilings double up to the limit and Retry-After is honored."""
+    monkeypatch.setattr(lm_studio_backends, "RETRY_BASE_DELAY", 0.5)
+    monkeypatch.setattr(lm_studio_backends, "RETRY_MAX_DELAY", 2.0)
+    error = make_status_error(503)
+    for retry, ceiling in [(1, 0.5), (2, 1.0), (3, 2.0), (6, 2.0)]:
+        delays = [retry_delay(error, retry) for _ in range(50)]
+        assert all(0 <= delay <= ceiling for delay in delays)
+    assert max(retry_delay(error, 3) for _ in range(200)) > 1.0
+
+    assert retry_delay(make_status_error(429, openai.RateLimitError, {"retry-after": "1.5"}), 1) == 1.5
+    assert retry_delay(make_status_error(429, openai.RateLimitError, {"retry-after": "60"}), 1) == 2.0
+
+def make_api_chunk(content=None, tool_calls=None, usage=None):
+    """Build a real ChatCompletionChunk, as the response cache stores and replays them."""
+    choices = [] if usage else [{"index": 0, "delta": {"content": content, "tool_calls": tool_calls}}]
+    chunk = {"id": "chunk", "object": "chat.completion.chunk", "created": 0, "model": "test-model", "choices": choices}
+    if usage:
+        chunk["usage"] = usage
+    return ChatCompletionChunk.model_validate(chunk)
+
+@pytest.mark.asyncio
+async def test_response_cache_replays_streams(fake_completions, tmp_path, monkeypatch):
+    """Test that a repeated turn is answered from the response cache, tool calls included."""
+    monkeypatch.setattr(agent_module, "RESPONSE_CACHE_ENABLED", True)
+    cache = ResponseCache(str(tmp_path / "responses.sqlite3"), ttl=3600, max_bytes=1024 * 1024)
+    monkeypatch.setattr(agent_module, "response_cache", cache)
+    # Keep the recorded usage from recalibrating the shared token estimate for later tests
+    monkeypatch.setattr(agent_module, "history_manager", HistoryManager())
+
+    test_file = tmp_path / "cached.txt"
+    test_file.write_text("from the tool")
+    arguments = json.dumps({"file_path": str(test_file)})
+    usage = {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110}
+    fake_completions.streams = [
+        [
+            make_api_chunk(tool_calls=[{"index": 0, "id": "call_0", "type": "function",
+                                        "function": {"name": "view_file", "arguments": arguments[:8]}}]),
+            make_api_chunk(tool_calls=[{"index": 0, "function": {"arguments": arguments[8:]}}]),
+            make_api_chunk(usage=usage),
+        ],
+        [make_api_chunk(content="The file says "), make_api_chunk(content="hello."), make_api_chunk(usage=usage)],
+    ]
+
+    async def run_turn():
+        agent_module.conversation_history = []
+        return [content async for content in run_lm_agent("Show the file", create_lm_agent(), "test-model")]
+
+    try:
+        first = await run_turn()
+        first_history = agent_module.conversation_history
+        first_usage = agent_module.history_manager.last_usage
+        first_scale = agent_module.history_manager.token_scale
+        second = await run_turn()
+    finally:
+        cache.close()
+
+    # Both requests of the second turn were replayed, and the tool still ran
+    assert len(fake_completions.requests) == 2
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert second == first
+    assert "".join(second).endswith("The file says hello.")
+    assert agent_module.conversation_history == first_history
+    assert json.loads(first_history[2]["content"])["content"] == "from the tool"
+    # Replayed usage does not recalibrate the token estimate
+    assert agent_module.history_manager.last_usage is first_usage
+    assert agent_module.history_manager.token_scale == first_scale
+
+def test_response_cache_expiry_and_eviction(tmp_path):
+    """Test the TTL, least recently used eviction and that the key ignores the timeout."""
+    cache = ResponseCache(str(tmp_path / "responses.sqlite3"), ttl=3600, max_bytes=250)
+    request = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0.1, "timeout": 60}
+    assert ResponseCache.make_key(request) == ResponseCache.make_key(dict(request, timeout=5))
+    assert ResponseCache.make_key(request) != ResponseCache.make_key(dict(request, temperature=0.2))
+
+    chunk = [{"text": "x" * 100}]
+    cache.put("a", chunk)
+    cache.put("b", chunk)
+    cache.connect().execute("UPDATE responses SET last_used = 0 WHERE key = 'b'")
+    cache.put("c", chunk)
+    assert cache.get("a") == chunk
+    assert cache.get("b") is None
+    assert cache.get("c") == chunk
+
+    cache.connect().execute("UPDATE responses SET created = 0 WHERE key = 'a'")
+    assert cache.get("a") is None
+    cache.close()
+
+def make_turn(turn_number, tool_result_size=0):
+    """Build one conversation turn, optionally with a tool call and a large tool result."""
+    turn = [{"role": "user", "content": f"question {turn_number}"}]
+    if tool_result_size:
+        turn.append({"role": "assistant", "content": None, "tool_calls": [
+            make_tool_call(f"call_{turn_number}", "view_file", {"file_path": "big.txt"})
+        ]})
+        turn.append({"role": "tool", "tool_call_id": f"call_{turn_number}", "content": "x" * tool_result_size})
+    turn.append({"role": "assistant", "content": f"answer {turn_number}"})
+    return turn
+
+class StandInServer:
+    """Minimal OpenAI-compatible server on a free local port, standing in for an LM Studio box."""
+
+    def __init__(self, first_token_delay=0.0):
+        self.first_token_delay = first_token_delay
+        self.chat_requests = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.send_json({"object": "list", "data": [{"id": "stand-in", "object": "model", "created": 0, "owned_by": "test"}]})
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with server.lock:
+                    server.chat_requests += 1
+                time.sleep(server.first_token_delay)
+                if not request.get("stream"):
+                    self.send_json({
+                        "id": "completion", "object": "chat.completion", "created": 0, "model": "stand-in",
+                        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": server.base_url}}]
+                    })
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for content in ("Hello from ", server.base_url):
+                    chunk = {
+                        "id": "chunk", "object": "chat.completion.chunk", "created": 0, "model": "stand-in",
+                        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest_asyncio.fixture
+async def stand_in_servers(monkeypatch):
+    """Start stand-in servers on demand and give the pool's clients a connection pool for this test."""
+    servers = []
+
+    def start(*first_token_delays):
+        new_servers = [StandInServer(delay) for delay in first_token_delays]
+        servers.extend(new_servers)
+        return new_servers
+
+    http_client = lm_studio_backends.DefaultAsyncHttpxClient()
+    monkeypatch.setattr(lm_studio_backends, "http_client", http_client)
+    yield start
+    await http_client.aclose()
+    for server in servers:
+        server.stop()
+
+async def read_stream(stream):
+    """Collect the text content of a streamed chat completion."""
+    text = ""
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            text += chunk.choices[0].delta.content
+    return text
+
+def chat_request(stream=True):
+    return {"model": "stand-in", "messages": [{"role": "user", "content": "hi"}], "stream": stream}
+
+@pytest.mark.asyncio
+async def test_backend_pool_spreads_concurrent_requests(stand_in_servers):
+    """Test that concurrent requests go to different endpoints by in-flight count."""
+    servers = stand_in_servers(0.2, 0.2)
+    pool = BackendPool([server.base_url for server in servers])
+
+    streams = await asyncio.gather(*(pool.create(**chat_request()) for _ in range(2)))
+    texts = await asyncio.gather(*(read_stream(stream) for stream in streams))
+
+    assert sorted(texts) == sorted(f"Hello from {server.base_url}" for server in servers)
+    assert [server.chat_requests for server in servers] == [1, 1]
+    assert [backend.in_flight for backend in pool.backends] == [0, 0]
+    assert all(backend.ttft() >= 0.2 for backend in pool.backends)
+
+@pytest.mark.asyncio
+async def test_backend_pool_prefers_the_faster_endpoint(stand_in_servers):
+    """Test that once both endpoints have been tried, idle requests go to the lower rolling TTFT."""
+    slow, fast = stand_in_servers(0.3, 0.0)
+    pool = BackendPool([slow.base_url, fast.base_url])
+
+    for _ in range(4):
+        await read_stream(await pool.create(**chat_request()))
+
+    assert (slow.chat_requests, fast.chat_requests) == (1, 3)
+    assert pool.backends[0].ttft() > pool.backends[1].ttft()
+
+@pytest.mark.asyncio
+async def test_backend_pool_routes_around_failed_probes(stand_in_servers):
+    """Test that an endpoint failing its health probes is taken out until a probe succeeds."""
+    up, down = stand_in_servers(0.0, 0.0)
+    pool = BackendPool([up.base_url, down.base_url])
+    down.stop()
+
+    await pool.check_health()
+    assert pool.backends[1].healthy
+    await pool.check_health()
+    assert [backend.healthy for backend in pool.backends] == [True, False]
+
+    # The healthy endpoint gets every request, even while it is busy
+    pool.backends[0].in_flight = 3
+    response = await pool.create(**chat_request(stream=False))
+    assert response.choices[0].message.content == up.base_url
+    assert pool.backends[0].in_flight == 3
+
+    pool.backends[0].healthy = False
+    await pool.check_health()
+    assert pool.backends[0].healthy
+    assert "down" in pool.describe()
+
+def test_history_manager_drops_whole_turns():
+    """Test that trimming never separates tool results from their tool call."""
+    manager = HistoryManager()
+    history = make_turn(1) + make_turn(2, tool_result_size=8000) + make_turn(3) + make_turn(4)
+
+    trimmed = manager.fit(history, budget=500)
+    assert trimmed == make_turn(3) + make_turn(4)
+    assert trimmed[0]["role"] == "user"
+
+    # With room for everything nothing is dropped
+    assert manager.fit(history, budget=100000) == history
+
+def test_history_manager_keeps_latest_turn_and_drops_orphans():
+    """Test that the latest turn survives and headless tool results are removed."""
+    manager = HistoryManager()
+    orphan = [{"role": "tool", "tool_call_id": "call_0", "content": "stale"}]
+    history = orphan + make_turn(1, tool_result_size=8000)
+    assert manager.fit(history, budget=10) == make_turn(1, tool_result_size=8000)
+
+def test_history_manager_compacts_in_large_chunks():
+    """Test that compaction drops a big block at once and then leaves the prefix alone."""
+    manager = HistoryManager()
+    history = []
+    for turn_number in range(1, 11):
+        history += make_turn(turn_number, tool_result_size=400)
+    budget = manager.estimate_tokens(history) - 1
+
+    compacted = manager.fit(history, budget)
+    assert manager.estimate_tokens(compacted) <= budget * agent_module.HISTORY_COMPACTION_TARGET
+    assert manager.compactions == 1
+
+    # Appending more turns keeps the compacted prefix byte-identical until the budget overflows again
+    grown = compacted + make_turn(11, tool_result_size=400)
+    assert manager.fit(grown, budget) == grown
+    assert manager.compactions == 1
+
+def test_history_manager_prefix_reuse_ratio():
+    """Test the estimated share of each request that repeats the previous request's prefix."""
+    manager = HistoryManager()
+    system_message = {"role": "system", "content": "system prompt"}
+    history = make_turn(1, tool_result_size=4000)
+
+    manager.record_request([system_message] + history)
+    assert manager.last_prefix_ratio == 0.0
+
+    manager.record_request([system_message] + history + make_turn(2))
+    assert 0.9 < manager.last_prefix_ratio < 1.0
+
+    # Dropping the oldest turn changes the prefix right after the system prompt
+    manager.record_request([system_message] + make_turn(2))
+    reused = manager.message_tokens(system_message) + manager.tools_tokens
+    assert manager.last_prefix_ratio == pytest.approx(reused / manager.last_raw_estimate)
+
+def test_history_manager_caches_and_calibrates():
+    """Test that token counts are cached per message and the scale follows reported usage."""
+    manager = HistoryManager()
+    message = {"role": "user", "content": "y" * 400}
+    first = manager.message_tokens(message)
+    message["content"] = "changed"  # Cached by identity, so the count is reused
+    assert manager.message_tokens(message) == first
+
+    manager.record_request([message])
+    manager.record_usage(SimpleNamespace(prompt_tokens=manager.last_raw_estimate * 2, completion_tokens=1))
+    assert manager.token_scale == pytest.approx(1.5)
+
+    # Only counts for the messages of the latest request are kept
+    for _ in range(5):
+        manager.message_tokens({"role": "system", "content": "rebuilt every turn"})
+    manager.record_request([message])
+    assert list(manager.token_cache) == [id(message)]
+
+@pytest.mark.asyncio
+async def test_run_lm_agent_reports_usage(fake_completions, monkeypatch):
+    """Test that the usage chunk at the end of a stream is recorded."""
+    monkeypatch.setattr(agent_module, "history_manager", HistoryManager())
+    usage_chunk = SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=123, completion_tokens=4))
+    fake_completions.streams = [[make_chunk(content="Hi."), usage_chunk]]
+
+    async for _ in run_lm_agent("Hello", create_lm_agent(), "test-model"):
+        pass
+
+    assert agent_module.history_manager.last_usage.prompt_tokens == 123
+    assert fake_completions.requests[0]["stream_options"] == {"include_usage": True}
+
+@pytest.mark.asyncio
+async def test_summarizer_folds_old_turns(fake_completions, monkeypatch):
+    """Test that idle-time summarization replaces the oldest turns with a summary turn."""
+    monkeypatch.setattr(agent_module, "SUMMARY_IDLE_DELAY", 0)
+    monkeypatch.setattr(agent_module, "SUMMARY_MESSAGE_CHARS", 500)
+    monkeypatch.setattr(agent_module, "HISTORY_MAX_TOKENS", 3000)
+    history = []
+    for turn_number in range(1, 11):
+        history += make_turn(turn_number, tool_result_size=1000)
+    monkeypatch.setattr(agent_module, "conversation_history", history)
+    fake_completions.streams = [[make_chunk(content="The user asked ten questions.")]]
+
+    summarizer = HistorySummarizer()
+    await summarizer.run_when_idle("test-model", {"role": "system", "content": "system prompt"})
+
+    new_history = agent_module.conversation_history
+    assert summarizer.summaries_applied == 1
+    assert new_history[0]["content"] == agent_module.SUMMARY_PREFIX + "The user asked ten questions."
+    assert new_history[1]["role"] == "assistant"
+    assert new_history[-len(make_turn(10, 1000)):] == make_turn(10, tool_result_size=1000)
+    assert len(new_history) < len(history)
+    # The transcript sent to the model has long tool results shortened
+    transcript = fake_completions.requests[0]["messages"][1]["content"]
+    assert "question 1" in transcript and "[truncated]" in transcript
+
+def test_compaction_expands_references_to_dropped_views(tmp_path, monkeypatch):
+    """Test that an "unchanged" view result gets the content back when the result it refers to is compacted away."""
+    cache = FileContentCache(max_chars=1024 * 1024)
+    monkeypatch.setattr(agent_module, "file_content_cache", cache)
+    monkeypatch.setattr(agent_module, "history_manager", HistoryManager())
+    monkeypatch.setattr(agent_module, "HISTORY_MAX_TOKENS", 500)
+    test_file = tmp_path / "repeat.txt"
+    test_file.write_text("same content")
+    result = view_file(str(test_file))
+
+    def view_turn(turn_number, tool_call_ids, history):
+        history.append({"role": "user", "content": f"question {turn_number}"})
+        for tool_call_id in tool_call_ids:
+            history.append({"role": "assistant", "content": None, "tool_calls": [
+                make_tool_call(tool_call_id, "view_file", {"file_path": str(test_file)})
+            ]})
+            content = json.dumps(cache.dedupe_view(tool_call_id, dict(result), history))
+            history.append({"role": "tool", "tool_call_id": tool_call_id, "content": content})
+        history.append({"role": "assistant", "content": f"answer {turn_number}"})
+
+    history = []
+    view_turn(1, ["call_a"], history)
+    for turn_number in range(2, 6):
+        history += make_turn(turn_number, tool_result_size=2000)
+    view_turn(6, ["call_b", "call_c"], history)
+    assert json.loads(history[-2]["content"])["status"] == "unchanged"
+    monkeypatch.setattr(agent_module, "conversation_history", history)
+
+    agent_module.prepare_history({"role": "system", "content": "system prompt"}, 100)
+
+    compacted = agent_module.conversation_history
+    tool_results = {message["tool_call_id"]: json.loads(message["content"]) for message in compacted if message["role"] == "tool"}
+    assert "call_a" not in tool_results
+    assert tool_results["call_b"]["content"] == "same content"
+    assert "call_b" in tool_results["call_c"]["message"]
+    # Later views refer to the result that now holds the content
+    assert "call_b" in cache.dedupe_view("call_d", dict(result), compacted)["message"]
+
+@pytest.mark.asyncio
+async def test_summarizer_cancel_leaves_history_untouched(monkeypatch):
+    """Test that cancelling a running summarization does not change the history."""
+    monkeypatch.setattr(agent_module, "SUMMARY_IDLE_DELAY", 0)
+    monkeypatch.setattr(agent_module, "HISTORY_MAX_TOKENS", 3000)
+    history = []
+    for turn_number in range(1, 11):
+        history += make_turn(turn_number, tool_result_size=1000)
+    monkeypatch.setattr(agent_module, "conversation_history", history)
+
+    started = asyncio.Event()
+
+    async def slow_summarize(model_name, turns):
+        started.set()
+        await asyncio.sleep(30)
+        return "too late"
+
+    summarizer = HistorySummarizer()
+    monkeypatch.setattr(summarizer, "summarize", slow_summarize)
+    task = asyncio.create_task(summarizer.run_when_idle("test-model", {"role": "system", "content": "system prompt"}))
+    await started.wait()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    assert agent_module.conversation_history is history
+    assert summarizer.summaries_applied == 0
+    assert summarizer.cancelled_runs == 1
+
+def test_sniff_image_type():
+    """Test that image formats are recognized from magic bytes, not extensions."""
+    with open("your_image.png", "rb") as f:
+        assert sniff_image_type(f.read(16)) == "image/png"
+    with open("your_image.jpeg", "rb") as f:
+        assert sniff_image_type(f.read(16)) == "image/jpeg"
+    assert sniff_image_type(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image/webp"
+    assert sniff_image_type(b"not an image") is None
+
+def test_preprocess_image_downscales_by_real_format(tmp_path):
+    """Test that a large PNG with a misleading extension is downscaled and sent as JPEG."""
+    from PIL import Image
+    image_path = tmp_path / "large.jpeg"
+    Image.new("RGBA", (4000, 3000), (255, 0, 0, 128)).save(image_path, format="PNG")
+
+    result = preprocess_image(str(image_path))
+    assert result["status"] == "success"
+    assert result["source_mime_type"] == "image/png"
+    assert result["source_size"] == (4000, 3000)
+    assert len(result["images"]) == 1
+    image = result["images"][0]
+    assert (image["width"], image["height"]) == (1024, 768)
+    assert image["mime_type"] == "image/jpeg"
+
+def test_preprocess_image_limits(tmp_path, monkeypatch):
+    """Test the pixel budget, optional tiling and unrecognized files."""
+    from PIL import Image
+    image_path = tmp_path / "wide.png"
+    Image.new("RGB", (4000, 1000), (0, 128, 255)).save(image_path)
+
+    monkeypatch.setattr(image_pipeline, "IMAGE_MAX_PIXELS", 1_000_000)
+    result = preprocess_image(str(image_path))
+    assert result["status"] == "error"
+    assert "pixels" in result["message"]
+
+    monkeypatch.setattr(image_pipeline, "IMAGE_MAX_PIXELS", 100_000_000)
+    monkeypatch.setattr(image_pipeline, "IMAGE_TILING_ENABLED", True)
+    result = preprocess_image(str(image_path))
+    assert result["status"] == "success"
+    # Overview plus a 2x2 grid of tiles
+    assert len(result["images"]) == 5
+    assert (result["images"][1]["width"], result["images"][1]["height"]) == (1024, 256)
+
+    text_path = tmp_path / "notes.png"
+    text_path.write_text("not an image")
+    assert preprocess_image(str(text_path))["status"] == "error"
+
+def test_image_describe_does_not_import_the_agent():
+    """Test that image_describe.py and its preprocessing workers load only the shared modules."""
+    code = (
+        "import sys, image_describe; "
+        "print('lm_studio_agent_clean_ui_bash_tool_use_vision_v4' in sys.modules, 'agents' in sys.modules)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True
+    ).stdout
+    assert output.split() == ["False", "False"]
+
+def make_completion(content):
+    """Build a non-streaming chat completion response."""
+    message = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+@pytest.fixture
+def image_cache(tmp_path, monkeypatch):
+    """Point describe_image at an empty image description cache and a known model id."""
+    cache = ImageDescriptionCache(str(tmp_path / "image_cache"), 1024 * 1024)
+    monkeypatch.setattr(agent_module, "image_description_cache", cache)
+    monkeypatch.setattr(agent_module, "active_model_id", "test-model")
+    return cache
+
+@pytest.mark.asyncio
+async def test_describe_image_uses_shared_client(fake_completions, image_cache):
+    """Test that describe_image awaits the shared async client with the vision settings."""
+    fake_completions.streams = [make_completion("A test image.")]
+
+    result = await describe_image("your_image.png")
+
+    assert result == {"status": "success", "description": "A test image."}
+    request = fake_completions.requests[0]
+    assert request["model"] == agent_module.VISION_MODEL
+    assert request["timeout"] == agent_module.VISION_TIMEOUT
+    image_part = request["messages"][-1]["content"][1]
+    # The 400 KB PNG is re-encoded as a much smaller JPEG
+    assert image_part["image_url"]["url"].startswith("data:image/jpeg;base64,")
+    # The description is not appended to the history by the tool itself
+    assert agent_module.conversation_history == []
+
+@pytest.mark.asyncio
+async def test_describe_image_cache_hit(fake_completions, image_cache, monkeypatch):
+    """Test that describing the same image twice runs inference once."""
+    fake_completions.streams = [make_completion("Cached description.")]
+
+    first = await describe_image("your_image.jpeg")
+    second = await describe_image("your_image.jpeg")
+
+    assert first["description"] == second["description"] == "Cached description."
+    assert second["cached"] is True
+    assert len(fake_completions.requests) == 1
+    assert (image_cache.hits, image_cache.misses) == (1, 1)
+
+    # A different model id is a different cache entry
+    monkeypatch.setattr(agent_module, "active_model_id", "other-model")
+    fake_completions.streams = [make_completion("Other model.")]
+    assert (await describe_image("your_image.jpeg"))["description"] == "Other model."
+
+class ConcurrencyTrackingCompletions(FakeCompletions):
+    """FakeCompletions that answers after a short delay and records peak concurrency."""
+
+    def __init__(self):
+        super().__init__([])
+        self.in_flight = 0
+        self.peak = 0
+
+    async def create(self, **kwargs):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(0.05)
+            self.requests.append(kwargs)
+            return make_completion(f"Image {len(self.requests)}")
+        finally:
+            self.in_flight -= 1
+
+@pytest.mark.asyncio
+async def test_describe_images_batch(tmp_path, image_cache, monkeypatch):
+    """Test that describe_images expands directories, bounds concurrency and aggregates results."""
+    from PIL import Image
+    completions = ConcurrencyTrackingCompletions()
+    monkeypatch.setattr(lm_studio_backends.openai_client.chat, "completions", completions)
+    monkeypatch.setattr(agent_module, "BATCH_CONCURRENCY", 2)
+    monkeypatch.setattr(image_pipeline, "BATCH_PREPROCESS_WORKERS", 2)
+    monkeypatch.setattr(image_pipeline, "preprocess_pool", None)
+
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    for index in range(5):
+        Image.new("RGB", (64 + index, 48), (index * 40, 0, 0)).save(image_dir / f"image_{index}.png")
+    # Non-images in a directory are skipped by sniffing, whatever their extension
+    (image_dir / "notes.png").write_text("not an image")
+    broken = tmp_path / "broken.jpg"
+    broken.write_text("not an image either")
+
+    try:
+        result = await describe_images([str(image_dir), str(tmp_path / "images" / "*.png"), str(broken), "missing.png"])
+    finally:
+        image_pipeline.shutdown_preprocess_pool()
+
+    assert result["status"] == "success"
+    assert result["described"] == 5
+    assert result["failed"] == 1
+    assert result["not_found"] == ["missing.png"]
+    # Results keep the input order and duplicates from the glob are dropped
+    assert [entry["path"] for entry in result["images"]] == \
+        [str(image_dir / f"image_{index}.png") for index in range(5)] + [str(broken)]
+    assert "error" in result["images"][-1]
+    assert len(completions.requests) == 5
+    assert completions.peak == 2
+
+    # A second run is answered from the description cache
+    repeat = await describe_images([str(image_dir / "image_0.png")])
+    assert repeat["cached"] == 1
+    assert len(completions.requests) == 5
+
+@pytest.mark.asyncio
+async def test_describe_bulk_writes_jsonl_and_resumes(tmp_path, monkeypatch):
+    """Test image_describe's bulk mode: one record per image, and a rerun skips finished images."""
+    from PIL import Image
+    import image_describe
+
+    completions = ConcurrencyTrackingCompletions()
+    monkeypatch.setattr(lm_studio_backends.openai_client.chat, "completions", completions)
+
+    async def loaded_model_id():
+        return "test-model"
+    monkeypatch.setattr(image_describe, "get_bulk_model_id", loaded_model_id)
+    cache = ImageDescriptionCache(str(tmp_path / "cache"), max_bytes=1024 * 1024)
+    monkeypatch.setattr(image_describe, "image_description_cache", cache)
+
+    image_dir = tmp_path / "photos"
+    (image_dir / "nested").mkdir(parents=True)
+    for index in range(3):
+        Image.new("RGB", (32, 32), (index * 60, 0, 0)).save(image_dir / f"photo_{index}.png")
+    Image.new("RGB", (32, 32)).save(image_dir / "nested" / "photo_3.jpg")
+    (image_dir / "readme.txt").write_text("not an image")
+    image_paths = image_describe.list_images(str(image_dir))
+    assert len(image_paths) == 4
+
+    output_path = tmp_path / "captions.jsonl"
+    # A record for an image that failed earlier is retried, a described one is not
+    with open(output_path, "w") as f:
+        f.write(json.dumps({"path": image_paths[0], "description": "Done before."}) + "\n")
+        f.write(json.dumps({"path": image_paths[1], "error": "timeout"}) + "\n")
+
+    backend = agent_module.backend_pool.backends[0]
+    routed_before = backend.requests
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        stats = await image_describe.describe_bulk(image_paths, str(output_path), concurrency=2, executor=executor)
+
+        assert stats["skipped"] == 1
+        assert stats["described"] == 3
+        assert len(completions.requests) == 3
+        # Bulk requests are routed through the backend pool
+        assert backend.requests - routed_before == 3 and backend.in_flight == 0
+        assert completions.peak <= 2
+
+        with open(output_path) as f:
+            records = [json.loads(line) for line in f][2:]
+        assert sorted(record["path"] for record in records) == sorted(image_paths[1:])
+        for record in records:
+            assert len(record["sha256"]) == 64
+            assert record["model"] == "test-model"
+            assert record["latency"] >= 0
+
+        # Everything is done now, so a rerun sends nothing
+        stats = await image_describe.describe_bulk(image_paths, str(output_path), concurrency=2, executor=executor)
+        assert stats["skipped"] == 4
+        assert len(completions.requests) == 3
+
+        # Descriptions are stored under the same key the interactive path and the agent use
+        raw = (image_dir / "photo_1.png").read_bytes()
+        key = ImageDescriptionCache.make_key(raw, image_describe.VISION_PROMPT, "test-model", image_describe.vision_cache_params())
+        assert cache.get(key) is not None
+
+        # A run into a new file answers described images from the cache
+        stats = await image_describe.describe_bulk(image_paths, str(tmp_path / "again.jsonl"), concurrency=2, executor=executor)
+        assert (stats["described"], stats["cached"]) == (4, 3)
+        assert len(completions.requests) == 4
+        with open(tmp_path / "again.jsonl") as f:
+            cached_records = [json.loads(line) for line in f if json.loads(line).get("cached")]
+        assert len(cached_records) == 3 and all(len(record["sha256"]) == 64 for record in cached_records)
+
+def test_image_description_cache_evicts_least_recently_used(tmp_path):
+    """Test size-based LRU eviction and that entries survive a new cache instance."""
+    cache = ImageDescriptionCache(str(tmp_path), max_bytes=1500)
+    keys = [ImageDescriptionCache.make_key(bytes([i]), "prompt", "model", {}) for i in range(3)]
+
+    cache.put(keys[0], "a" * 500, {})
+    cache.put(keys[1], "b" * 500, {})
+    # Touch the first entry so the second one is the least recently used
+    os.utime(cache.entry_path(keys[1]), (1, 1))
+    assert cache.get(keys[0]) == "a" * 500
+    cache.put(keys[2], "c" * 500, {})
+
+    reopened = ImageDescriptionCache(str(tmp_path), max_bytes=1500)
+    assert reopened.get(keys[0]) == "a" * 500
+    assert reopened.get(keys[1]) is None
+    assert reopened.get(keys[2]) == "c" * 500
 
 def test_create_lm_agent():
     """Test creating an LM Studio agent."""
@@ -239,7 +1564,8 @@ async def test_streaming_response(lm_studio_client):
     assert len(response_text) > 0
     print(f"Streaming response: {response_text}")
 
-def test_describe_image(lm_studio_client):
+@pytest.mark.asyncio
+async def test_describe_image(lm_studio_client):
     """Test the image description capability."""
     # Find any image files in the current directory
     image_files = glob.glob("*.jpeg") + glob.glob("*.png")
@@ -252,7 +1578,7 @@ def test_describe_image(lm_studio_client):
     print(f"Testing image description with: {test_image}")
     
     # Test describing the image
-    result = describe_image(test_image)
+    result = await describe_image(test_image)
     
     # Print the result for debugging
     print(f"Result: {result}")